@@ -0,0 +1,64 @@
+# conftest.py —— pytest 公共夹具：fakeredis（带 lupa，Lua 脚本照常执行），不需要真实 Redis / Keycloak
+# 用法（仓库根目录）：
+#   pip install -r zero-trust-gateway/requirements.txt
+#   python -m pytest -q tests
+import os
+import sys
+import tempfile
+import time
+
+import jwt
+import pytest
+
+GATEWAY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zero-trust-gateway")
+sys.path.insert(0, GATEWAY_DIR)
+
+# app 在导入时按环境变量建后端 / 决策日志：必须在任何测试导入 app 之前设好
+_TMP = tempfile.mkdtemp(prefix="zt-tests-")
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("CSV_PATH", os.path.join(_TMP, "decisions.csv"))
+os.environ.setdefault("ARCHIVE_PATH", os.path.join(_TMP, "decisions.zta"))
+os.environ.setdefault("POLICY_RELOAD_SECONDS", "0")
+os.environ.setdefault("JWT_VERIFY_MODE", "none")
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+T0 = 1_700_000_000_000  # 固定起点（毫秒），各测试显式传 now
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def make_client(redis_server):
+    """同一个 FakeServer 上的新连接（decode_responses=True，与网关一致）"""
+    def make():
+        return fakeredis.FakeRedis(server=redis_server, decode_responses=True)
+    return make
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
+
+
+def auth_headers(user="alice", ip="10.0.0.1"):
+    """JWT_VERIFY_MODE=none 下可用的未签名 token"""
+    token = jwt.encode({"preferred_username": user, "exp": int(time.time()) + 3600}, None, algorithm="none")
+    return {"Authorization": f"Bearer {token}", "X-Forwarded-For": ip, "User-Agent": "pytest"}
+
+
+@pytest.fixture
+def make_gateway(monkeypatch):
+    """每次调用：新 FakeServer 上的 Redis 后端网关，替换 app 模块里的全局 gateway；返回 (gateway, client)"""
+    import app as gw
+
+    def make(mode="script", **kwargs):
+        client = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        gateway = gw.ZeroTrustGateway(client=client, mode=mode, **kwargs)
+        monkeypatch.setattr(gw, "gateway", gateway)
+        return gateway, client
+    return make
@@ -0,0 +1,79 @@
+"""批量决策：score_many 与同样顺序的逐条评分一致；/api/access-request/batch 与同样顺序的单条请求一致"""
+import random
+
+import fakeredis
+import pytest
+
+import app as gw
+from conftest import T0, auth_headers
+from rate_limit import parse_rate_limits
+from state_backend import MemoryStateBackend, RedisStateBackend, ScoreSignals
+
+RULES = parse_rate_limits("/admin=3/60,/=5/60")
+FINGERPRINTS = [("%02x" % k) * 32 for k in range(4)]
+ITEMS = [
+    {"resource": "/reports"},
+    {"resource": "/reports", "platform": "Linux"},
+    {"resource": "/admin/users"},
+    {"resource": "/reports", "timezone": "Europe/Berlin"},
+    {"resource": "/transfer"},
+    {"resource": "/reports"},
+]
+
+
+def make_backend(mode):
+    if mode == "memory":
+        return MemoryStateBackend(rules=RULES)
+    return RedisStateBackend(fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True),
+                             mode, rules=RULES)
+
+
+def random_signals(rng):
+    return ScoreSignals(rng.choice(["10.0.0.1", "10.0.0.2"]), rng.choice(FINGERPRINTS), False,
+                        rng.random() < 0.3, rng.choice(["/admin/users", "/reports"]), 12)
+
+
+@pytest.mark.parametrize("mode", ["memory", "script", "calls"])
+def test_score_many_matches_sequential(mode):
+    """批量评分（/api/access-request/batch 用）与同样顺序的逐条评分结果、落下的状态都一致"""
+    rng = random.Random(3)
+    batched, sequential = make_backend(mode), make_backend(mode)
+    now = T0
+    for _ in range(40):
+        now += rng.choice([100, 3000, 30000])
+        items = [random_signals(rng) for _ in range(rng.randint(1, 8))]
+        assert batched.score_many("alice", items, now) == [sequential.score("alice", s, now) for s in items]
+    assert batched.user_states(["alice"], now) == sequential.user_states(["alice"], now)
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_batch_matches_single_requests(make_gateway, mode):
+    tc = gw.app.test_client()
+
+    single_gateway, _ = make_gateway(mode)
+    singles = []
+    for item in ITEMS:
+        r = tc.post("/api/access-request", json=item, headers=auth_headers())
+        singles.append((r.get_json(), r.status_code))
+
+    batch_gateway, client = make_gateway(mode)
+    r = tc.post("/api/access-request/batch", json={"items": ITEMS}, headers=auth_headers())
+    assert r.status_code == 200
+    results = r.get_json()["results"]
+
+    assert [(x["trust_score"], x["access_decision"], x["reason"], x["status"]) for x in results] == \
+        [(b["trust_score"], b["access_decision"], b["reason"], code) for b, code in singles]
+    assert client.xlen("access_stream") == len(ITEMS)
+    single_state = single_gateway.backend.user_states(["alice"])[0]
+    batch_state = batch_gateway.backend.user_states(["alice"])[0]
+    assert (batch_state.trust_score, batch_state.last_ip, batch_state.flags) == \
+        (single_state.trust_score, single_state.last_ip, single_state.flags)
+
+
+def test_batch_rejects_bad_items(make_gateway):
+    make_gateway()
+    tc = gw.app.test_client()
+    assert tc.post("/api/access-request/batch", json={"items": ITEMS}).status_code == 401
+    assert tc.post("/api/access-request/batch", json={"items": "x"}, headers=auth_headers()).status_code == 400
+    too_many = [{"resource": "/"}] * (gw.BATCH_MAX_ITEMS + 1)
+    assert tc.post("/api/access-request/batch", json={"items": too_many}, headers=auth_headers()).status_code == 413
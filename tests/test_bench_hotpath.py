@@ -0,0 +1,32 @@
+"""热路径基准的回归判定：亚微秒阶段的计时抖动不算退化，真实变慢与分配增长仍报出"""
+from bench_hotpath import ALLOC_SLACK_BYTES, TIME_SLACK_NS, compare
+
+
+def result(**stages):
+    return {"stages": {name: dict({"alloc_peak_bytes": 1000, "ns_noise": 0.0}, **s) for name, s in stages.items()}}
+
+
+def test_sub_microsecond_jitter_is_not_a_regression():
+    base = result(select_policy={"ops_per_sec": 1_000_000})   # 1000 ns/op
+    now = result(select_policy={"ops_per_sec": 730_000})      # -27%，约 1370 ns/op
+    assert compare(base, now, 0.15) == []
+
+
+def test_slow_stage_regression_is_reported():
+    base = result(calculate_trust_score={"ops_per_sec": 1000})  # 1 ms/op
+    now = result(calculate_trust_score={"ops_per_sec": 800})
+    assert [r.split(":")[0] for r in compare(base, now, 0.15)] == ["calculate_trust_score"]
+
+
+def test_measured_noise_widens_the_slack():
+    slack = TIME_SLACK_NS + 2_000
+    base = result(s={"ops_per_sec": 100_000, "ns_noise": slack})  # 10 µs/op，本机中位数比最好轮慢 2.25 µs
+    now = result(s={"ops_per_sec": 100_000 / 1.3})               # 13 µs/op
+    assert compare(base, now, 0.15) == []
+    assert compare(result(s={"ops_per_sec": 100_000}), now, 0.15)
+
+
+def test_allocation_growth_is_reported_and_old_results_still_compare():
+    base = {"stages": {"s": {"ops_per_sec": 1000, "alloc_peak_bytes": 10_000}}}  # 旧版结果：无 ns 字段
+    now = {"stages": {"s": {"ops_per_sec": 1000, "alloc_peak_bytes": 11_500 + ALLOC_SLACK_BYTES + 1}}}
+    assert [r.split(":")[0] for r in compare(base, now, 0.15)] == ["s"]
@@ -0,0 +1,130 @@
+"""决策归档：CSV（9 列 / 6 列混写）→ .zta → 汇总往返，残块在读取时忽略、追加前截掉，
+多文件各自的字典合并后汇总，summary CLI 写出报表"""
+import csv
+
+import numpy as np
+import pytest
+
+from decision_archive import (CHUNK_HEADER, CHUNK_MAGIC, MISSING_LATENCY, MISSING_SCORE, RUN_ALL_CSV_COLUMNS,
+                              ArchiveReader, ArchiveWriter, Summary, convert, main)
+
+RUN_ALL_ROWS = [
+    ["2025-09-05T19:00:00", "normal", "alice", "85", "/reports", "allow", "low_risk", "1.5", "200"],
+    ["2025-09-05T19:00:01", "attack", "mallory", "20", "/admin/users", "deny", "very_high_risk", "3.25", "403"],
+    ["2025-09-05T19:00:02", "normal", "bob", "65", "/reports", "allow_restricted", "mid_risk_readonly", "2", "200"],
+]
+GATEWAY_ROWS = [  # 网关写的 6 列行：无 group / latency / status
+    ["2025-09-05T19:00:03", "alice", "45", "/admin", "require_mfa", "high_risk_stepup"],
+    ["2025-09-05T19:00:04", "carol", "90", "/", "allow", "low_risk"],
+]
+
+
+def write_csv(path, rows, header=RUN_ALL_CSV_COLUMNS):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
+    return str(path)
+
+
+def labels(reader, name):
+    return [reader.dicts[name][c] for c in reader.column(name).tolist()]
+
+
+def test_round_trip_mixed_columns(tmp_path):
+    src = write_csv(tmp_path / "decisions.csv", RUN_ALL_ROWS + GATEWAY_ROWS + [["bad", "row"], [""] * 9])
+    archive = str(tmp_path / "decisions.zta")
+    assert convert([src], archive, chunk_rows=2) == 5
+
+    with ArchiveReader(archive) as r:
+        assert r.rows == 5 and len(r.chunks) == 3
+        assert labels(r, "user") == ["alice", "mallory", "bob", "alice", "carol"]
+        assert labels(r, "group") == ["normal", "attack", "normal", "", ""]
+        assert labels(r, "status") == ["200", "403", "200", "", ""]
+        assert r.column("trust_score").tolist() == [85, 20, 65, 45, 90]
+        assert r.column("latency_us").tolist() == [1500, 3250, 2000, MISSING_LATENCY, MISSING_LATENCY]
+        ts = r.column("ts_ms")
+        assert (np.diff(ts) == 1000).all()
+        assert ts[0] == np.datetime64("2025-09-05T19:00:00", "ms").astype(np.int64)
+        assert len(r.dicts["user"]) == 4  # 字典增量跨块累积，不重复登记
+
+        s = Summary([r])
+    assert s.total == 5
+    assert s.counts_by("action", "reason")[0] == ("allow", "low_risk", 2)
+    assert s.top("user", 1) == [("alice", 2)]
+    hist, missing = s.score_histogram(10)
+    assert missing == 0 and sum(c for _, _, c in hist) == 5 and hist[2] == (20, 29, 1)
+    latency = dict(s.latency_by_group())
+    assert latency["ALL"]["count"] == 3 and latency["attack"]["max"] == 3.25
+    assert latency["normal"] == {"count": 2, "p50": 1.5, "p90": 2.0, "p99": 2.0, "p999": 2.0, "max": 2.0}
+
+
+def test_gateway_only_csv_keeps_missing_values(tmp_path):
+    src = write_csv(tmp_path / "gw.csv", GATEWAY_ROWS + [["2025-09-05T19:00:05", "dave", "", "/", "deny", "x"]],
+                    header=["ts", "user_id", "trust_score", "resource", "action", "reason"])
+    archive = str(tmp_path / "gw.zta")
+    assert convert([src], archive) == 3
+    with ArchiveReader(archive) as r:
+        assert r.column("trust_score").tolist() == [45, 90, MISSING_SCORE]
+        s = Summary([r])
+    assert s.score_histogram()[1] == 1
+    assert s.latency_by_group() == []
+
+
+def test_partial_tail_ignored_then_truncated_on_append(tmp_path):
+    archive = str(tmp_path / "decisions.zta")
+    with ArchiveWriter(archive, chunk_rows=2) as w:
+        w.writerows(RUN_ALL_ROWS)
+    with ArchiveReader(archive) as r:
+        good_end = r.end
+    with open(archive, "ab") as f:  # 写到一半崩溃：块头说有 4096 字节块体，实际只写了一点
+        f.write(CHUNK_HEADER.pack(CHUNK_MAGIC, 100, 0, 4096) + b"\x01" * 50)
+
+    with ArchiveReader(archive) as r:
+        assert (r.rows, r.end) == (3, good_end)
+
+    with ArchiveWriter(archive) as w:
+        assert w.tell() == good_end
+        w.writerow(["2025-09-05T19:00:09", "normal", "dave", "70", "/reports", "allow_restricted",
+                    "mid_risk_readonly", "1", "200"])
+    with ArchiveReader(archive) as r:
+        assert r.rows == 4 and len(r.chunks) == 3
+        assert labels(r, "user") == ["alice", "mallory", "bob", "dave"]
+        assert labels(r, "resource")[-1] == "/reports"  # 已有字典值沿用旧编码
+        assert r.dicts["resource"].count("/reports") == 1
+
+
+def test_multi_file_summary_merges_dictionaries(tmp_path):
+    a, b = str(tmp_path / "decisions.0.zta"), str(tmp_path / "decisions.1.zta")
+    convert([write_csv(tmp_path / "a.csv", RUN_ALL_ROWS)], a)
+    convert([write_csv(tmp_path / "b.csv", [RUN_ALL_ROWS[2], RUN_ALL_ROWS[1], RUN_ALL_ROWS[1]])], b)
+    with ArchiveReader(a) as ra, ArchiveReader(b) as rb:
+        assert ra.dicts["user"] != rb.dicts["user"]  # 两个文件的编码各不相同
+        s = Summary([ra, rb])
+        window = Summary([ra, rb], since_ms=int(ra.column("ts_ms")[1]), until_ms=int(ra.column("ts_ms")[2]))
+    assert s.total == 6
+    assert dict(s.top("user")) == {"mallory": 3, "bob": 2, "alice": 1}
+    assert sorted(s.counts_by("group", "status")) == [("attack", "403", 3), ("normal", "200", 3)]
+    assert window.total == 3 and window.top("user") == [("mallory", 3)]
+
+
+def test_summary_cli_writes_reports(tmp_path, capsys):
+    archive = str(tmp_path / "decisions.zta")
+    assert main(["convert", write_csv(tmp_path / "d.csv", RUN_ALL_ROWS), archive]) == 0
+    out_dir = tmp_path / "report"
+    assert main(["summary", archive, "--top", "2", "--out-dir", str(out_dir)]) == 0
+    assert "汇总 3 行" in capsys.readouterr().out
+    with open(out_dir / "summary.csv", newline="", encoding="utf-8") as f:
+        assert list(csv.reader(f)) == [["group", "http_status", "count"], ["attack", "403", "1"],
+                                       ["normal", "200", "2"]]
+    assert {p.name for p in out_dir.iterdir()} == {"summary.csv", "latency.csv", "decisions_by_reason.csv",
+                                                   "top_reasons.csv", "score_histogram.csv"}
+
+
+def test_rejects_non_archive(tmp_path):
+    path = tmp_path / "decisions.csv"
+    path.write_text("ts,user_id\n", encoding="utf-8")
+    with pytest.raises(ValueError):
+        ArchiveReader(str(path))
+    with pytest.raises(ValueError):
+        ArchiveWriter(str(tmp_path / "x.zta"), fields=["ts", "nope"])
@@ -0,0 +1,129 @@
+"""决策缓存：命中条件、失效（IP / 设备变化、主动失效、TTL、token exp）、不可缓存的信号；命中也写访问日志流，
+敏感资源不查缓存，状态存储不可用时放弃命中改走完整评分"""
+import time
+
+import pytest
+
+import app as gw
+from decision_cache import DecisionCache, merge_flags
+from resilience import StateUnavailable
+from scoring import FLAG_HIGH_FREQUENCY, FLAG_IP_CHANGE, FLAG_OFF_HOURS, FLAG_SENSITIVE
+
+RULE = ("/", "/")
+
+
+@pytest.fixture
+def cache():
+    return DecisionCache(max_users=10, ttl=2.0)
+
+
+def test_hit_requires_same_device_and_ip(cache):
+    assert cache.put("alice", "fp1", "10.0.0.1", RULE, [], now=100.0)
+    assert cache.get("alice", "fp1", "10.0.0.1", RULE, now=101.0) == ()
+    assert cache.get("alice", "fp2", "10.0.0.1", RULE, now=101.0) is None
+    assert cache.get("alice", "fp1", "10.0.0.2", RULE, now=101.0) is None
+    assert cache.get("alice", "fp1", "10.0.0.1", ("/admin", "/admin"), now=101.0) is None
+    assert (cache.hits, cache.misses) == (1, 3)
+
+
+def test_invalidation_and_expiry(cache):
+    cache.put("alice", "fp1", "10.0.0.1", RULE, [], now=100.0)
+    cache.invalidate("alice")
+    assert cache.get("alice", "fp1", "10.0.0.1", RULE, now=100.5) is None
+
+    cache.put("alice", "fp1", "10.0.0.1", RULE, [], now=100.0)
+    assert cache.get("alice", "fp1", "10.0.0.1", RULE, now=102.0) is None  # ttl 到期
+
+    cache.put("alice", "fp1", "10.0.0.1", RULE, [], token_exp=100.5, now=100.0)
+    assert cache.get("alice", "fp1", "10.0.0.1", RULE, now=100.6) is None  # 不超过 token exp
+    assert not cache.put("alice", "fp1", "10.0.0.1", RULE, [], token_exp=99.0, now=100.0)
+
+
+def test_uncacheable_result_drops_user_entry(cache):
+    cache.put("alice", "fp1", "10.0.0.1", RULE, [], now=100.0)
+    assert not cache.put("alice", "fp1", "10.0.0.1", RULE, [FLAG_IP_CHANGE], now=100.1)
+    assert cache.get("alice", "fp1", "10.0.0.1", RULE, now=100.2) is None
+    assert len(cache) == 1
+    assert not cache.put("bob", "fp1", "10.0.0.9", RULE, [FLAG_IP_CHANGE], now=100.0)
+    assert not cache.put("bob", "fp1", "10.0.0.9", RULE, [FLAG_SENSITIVE], now=100.0)
+    assert len(cache) == 1
+
+
+def test_volatile_flags_are_recomputed(cache):
+    cache.put("alice", "fp1", "10.0.0.1", RULE, [FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY], now=100.0)
+    cached = cache.get("alice", "fp1", "10.0.0.1", RULE, now=100.1)
+    assert cached == ()
+    assert merge_flags(cached, [FLAG_HIGH_FREQUENCY, FLAG_OFF_HOURS]) == [FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY]
+
+
+def test_lru_bound():
+    cache = DecisionCache(max_users=2, ttl=2.0)
+    for user in ("a", "b", "c"):
+        cache.put(user, "fp", "10.0.0.1", RULE, [], now=100.0)
+    assert len(cache) == 2
+    assert cache.get("a", "fp", "10.0.0.1", RULE, now=100.1) is None
+
+
+def test_gateway_cache_hits_still_reach_access_stream(client):
+    """命中缓存跳过完整评分，但每个请求仍在 access_stream 里有一条记录（后台攒批写入）"""
+    gateway = gw.ZeroTrustGateway(client=client, decision_cache=DecisionCache(100, 60.0))
+    ctx = {"ip": "10.0.0.1", "user_agent": "ua", "resource": "/reports"}
+    exp = time.time() + 3600
+    results = [gateway.decide("alice", ctx, exp) for _ in range(10)]
+    gateway.hit_log.close()
+
+    assert gateway.decision_cache.hits == 8  # 第一次是未知设备（不缓存），第二次回源后写入
+    assert len({score for score, _, _ in results[1:]}) == 1
+    assert client.xlen("access_stream") == 10
+
+    gateway.decision_cache.invalidate("alice")
+    gateway.decide("alice", dict(ctx, ip="10.0.0.2"), exp)
+    assert gateway.decision_cache.get("alice", gw.device_fingerprint(ctx), "10.0.0.2", ("/", "/")) is None
+
+
+
+def counting_score_logged(monkeypatch, gateway):
+    calls = []
+    score_logged = gateway.backend.score_logged
+
+    def counting(*args, **kwargs):
+        calls.append(args[0])
+        return score_logged(*args, **kwargs)
+    monkeypatch.setattr(gateway.backend, "score_logged", counting)
+    return calls
+
+
+def test_gateway_sensitive_resources_bypass_cache(client, monkeypatch):
+    cache = DecisionCache(100, 60.0)
+    gateway = gw.ZeroTrustGateway(client=client, decision_cache=cache)
+    assert gateway.decision_cache is cache  # 空缓存也是显式传入的缓存
+    calls = counting_score_logged(monkeypatch, gateway)
+    ctx = {"ip": "10.0.0.1", "user_agent": "ua", "resource": "/admin/users",
+           "sensitive_operation": gateway.policies.current().is_sensitive("/admin/users")}  # 路由里这样填
+    exp = time.time() + 3600
+    for _ in range(4):
+        _, flags, _ = gateway.decide("alice", ctx, exp)
+    gateway.hit_log.close()
+
+    assert "sensitive_operation" in flags
+    assert len(calls) == 4 and len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_gateway_falls_back_when_state_unavailable(client, monkeypatch):
+    cache = DecisionCache(100, 60.0)
+    gateway = gw.ZeroTrustGateway(client=client, decision_cache=cache)
+    ctx = {"ip": "10.0.0.1", "user_agent": "ua", "resource": "/reports"}
+    exp = time.time() + 3600
+    for _ in range(3):
+        expected = gateway.decide("alice", ctx, exp)
+    assert cache.hits == 1
+
+    def unavailable(*args, **kwargs):
+        raise StateUnavailable("down")
+    monkeypatch.setattr(gateway.backend, "count_hit", unavailable)
+    calls = counting_score_logged(monkeypatch, gateway)
+    assert gateway.decide("alice", ctx, exp)[:2] == expected[:2]
+    gateway.hit_log.close()
+    assert calls == ["alice"]  # 命中作废，回源完整评分后重新写入
+    assert cache.get("alice", gw.device_fingerprint(ctx), "10.0.0.1", ("/", "/")) == ()
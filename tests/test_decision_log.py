@@ -0,0 +1,140 @@
+"""决策日志后台写入器：队列上限（wait / drop）、轮转、close() 有界刷盘、每进程文件、写盘失败计入丢弃"""
+import csv
+import glob
+import os
+import threading
+import time
+
+import pytest
+from prometheus_client import REGISTRY
+
+from decision_log import DecisionLogWriter, process_path
+
+HEADER = ["ts", "user_id", "trust_score"]
+
+
+def rows_in(paths):
+    out = []
+    for path in paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            assert next(reader) == HEADER
+            out.extend(reader)
+    return out
+
+
+def stall(writer, monkeypatch):
+    """让后台线程卡在第一批写盘上，队列只进不出；返回放行用的 Event"""
+    release, entered = threading.Event(), threading.Event()
+    write = writer._write_batch
+
+    def blocked(rows):
+        entered.set()
+        release.wait(5)
+        write(rows)
+    monkeypatch.setattr(writer, "_write_batch", blocked)
+    writer.entered = entered
+    return release
+
+
+def fill(writer, n):
+    writer.submit(["r0"])
+    assert writer.entered.wait(2)  # 第一行已被后台线程取走并卡住
+    writer.submit_many([[f"r{i}"] for i in range(1, n + 1)])
+
+
+def test_all_rows_written_on_close(tmp_path):
+    path = str(tmp_path / "d.csv")
+    writer = DecisionLogWriter(path, HEADER, batch_size=7, flush_interval=0.01)
+    writer.submit_many([["t", f"u{i}", i] for i in range(100)])
+    writer.close()
+    assert [r[1] for r in rows_in([path])] == [f"u{i}" for i in range(100)]
+    assert writer.dropped == 0
+
+
+def test_drop_overflow_does_not_wait(tmp_path, monkeypatch):
+    writer = DecisionLogWriter(str(tmp_path / "d.csv"), HEADER, max_queue=5, batch_size=1, overflow="drop")
+    release = stall(writer, monkeypatch)
+    started = time.monotonic()
+    fill(writer, 8)
+    assert time.monotonic() - started < 0.5
+    assert writer.dropped == 3
+    release.set()
+    writer.close()
+    assert len(rows_in([writer.path])) == 6
+
+
+def test_wait_overflow_waits_bounded_then_drops(tmp_path, monkeypatch):
+    writer = DecisionLogWriter(str(tmp_path / "d.csv"), HEADER, max_queue=5, batch_size=1,
+                               overflow="wait", wait_timeout=0.05)
+    release = stall(writer, monkeypatch)
+    fill(writer, 5)
+    started = time.monotonic()
+    writer.submit(["late"])
+    assert 0.04 <= time.monotonic() - started < 1.0
+    started = time.monotonic()
+    writer.submit(["loop"], wait=False)  # 事件循环里：不等待
+    assert time.monotonic() - started < 0.04
+    assert writer.dropped == 2
+    release.set()
+    writer.close()
+
+
+def test_block_is_an_alias_for_wait(tmp_path):
+    assert DecisionLogWriter(str(tmp_path / "d.csv"), HEADER, overflow="block").overflow == "wait"
+    with pytest.raises(ValueError):
+        DecisionLogWriter(str(tmp_path / "d.csv"), HEADER, overflow="forever")
+
+
+def test_close_is_bounded_when_writer_is_stuck(tmp_path, monkeypatch):
+    writer = DecisionLogWriter(str(tmp_path / "d.csv"), HEADER, max_queue=5, batch_size=1)
+    release = stall(writer, monkeypatch)
+    fill(writer, 5)
+    started = time.monotonic()
+    writer.close(timeout=0.2)
+    assert time.monotonic() - started < 1.0
+    release.set()
+
+
+def test_rotation_by_size(tmp_path):
+    path = str(tmp_path / "d.csv")
+    writer = DecisionLogWriter(path, HEADER, batch_size=1, flush_interval=0.01, rotate_bytes=40)
+    for i in range(12):
+        writer.submit(["2025-01-01T00:00:00", f"user{i}", 90])
+        time.sleep(0.02)
+    writer.close()
+    rotated = sorted(glob.glob(path + ".*"))
+    assert rotated
+    assert sorted(r[1] for r in rows_in(rotated + [path])) == sorted(f"user{i}" for i in range(12))
+
+
+def test_per_process_path(tmp_path):
+    assert process_path("out/decisions.csv", 123) == os.path.join("out", "decisions.123.csv")
+    assert process_path("out/decisions.zta", 7) == os.path.join("out", "decisions.7.zta")
+
+    base = str(tmp_path / "d.csv")
+    writer = DecisionLogWriter(base, HEADER, flush_interval=0.01, per_process=True)
+    writer.submit(["parent"])
+    pid = os.fork()
+    if pid == 0:  # 子进程：首次写入换成自己的文件和线程
+        writer.submit(["child"])
+        writer.close()
+        os._exit(0)
+    os.waitpid(pid, 0)
+    writer.close()
+    assert rows_in([process_path(base)]) == [["parent"]]
+    assert rows_in([process_path(base, pid)]) == [["child"]]
+    assert not os.path.exists(base)
+
+
+def test_write_errors_count_as_dropped(tmp_path):
+    path = tmp_path / "d.csv"
+    path.mkdir()  # 打不开文件：整批丢弃并计数
+    before = REGISTRY.get_sample_value("zt_csv_rows_dropped_total") or 0
+    errors = REGISTRY.get_sample_value("zt_csv_write_errors_total") or 0
+    writer = DecisionLogWriter(str(path), HEADER, flush_interval=0.01)
+    writer.submit_many([["a"], ["b"], ["c"]])
+    writer.close()
+    assert writer.dropped == 3
+    assert REGISTRY.get_sample_value("zt_csv_rows_dropped_total") == before + 3
+    assert REGISTRY.get_sample_value("zt_csv_write_errors_total") > errors
@@ -0,0 +1,107 @@
+"""设备记忆：截断指纹，按最近使用淘汰（单条 / 同批多台新设备），ttl 老化，旧版 SET 视为已知并迁出；
+memory / 脚本 / 逐条调用三种实现一致"""
+import fakeredis
+import pytest
+
+from conftest import T0
+from device_memory import DevicePolicy, compact_fingerprint, memory_device_seen
+from rate_limit import parse_rate_limits
+from scoring import FLAG_UNKNOWN_DEVICE
+from state_backend import MemoryStateBackend, RedisStateBackend, ScoreSignals
+
+RULES = parse_rate_limits("/=1000/60")
+CAPPED = DevicePolicy(max_devices=3, ttl_ms=0, fp_bytes=8)
+AGING = DevicePolicy(max_devices=0, ttl_ms=10_000, fp_bytes=8)
+FINGERPRINTS = [("%02x" % k) * 32 for k in range(6)]  # 前 fp_bytes 字节互不相同
+SIGNALS = ScoreSignals("10.0.0.1", FINGERPRINTS[0], False, False, "/", 12)
+
+
+def make_backend(mode, policy, client=None):
+    if mode == "memory":
+        return MemoryStateBackend("sliding_window", RULES, device_policy=policy)
+    client = client or fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    return RedisStateBackend(client, mode, "sliding_window", RULES, device_policy=policy)
+
+
+def unknown(backend, fp, now):
+    _, flags = backend.score("alice", SIGNALS._replace(fingerprint=fp), now)
+    return FLAG_UNKNOWN_DEVICE in flags
+
+
+def test_compact_fingerprint():
+    fp = "ab" * 32
+    assert compact_fingerprint(fp) == b"\xab" * 8
+    assert compact_fingerprint(fp, 4) == b"\xab" * 4
+    assert compact_fingerprint("0123456789abcdef" * 4, 2) == b"\x01\x23"
+
+
+def test_memory_device_seen_cap_and_ttl():
+    devices = {}
+    policy = DevicePolicy(max_devices=2, ttl_ms=1000, fp_bytes=8)
+    assert memory_device_seen(devices, b"a", T0, policy) == (False, 1, 0, 0)
+    assert memory_device_seen(devices, b"b", T0 + 100, policy) == (False, 2, 0, 0)
+    assert memory_device_seen(devices, b"a", T0 + 200, policy) == (True, 2, 0, 0)  # 刷新 a 的时间
+    assert memory_device_seen(devices, b"c", T0 + 300, policy) == (False, 2, 1, 0)  # 挤掉最久未见的 b
+    assert set(devices) == {b"a", b"c"}
+    # 恰好 ttl 前出现的也算过期（与 ZREMRANGEBYSCORE -inf now-ttl 相同）
+    assert memory_device_seen(devices, b"c", T0 + 1200, policy) == (True, 1, 0, 1)
+    assert devices == {b"c": T0 + 1200}
+
+
+def test_memory_device_seen_ties_break_on_member():
+    devices = {b"b": T0, b"a": T0}
+    memory_device_seen(devices, b"c", T0 + 1, DevicePolicy(max_devices=2, ttl_ms=0, fp_bytes=8))
+    assert set(devices) == {b"b", b"c"}
+
+
+@pytest.mark.parametrize("mode", ["memory", "script", "calls"])
+def test_device_cap_evicts_least_recent(mode):
+    backend = make_backend(mode, CAPPED)
+    now = T0
+    seen = []
+    for fp in FINGERPRINTS[:4] + [FINGERPRINTS[0]]:  # 上限 3：第 4 台挤掉最久未见的第 1 台
+        now += 1000
+        seen.append(unknown(backend, fp, now))
+    assert seen == [True, True, True, True, True]
+    assert not unknown(backend, FINGERPRINTS[3], now + 1000)
+
+
+@pytest.mark.parametrize("mode", ["memory", "script", "calls"])
+def test_batch_of_new_devices_respects_cap(mode):
+    backend = make_backend(mode, CAPPED)
+    batch = [SIGNALS._replace(fingerprint=fp) for fp in FINGERPRINTS[:5]]
+    results = backend.score_many("alice", batch, T0)
+    assert [FLAG_UNKNOWN_DEVICE in flags for _, flags in results] == [True] * 5
+    # 同批后面的设备挤掉了前面的：只剩最后 3 台
+    assert [unknown(backend, fp, T0 + 1000) for fp in FINGERPRINTS[2:5]] == [False, False, False]
+    assert unknown(backend, FINGERPRINTS[0], T0 + 2000)
+
+
+@pytest.mark.parametrize("mode", ["memory", "script", "calls"])
+def test_devices_age_out_after_ttl(mode):
+    backend = make_backend(mode, AGING)
+    assert unknown(backend, FINGERPRINTS[0], T0)
+    assert not unknown(backend, FINGERPRINTS[0], T0 + 9_000)  # 出现即刷新
+    assert not unknown(backend, FINGERPRINTS[0], T0 + 18_000)
+    assert unknown(backend, FINGERPRINTS[0], T0 + 28_000)
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_redis_members_are_truncated_and_expire(client, mode):
+    backend = make_backend(mode, AGING, client)
+    backend.score("alice", SIGNALS, T0)
+    key = backend.key("alice", "device_seen")
+    raw = fakeredis.FakeRedis(server=client.connection_pool.connection_kwargs["server"])
+    assert raw.zrange(key, 0, -1, withscores=True) == [(compact_fingerprint(FINGERPRINTS[0]), float(T0))]
+    assert 0 < client.pttl(key) <= AGING.ttl_ms
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_legacy_device_set_counts_as_known(client, mode):
+    backend = make_backend(mode, CAPPED, client)
+    legacy = backend.key("alice", "devices")
+    client.sadd(legacy, FINGERPRINTS[1], FINGERPRINTS[2])
+    assert not unknown(backend, FINGERPRINTS[1], T0)
+    assert client.smembers(legacy) == {FINGERPRINTS[2]}  # 用到的迁出旧集合
+    assert not unknown(backend, FINGERPRINTS[1], T0 + 1000)
+    assert unknown(backend, FINGERPRINTS[3], T0 + 2000)
@@ -0,0 +1,105 @@
+"""L1 本地缓存：LRU + TTL 淘汰、设备数上限；一个实例发布的失效消息清掉另一个实例的本地条目"""
+import time
+
+import pytest
+
+import l1_cache
+from conftest import T0
+from l1_cache import InvalidationSubscriber, LocalRiskCache, invalidation_message
+from state_backend import RedisStateBackend, ScoreSignals
+
+CHANNEL = "zt:l1:test"
+FP = "ab" * 32
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(l1_cache.time, "monotonic", c)
+    return c
+
+
+def test_lru_evicts_least_recently_used(clock):
+    cache = LocalRiskCache(max_entries=2, ttl=30)
+    cache.remember("a", last_ip="10.0.0.1")
+    cache.remember("b", last_ip="10.0.0.2")
+    assert cache.get_last_ip("a") == (True, "10.0.0.1")  # a 变为最近使用
+    cache.remember("c", last_ip="10.0.0.3")
+    assert len(cache) == 2
+    assert cache.get_last_ip("b") == (False, None)
+    assert cache.get_last_ip("a") == (True, "10.0.0.1")
+
+
+def test_ttl_expires_entries(clock):
+    cache = LocalRiskCache(ttl=30)
+    cache.remember("a", last_ip="10.0.0.1", devices=["fp1"])
+    clock.now += 29.9
+    assert cache.is_known_device("a", "fp1")
+    clock.now += 0.2
+    assert not cache.is_known_device("a", "fp1")
+    assert cache.get_last_ip("a") == (False, None)
+    assert len(cache) == 0
+
+
+def test_device_limit_and_negative_answers(clock):
+    cache = LocalRiskCache(max_devices=2)
+    cache.remember("a", devices=["fp1", "fp2", "fp3"])
+    assert [cache.is_known_device("a", fp) for fp in ("fp1", "fp2", "fp3")] == [True, True, False]
+    assert not cache.is_known_device("nobody", "fp1")
+
+
+def test_own_messages_are_ignored(clock):
+    cache = LocalRiskCache()
+    cache.remember("a", last_ip="10.0.0.1")
+    cache.handle_message(invalidation_message(cache.instance_id, "a"))
+    assert len(cache) == 1
+    cache.handle_message(invalidation_message("other", "a"))
+    assert len(cache) == 0
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def calls_backend(client):
+    l1 = LocalRiskCache(ttl=60)
+    subscriber = InvalidationSubscriber(client, l1, CHANNEL, reconnect_delay=0.05)
+    return RedisStateBackend(client, "calls", l1=l1, subscriber=subscriber, l1_channel=CHANNEL)
+
+
+@pytest.mark.parametrize("publisher_mode", ["calls", "script"])
+def test_invalidation_crosses_instances(make_client, publisher_mode):
+    a = calls_backend(make_client())
+    if publisher_mode == "calls":
+        b = calls_backend(make_client())
+    else:  # 脚本模式实例没有 L1，只在脚本内 PUBLISH
+        b = RedisStateBackend(make_client(), "script", l1_channel=CHANNEL)
+    client = make_client()
+    try:
+        a.score("alice", ScoreSignals("10.0.0.1", FP, False, False, "/", 12), T0)
+        assert wait_for(lambda: client.pubsub_numsub(CHANNEL)[0][1] >= 1)
+        assert a.l1.get_last_ip("alice") == (True, "10.0.0.1")
+
+        b.score("alice", ScoreSignals("10.0.0.2", FP, False, False, "/", 12), T0 + 1)
+        assert wait_for(lambda: len(a.l1) == 0)
+
+        # a 回源读到 b 写下的 last_ip：IP 未变，不再误判 ip_change
+        _, flags = a.score("alice", ScoreSignals("10.0.0.2", FP, False, False, "/", 12), T0 + 2)
+        assert "ip_change" not in flags
+    finally:
+        for backend in (a, b):
+            if backend._l1_subscriber is not None:
+                backend._l1_subscriber.stop()
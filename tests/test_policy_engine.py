@@ -0,0 +1,128 @@
+"""策略引擎：最长前缀匹配，编译后的决策与原硬编码一致、子前缀继承，mtime 热加载（失败保留旧表），
+文件缺失时回落到内置默认"""
+import json
+import os
+
+import pytest
+
+from policy_engine import (DEFAULT_POLICY_FILE, DEGRADED_DENY, PolicyEngine, PrefixTrie, builtin_document,
+                           compile_policy, load_document)
+from scoring import select_policy
+
+
+def test_trie_longest_prefix():
+    trie = PrefixTrie()
+    for prefix in ("/", "/admin", "/admin/health", "/api/v1"):
+        trie.insert(prefix, prefix)
+    trie.insert("/admin", "/admin")  # 重复登记不重复计数
+    assert trie.size == 4
+    assert trie.longest("/admin/health/deep") == "/admin/health"
+    assert trie.longest("/administrator") == "/admin"  # 与 str.startswith 同义
+    assert trie.longest("/api/v2") == "/"
+    assert trie.longest("/api/v1/x") == "/api/v1"
+    assert PrefixTrie().longest("/x", "fallback") == "fallback"
+
+
+@pytest.mark.parametrize("score", [100, 80, 79, 60, 59, 40, 39, 0])
+def test_builtin_matches_select_policy(score):
+    compiled = compile_policy(builtin_document())
+    for resource in ("/", "/reports", "/admin/users"):
+        decision = dict(compiled.decide(resource, score))
+        if decision["restrictions"] is not None:
+            decision["restrictions"] = list(decision["restrictions"])
+        assert decision == select_policy(score), (resource, score)
+    assert compiled.is_sensitive("/admin/users") and not compiled.is_sensitive("/reports")
+    assert compiled.decide("/admin", 90, degraded=True) is DEGRADED_DENY
+    assert compiled.decide("/reports", 90, degraded=True)["action"] == "allow"
+
+
+def test_routes_inherit_and_decisions_are_frozen():
+    compiled = compile_policy({
+        "defaults": {"thresholds": [85, 65, 45]},
+        "routes": [
+            {"prefix": "/finance/audit", "tiers": {"allow": {"monitoring_level": "enhanced"}}},
+            {"prefix": "/finance", "thresholds": [90, 70, 50], "sensitive": True},
+        ],
+    })
+    assert compiled.route_count == 2
+    assert compiled.decide("/reports", 84)["action"] == "allow_restricted"
+    audit = compiled.match("/finance/audit/2024")
+    assert audit.prefix == "/finance/audit" and audit.thresholds == (90, 70, 50) and audit.sensitive
+    allow = audit.decide(95)
+    assert (allow["action"], allow["monitoring_level"], allow["reason"]) == ("allow", "enhanced", "low_risk")
+    assert audit.decide(95) is allow  # 预编译：每次取同一个对象
+    with pytest.raises(TypeError):
+        allow["action"] = "deny"
+    assert compiled.decide("/finance", 85)["action"] == "allow_restricted"
+
+
+@pytest.mark.parametrize("doc", [
+    {"defaults": {"thresholds": [40, 60, 80]}},
+    {"routes": [{"prefix": "admin"}]},
+    {"routes": [{"prefix": "/a"}, {"prefix": "/a"}]},
+    {"routes": [{"prefix": "/a", "on_degraded": "maybe"}]},
+    {"routes": [{"prefix": "/a", "tiers": {"block": {}}}]},
+    {"routes": [{"prefix": "/a", "weight": 1}]},
+])
+def test_compile_rejects_bad_documents(doc):
+    with pytest.raises(ValueError):
+        compile_policy(doc)
+
+
+def test_shipped_policy_file_equals_builtin():
+    shipped = compile_policy(load_document(DEFAULT_POLICY_FILE))
+    builtin = compile_policy(builtin_document())
+    for resource in ("/", "/admin", "/administrator", "/reports"):
+        assert shipped.match(resource)[1:] == builtin.match(resource)[1:], resource
+
+
+def write_policy(path, doc, mtime_ns):
+    path.write_text(json.dumps(doc), encoding="utf-8")
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_hot_reload_on_mtime_change(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("policy_engine.time.monotonic", lambda: clock[0])
+    path = tmp_path / "policies.json"
+    write_policy(path, {"routes": [{"prefix": "/a", "thresholds": [90, 70, 50]}]}, 1_000_000_000)
+    engine = PolicyEngine(str(path), reload_interval=5)
+    first = engine.current()
+    assert first.version == "1000000000" and first.decide("/a", 85)["action"] == "allow_restricted"
+
+    write_policy(path, {"routes": [{"prefix": "/a", "thresholds": [80, 60, 40]}]}, 2_000_000_000)
+    assert engine.current() is first  # 还没到轮询间隔
+    clock[0] += 5
+    second = engine.current()
+    assert second is not first and second.decide("/a", 85)["action"] == "allow"
+
+    clock[0] += 5
+    assert engine.current() is second  # mtime 未变：不重新编译
+
+    write_policy(path, {"routes": [{"prefix": "/a", "thresholds": [1, 2, 3]}]}, 3_000_000_000)
+    clock[0] += 5
+    assert engine.current() is second  # 编译失败保留旧表
+    assert engine.status()["last_error"].startswith("ValueError")
+    assert engine.status()["version"] == "2000000000"
+
+    write_policy(path, {}, 4_000_000_000)
+    clock[0] += 5
+    assert engine.current().version == "4000000000" and engine.last_error is None
+
+
+def test_missing_file_falls_back_to_builtin(tmp_path, capsys):
+    path = tmp_path / "absent.yaml"
+    engine = PolicyEngine(str(path), reload_interval=0)
+    assert "不存在" in capsys.readouterr().out
+    compiled = engine.current()
+    assert compiled.version == "builtin" and compiled.is_sensitive("/admin")
+    assert engine.status() == {"version": "builtin", "source": None, "routes": 1, "last_error": None}
+
+    write_policy(path, {"routes": [{"prefix": "/ops", "sensitive": True}]}, 1_000_000_000)
+    assert engine.reload()  # 文件出现后换上新表
+    assert engine.current().is_sensitive("/ops") and not engine.current().is_sensitive("/admin")
+
+    path.unlink()
+    assert engine.reload()  # 文件被删：回到内置默认，并再次提示
+    assert engine.current().version == "builtin"
+    assert "不存在" in capsys.readouterr().out
@@ -0,0 +1,72 @@
+"""频率估计：GCRA / 滑动窗口的 Redis 实现（Lua）与进程内 memory_rate_hit 逐次一致；只读估计不计数"""
+import random
+
+import pytest
+
+from conftest import T0
+from rate_limit import RateLimiter, RateRule, memory_rate_hit, memory_rate_peek, parse_rate_limits
+
+
+def test_parse_rate_limits_orders_longest_prefix_first():
+    rules = parse_rate_limits("/=30/60,/admin=10/60")
+    assert rules == [RateRule("/admin", 10, 60), RateRule("/", 30, 60)]
+    assert parse_rate_limits("/admin=5/10")[-1] == RateRule("/", 30, 60)
+
+
+def test_rule_for_longest_prefix(client):
+    limiter = RateLimiter(client, "sliding_window", parse_rate_limits("/admin=10/60,/admin/audit=2/60"))
+    assert limiter.rule_for("/admin/audit/x").prefix == "/admin/audit"
+    assert limiter.rule_for("/admin/users").prefix == "/admin"
+    assert limiter.rule_for("/reports").prefix == "/"
+    assert limiter.rule_for(None).prefix == "/"
+    with pytest.raises(ValueError):
+        RateLimiter(client, "token_bucket")
+
+
+def test_sliding_window_weights_previous_bucket(client):
+    limiter = RateLimiter(client, "sliding_window", parse_rate_limits("/=4/60"))
+    limiter.hit_many("alice", ["/"] * 4, T0 - T0 % 60000)
+    # 下一个窗口过了一半：上一桶按 50% 计入
+    assert limiter.hit("alice", "/", T0 - T0 % 60000 + 90000) == (False, 3)
+
+
+def test_gcra_admits_burst_then_one_per_interval(client):
+    limiter = RateLimiter(client, "gcra", parse_rate_limits("/=3/60"))
+    assert [limiter.hit("alice", "/", T0)[0] for _ in range(4)] == [False, False, False, True]
+    assert limiter.hit("alice", "/", T0 + 19_999)[0]     # 间隔 60s/3 = 20s
+    assert not limiter.hit("alice", "/", T0 + 20_000)[0]
+    assert limiter.hit("alice", "/", T0 + 20_000)[0]
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+def test_redis_matches_memory(client, algorithm):
+    rules = parse_rate_limits("/admin=3/60,/=5/60")
+    limiter = RateLimiter(client, algorithm, rules)
+    state = {}
+    rng = random.Random(11)
+    now = T0
+    for _ in range(500):
+        now += rng.choice([0, 500, 4000, 15000, 70000])
+        user = rng.choice(["alice", "bob"])
+        resources = [rng.choice(["/admin/x", "/a"]) for _ in range(rng.randint(1, 3))]
+        got = limiter.hit_many(user, resources, now)
+        want = []
+        for r in resources:
+            rule = limiter.rule_for(r)
+            want.append(memory_rate_hit(state, (user, rule.prefix), algorithm, now, rule))
+        assert [over for over, _ in got] == [over for over, _ in want]
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+def test_read_only_estimates_do_not_count(client, algorithm):
+    rules = parse_rate_limits("/admin=3/60,/=5/60")
+    limiter = RateLimiter(client, algorithm, rules)
+    state = {}
+    for i in range(3):
+        limiter.hit("alice", "/a", T0 + i)
+        memory_rate_hit(state, "/", algorithm, T0 + i, rules[-1])
+    for _ in range(3):
+        assert limiter.recent_counts("alice", T0 + 10) == {"/admin": 0, "/": 3}
+        assert memory_rate_peek(state, "/", algorithm, T0 + 10, rules[-1]) == 3
+    assert limiter.recent_count("alice", T0 + 10) == 3
+    assert limiter.recent_count("nobody", T0 + 10) == 0
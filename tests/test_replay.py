@@ -0,0 +1,127 @@
+"""离线回放：向量化特征抽取（分批、跨批延续状态）与逐事件参考实现、MemoryStateBackend 的扣分信号逐条一致；
+live 配置的决策分布与网关按路由决策一致；--verify 命令行"""
+import json
+import random
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from baseline import DEFAULT_BASELINE, ip_prefix_key
+from conftest import T0
+from device_memory import DevicePolicy
+from rate_limit import parse_rate_limits
+from policy_engine import builtin_document, compile_policy
+from replay import (
+    MS_PER_HOUR, ConfigEvaluator, FeatureExtractor, iter_events, load_configs, main, reference_features,
+)
+from scoring import SIGNAL_ORDER, device_fingerprint, is_off_hours, is_sensitive
+from state_backend import MemoryStateBackend, ScoreSignals
+
+RULES = parse_rate_limits("/admin=3/60,/=5/60")
+DEVICES = DevicePolicy(max_devices=3, ttl_ms=0, fp_bytes=8)
+AGENTS = [f"agent-{k}" for k in range(5)]
+
+
+def make_events(n, seed=5):
+    """随机访问，偶尔插入同一用户的短时突发（触发 high_frequency / rate_anomaly）"""
+    rng = random.Random(seed)
+    now = T0
+    events = []
+    while len(events) < n:
+        user = rng.choice(["alice", "bob", "carol"])
+        burst = 40 if rng.random() < 0.01 else 1
+        for _ in range(burst):
+            now += 200 if burst > 1 else rng.choice([0, 300, 2000, 20000, 900000])
+            events.append({
+                "ts_ms": now,
+                "user": user,
+                "ip": rng.choice(["10.0.0.1", "10.0.0.1", "10.0.1.7", "192.0.2.4"]),
+                "fp": device_fingerprint({"user_agent": rng.choice(AGENTS)}),
+                "resource": rng.choice(["/admin/users", "/reports", "/", "/transfer"]),
+            })
+    return events[:n]
+
+
+def to_batch(events):
+    ts_ms = np.array([e["ts_ms"] for e in events], dtype=np.int64)
+    return {
+        "ts_ms": ts_ms,
+        "hour": (ts_ms // MS_PER_HOUR) % 24,
+        "user": np.array([e["user"] for e in events], dtype=object),
+        "ip": np.array([e["ip"] for e in events], dtype=object),
+        "fp": np.array([e["fp"] for e in events], dtype=object),
+        "resource": np.array([e["resource"] for e in events], dtype=str),
+    }
+
+
+def backend_scores(events, algorithm, baseline, sensitive=is_sensitive):
+    """按事件顺序喂给 MemoryStateBackend，返回 [(信任分, 扣分信号), ...]"""
+    backend = MemoryStateBackend(algorithm, RULES, device_policy=DEVICES, baseline=baseline)
+    out = []
+    for e in events:
+        hour = int((e["ts_ms"] // MS_PER_HOUR) % 24)
+        signals = ScoreSignals(e["ip"], e["fp"], is_off_hours(hour), sensitive(e["resource"]), e["resource"],
+                               hour, ip_prefix_key(e["ip"]), 0)
+        out.append(backend.score(e["user"], signals, e["ts_ms"]))
+    return out
+
+
+def backend_features(events, algorithm, baseline):
+    rows = [[f in flags for f in SIGNAL_ORDER] for _, flags in backend_scores(events, algorithm, baseline)]
+    return np.array(rows, dtype=bool)
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+@pytest.mark.parametrize("baseline", [None, DEFAULT_BASELINE], ids=["no-baseline", "baseline"])
+def test_replay_matches_memory_backend(algorithm, baseline):
+    events = make_events(3000)
+    extractor = FeatureExtractor(RULES, algorithm, device_policy=DEVICES, baseline=baseline)
+    vectorized = np.vstack([extractor.extract(to_batch(events[i:i + 700])) for i in range(0, len(events), 700)])
+    reference = reference_features(to_batch(events), RULES, algorithm, device_policy=DEVICES, baseline=baseline)
+    expected = backend_features(events, algorithm, baseline)
+
+    if baseline is None:
+        expected = expected[:, :5]
+        vectorized, reference = vectorized[:, :5], reference[:, :5]
+    np.testing.assert_array_equal(reference, expected)
+    np.testing.assert_array_equal(vectorized, expected)
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+def test_live_config_matches_gateway_decisions(algorithm):
+    policy = compile_policy(builtin_document())
+    events = make_events(2000)
+    live = Counter()
+    for e, (score, _) in zip(events, backend_scores(events, algorithm, None, policy.is_sensitive)):
+        decision = policy.decide(e["resource"], score)
+        live[(decision["action"], decision["reason"])] += 1
+
+    evaluator = ConfigEvaluator(load_configs(None), policy)
+    extractor = FeatureExtractor(RULES, algorithm, policy.is_sensitive, DEVICES)
+    batch = to_batch(events)
+    evaluator.add(extractor.extract(batch), batch["resource"])
+    replayed = {(action, reason): n for name, action, reason, n, _ in evaluator.rows() if name == "live" and n}
+    assert replayed == dict(live)
+
+
+def test_verify_cli(tmp_path, capsys):
+    path = tmp_path / "events.jsonl"
+    rng = random.Random(2)
+    with open(path, "w", encoding="utf-8") as f:
+        for e in make_events(600):
+            f.write(json.dumps({
+                "ts": str(np.datetime64(int(e["ts_ms"]), "ms")),
+                "user_id": e["user"], "ip": e["ip"], "user_agent": rng.choice(AGENTS),
+                "resource": e["resource"],
+            }) + "\n")
+    assert main([str(path), "--verify", "600", "--rate-limits", "/admin=3/60,/=5/60", "--device-cap", "3"]) == 0
+    assert main([str(path), "--verify", "600", "--algo", "gcra", "--baseline"]) == 0
+    assert "600 个事件" in capsys.readouterr().out
+
+
+def test_multiple_inputs_merge_by_timestamp(tmp_path):
+    a, b = tmp_path / "a.jsonl", tmp_path / "b.jsonl"
+    a.write_text('{"ts": "2024-01-01T00:00:01", "user_id": "a"}\n{"ts": "2024-01-01T00:00:03", "user_id": "a"}\n')
+    b.write_text('{"ts": "2024-01-01T00:00:02", "user_id": "b"}\n{"ts": "2024-01-01T00:00:04", "user_id": "b"}\n')
+    assert [ev["ts"][-1] for ev in iter_events([str(a), str(b)])] == ["1", "2", "3", "4"]
@@ -0,0 +1,155 @@
+"""状态存储降级：断路器状态机，超预算的慢调用计为失败，Redis 不可用时降级评分（脚本不因此关掉），
+fault_redis.verify 的 健康→宕机→变慢→恢复 四个阶段"""
+import argparse
+import os
+
+import fakeredis
+import pytest
+import redis
+
+import app as gw
+import fault_redis
+from conftest import T0
+from policy_engine import builtin_document, compile_policy
+from rate_limit import parse_rate_limits
+from resilience import CircuitBreaker, DegradedScorer, ResilientStateBackend, StateUnavailable, call_guarded
+from scoring import FLAG_DEGRADED, FLAG_IP_CHANGE, FLAG_UNKNOWN_DEVICE
+from state_backend import RedisStateBackend, ScoreSignals
+from trust_script import TrustScoreScript
+
+RULES = parse_rate_limits("/=100/60")
+POLICY = compile_policy(builtin_document())
+SIGNALS = ScoreSignals("10.0.0.1", "ab" * 32, False, False, "/", 12)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr("resilience.time.monotonic", c)
+    return c
+
+
+def resilient(mode="script", threshold=2):
+    faults = fault_redis.Faults()
+    client = fault_redis.inject_faults(
+        fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True), faults)
+    backend = ResilientStateBackend(RedisStateBackend(client, mode, rules=RULES),
+                                    CircuitBreaker(threshold, reset_timeout=5), latency_budget=1.0)
+    return backend, faults
+
+
+def test_breaker_opens_half_opens_and_closes(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=5, half_open_max=1)
+    breaker.record_failure("x")
+    breaker.record_success()  # 成功清零连续失败数
+    breaker.record_failure("x")
+    assert breaker.state == "closed"
+    breaker.record_failure("y")
+    assert breaker.state == "open" and not breaker.allow()
+    assert breaker.status()["retry_in_seconds"] == 5
+
+    clock.now += 5
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()  # 只放行 half_open_max 个试探
+    breaker.record_failure("z")
+    assert breaker.state == "open" and breaker.status()["last_failure"] == "z"
+
+    clock.now += 5
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.failures == 0
+
+
+def test_slow_call_returns_result_but_counts_as_failure(monkeypatch):
+    ticks = iter([0.0, 0.2, 1.0, 1.2])
+    monkeypatch.setattr("resilience.time.perf_counter", lambda: next(ticks))
+    breaker = CircuitBreaker(failure_threshold=2)
+    assert call_guarded(breaker, 0.05, lambda: "ok") == "ok"
+    assert breaker.failures == 1 and breaker.last_failure.startswith("slow")
+    assert call_guarded(breaker, 0.05, lambda: "ok") == "ok"
+    assert breaker.state == "open"
+    with pytest.raises(StateUnavailable) as e:
+        call_guarded(breaker, 0.05, lambda: "ok")
+    assert e.value.cause == "open"
+
+
+def test_degraded_scorer_uses_local_memory():
+    scorer = DegradedScorer(max_users=2, penalty=10)
+    _, flags = scorer.score("new", SIGNALS, T0)
+    assert flags == [FLAG_DEGRADED]  # 本地没有的用户：按无变化 / 已知设备处理
+    scorer.remember("alice", "10.0.0.9", "cd" * 32)
+    _, flags = scorer.score("alice", SIGNALS, T0)
+    assert {FLAG_IP_CHANGE, FLAG_UNKNOWN_DEVICE, FLAG_DEGRADED} <= set(flags)
+    scorer.remember("bob", "10.0.0.1", SIGNALS.fingerprint)
+    scorer.remember("carol", "10.0.0.1", SIGNALS.fingerprint)
+    assert "new" not in scorer._users  # 用户数按 LRU 封顶
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_outage_degrades_scoring(clock, mode):
+    backend, faults = resilient(mode)
+    assert FLAG_DEGRADED not in backend.score("alice", SIGNALS, T0)[1]
+
+    faults.set(down=True)
+    moved = SIGNALS._replace(ip="10.0.0.2")
+    _, flags = backend.score("alice", moved, T0 + 1)
+    assert flags == [FLAG_IP_CHANGE, FLAG_DEGRADED]  # 与成功路径记下的 last_ip 比较
+    assert backend.score("alice", moved, T0 + 2)[1] == [FLAG_DEGRADED]
+    assert backend.breaker.state == "open"
+    calls = faults.calls
+    _, _, decision = backend.score_logged("alice", SIGNALS._replace(resource="/admin"), POLICY.match("/admin"), T0)
+    assert decision["reason"] == "state_unavailable"  # /admin fail-closed
+    assert [flags for _, flags in backend.score_many("alice", [SIGNALS, SIGNALS], T0)] == [[FLAG_DEGRADED]] * 2
+    backend.push_logs([{"u": "alice"}], {"alice": 10})  # 丢弃，不抛
+    with pytest.raises(StateUnavailable):
+        backend.user_states(["alice"])
+    assert faults.calls == calls  # 断路器打开期间不碰 Redis
+
+    faults.set()
+    clock.now += 5
+    assert FLAG_DEGRADED not in backend.score("alice", SIGNALS, T0 + 10)[1]
+    assert backend.breaker.state == "closed"
+
+
+def test_script_errors_degrade_without_disabling_script(monkeypatch):
+    backend, _ = resilient("script", threshold=5)
+
+    def read_only(*args, **kwargs):
+        raise redis.exceptions.ReadOnlyError("You can't write against a read only replica.")
+    monkeypatch.setattr(TrustScoreScript, "run", read_only)
+    _, flags = backend.score("alice", SIGNALS, T0)
+    assert FLAG_DEGRADED in flags
+    assert backend.inner._script is not None  # 故障转移期间不退回逐条调用
+    assert backend.breaker.failures == 1
+
+    monkeypatch.undo()
+    _, flags = backend.score("alice", SIGNALS, T0 + 1)
+    assert FLAG_DEGRADED not in flags and backend.breaker.failures == 0
+
+
+def test_fault_verify_four_phases(monkeypatch, capsys):
+    """fault_redis.verify 改写 os.environ 与 app 的全局对象：先登记到 monkeypatch，测试结束后还原"""
+    args = argparse.Namespace(budget_ms=20.0, threshold=3, reset_seconds=0.3)
+    monkeypatch.setattr(os, "environ", dict(os.environ))
+    # app 已在别的测试里导入过，环境变量不会再读一遍：对应的模块常量直接设成 verify 期望的值
+    monkeypatch.setattr(gw, "RESILIENCE_ENABLED", True)
+    monkeypatch.setattr(gw, "L1_CACHE_ENABLED", False)
+    monkeypatch.setattr(gw, "STATE_LATENCY_BUDGET_MS", args.budget_ms)
+    monkeypatch.setattr(gw, "BREAKER_FAILURE_THRESHOLD", args.threshold)
+    monkeypatch.setattr(gw, "BREAKER_RESET_SECONDS", args.reset_seconds)
+    monkeypatch.setattr(gw, "redis_client", gw.redis_client)
+    monkeypatch.setattr(gw, "gateway", gw.gateway)
+
+    assert fault_redis.verify(args) == 0
+    out = capsys.readouterr().out
+    for name in ("健康", "宕机", "变慢", "恢复"):
+        assert f"== {name}:" in out
+    assert "✗" not in out
@@ -0,0 +1,122 @@
+"""状态后端：memory / Redis 脚本 / Redis 逐条调用三者逐请求一致，风险排行一致，工厂按 STATE_BACKEND 选实现，
+Cluster 下同一用户的 key 共用哈希标签"""
+import random
+import threading
+
+import fakeredis
+import pytest
+
+import app as gw
+from baseline import DEFAULT_BASELINE, ip_prefix_key
+from conftest import T0
+from device_memory import DevicePolicy
+from rate_limit import parse_rate_limits
+from resilience import ResilientStateBackend
+from scoring import is_off_hours
+from state_backend import MemoryStateBackend, RedisClusterStateBackend, RedisStateBackend, ScoreSignals
+
+RULES = parse_rate_limits("/admin=3/60,/=5/60")
+DEVICES = DevicePolicy(max_devices=3, ttl_ms=0, fp_bytes=8)
+FINGERPRINTS = [("%02x" % k) * 32 for k in range(6)]  # 前 fp_bytes 字节互不相同
+
+
+def make_backends(algorithm, baseline=None, device_policy=DEVICES):
+    """三种实现各用独立的 FakeServer，避免互相看见对方的状态"""
+    def redis_backend(mode):
+        client = fakeredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+        return RedisStateBackend(client, mode, algorithm, RULES, device_policy=device_policy, baseline=baseline)
+    return {
+        "memory": MemoryStateBackend(algorithm, RULES, device_policy=device_policy, baseline=baseline),
+        "script": redis_backend("script"),
+        "calls": redis_backend("calls"),
+    }
+
+
+def random_signals(rng, hour):
+    ip = rng.choice(["10.0.0.1", "10.0.0.9", "10.0.1.3", "192.0.2.4"])
+    return ScoreSignals(
+        ip=ip,
+        fingerprint=rng.choice(FINGERPRINTS),
+        off_hours=is_off_hours(hour),
+        sensitive=rng.random() < 0.3,
+        resource=rng.choice(["/admin/users", "/reports", "/"]),
+        hour=hour,
+        net=ip_prefix_key(ip),
+        asn=0,
+    )
+
+
+def assert_same(results):
+    first = next(iter(results.values()))
+    for name, r in results.items():
+        assert list(map(tuple, r)) == list(map(tuple, first)), name
+
+
+@pytest.mark.parametrize("algorithm", ["sliding_window", "gcra"])
+@pytest.mark.parametrize("baseline", [None, DEFAULT_BASELINE], ids=["no-baseline", "baseline"])
+def test_backends_agree(algorithm, baseline):
+    rng = random.Random(7)
+    backends = make_backends(algorithm, baseline)
+    now = T0
+    for _ in range(800):
+        now += rng.choice([0, 200, 1000, 5000, 60000])
+        hour = (now // 3600000) % 24
+        user = rng.choice(["alice", "bob"])
+        s = random_signals(rng, hour)
+        if rng.random() < 0.1:
+            batch = [s, random_signals(rng, hour)]
+            assert_same({name: b.score_many(user, batch, now) for name, b in backends.items()})
+        else:
+            assert_same({name: [b.score(user, s, now)] for name, b in backends.items()})
+        hit = {name: b.count_hit(user, s, now) for name, b in backends.items()}
+        assert len(set(map(tuple, hit.values()))) == 1, hit
+
+    for user in ("alice", "bob"):
+        states = {name: b.user_states([user], now)[0] for name, b in backends.items()}
+        assert len({(st.trust_score, st.last_ip, tuple(st.flags)) for st in states.values()}) == 1, states
+
+
+def test_riskiest_agrees():
+    scores = {"alice": 40, "bob": 80, "carol": 40, "dave": 10}
+    for name, b in make_backends("sliding_window").items():
+        b.push_logs([], scores)
+        b.push_logs([], {"bob": 5})  # 后写覆盖前写
+        total, page = b.riskiest(0, 3)
+        assert total == 4, name
+        assert [(u, int(s)) for u, s in page] == [("bob", 5), ("dave", 10), ("alice", 40)], name
+        assert [u for u, _ in b.riskiest(3, 3)[1]] == ["carol"], name
+
+
+def test_memory_backend_counts_concurrent_hits():
+    backend = MemoryStateBackend("sliding_window", parse_rate_limits("/=100000/60"), stripes=4)
+    signals = ScoreSignals("10.0.0.1", FINGERPRINTS[0], False, False, "/", 12)
+
+    def worker():
+        for _ in range(200):
+            backend.count_hit("alice", signals, T0)
+
+    backend.score("alice", signals, T0)
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert backend.user_state("alice", T0).access_count == 1 + 8 * 200
+
+
+def test_make_state_backend_kinds(client, monkeypatch):
+    assert isinstance(gw.make_state_backend(kind="memory"), MemoryStateBackend)
+    monkeypatch.setattr(gw, "RESILIENCE_ENABLED", True)
+    backend = gw.make_state_backend(client, "calls", kind="memory")  # 显式 client 总是走 Redis
+    assert isinstance(backend, ResilientStateBackend) and isinstance(backend.inner, RedisStateBackend)
+    monkeypatch.setattr(gw, "RESILIENCE_ENABLED", False)
+    assert type(gw.make_state_backend(client, "script", kind="redis")) is RedisStateBackend
+    with pytest.raises(ValueError):
+        gw.make_state_backend(kind="sqlite")
+
+
+def test_cluster_keys_share_hash_tag(client):
+    backend = RedisClusterStateBackend(client, "script", rules=RULES)
+    backend.score("alice", ScoreSignals("10.0.0.1", FINGERPRINTS[0], False, False, "/", 12), T0)
+    keys = [k for k in client.keys("*") if "alice" in k]
+    assert keys and all("{alice}" in k for k in keys)
@@ -0,0 +1,151 @@
+"""访问日志流导出：写成功才 XACK；写失败留在 pending 下一轮重读；挂掉的消费者的 pending 被其他消费者认领；
+文件 sink 单写者（{consumer} 展开成各自的文件，同一文件第二个写者被拒）"""
+import argparse
+import csv
+import os
+import time
+
+import pytest
+
+from access_stream import ACCESS_STREAM_KEY, encode_entry
+from decision_archive import ArchiveReader
+from replay import GATEWAY_CSV_COLUMNS
+from stream_exporter import ArchiveSink, OutputLocked, StreamExporter, lock_output, make_sinks
+
+DECISION = {"action": "allow", "reason": "low_risk"}
+
+
+class ListSink:
+    name = "list"
+
+    def __init__(self, fail=False):
+        self.entries = []
+        self.fail = fail
+
+    def write(self, entries):
+        if self.fail:
+            raise IOError("sink down")
+        self.entries.extend(entries)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def push(client, n, start=0):
+    for i in range(start, start + n):
+        client.xadd(ACCESS_STREAM_KEY, encode_entry(f"u{i}", 90, "/", DECISION))
+
+
+def make_exporter(client, sink, consumer, claim_idle_ms=0):
+    return StreamExporter(client, [sink], consumer=consumer, block_ms=0, claim_idle_ms=claim_idle_ms)
+
+
+def test_export_acks_after_sink_write(client):
+    sink = ListSink()
+    exporter = make_exporter(client, sink, "c1")
+    exporter.ensure_group("0")
+    push(client, 5)
+    assert exporter.run_once() == 5
+    assert [e.user_id for e in sink.entries] == [f"u{i}" for i in range(5)]
+    assert exporter.stats()["pending"] == 0
+    assert exporter.run_once() == 0
+
+
+def test_failed_write_stays_pending_and_is_replayed(client):
+    sink = ListSink(fail=True)
+    exporter = make_exporter(client, sink, "c1")
+    exporter.ensure_group("0")
+    push(client, 3)
+    with pytest.raises(IOError):
+        exporter.run_once()
+    assert exporter.stats()["pending"] == 3
+
+    sink.fail = False
+    exporter._replay = True  # run() 出错后同样从自己的 pending 重读
+    assert exporter.run_once() == 3
+    assert len(sink.entries) == 3
+    assert exporter.stats()["pending"] == 0
+
+
+def test_idle_pending_is_claimed_by_another_consumer(client):
+    dead = make_exporter(client, ListSink(fail=True), "dead")
+    dead.ensure_group("0")
+    push(client, 4)
+    with pytest.raises(IOError):
+        dead.run_once()
+
+    sink = ListSink()
+    alive = make_exporter(client, sink, "alive", claim_idle_ms=10)
+    time.sleep(0.05)
+    exported = 0
+    for _ in range(4):
+        exported += alive.run_once()
+    assert exported == 4
+    assert sorted(e.user_id for e in sink.entries) == [f"u{i}" for i in range(4)]
+    assert alive.stats()["pending"] == 0
+
+
+def test_ensure_group_is_idempotent(client):
+    exporter = make_exporter(client, ListSink(), "c1")
+    assert exporter.ensure_group()
+    assert not exporter.ensure_group()
+
+
+def test_output_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / "decisions.csv")
+    fd = lock_output(path)
+    with pytest.raises(OutputLocked):
+        lock_output(path)
+    os.close(fd)
+    os.close(lock_output(path))
+
+
+def sink_args(tmp_path):
+    return argparse.Namespace(csv=str(tmp_path / "access_log.{consumer}.csv"),
+                              archive=str(tmp_path / "access_log.{consumer}.zta"), metrics_port=None)
+
+
+def test_make_sinks_expands_consumer(client, tmp_path):
+    args = sink_args(tmp_path)
+    sinks = {name: make_sinks(args, name) for name in ("c1", "c2")}  # 同组两个消费者各写各的文件
+    with pytest.raises(OutputLocked):
+        make_sinks(args, "c1")
+    push(client, 3)
+    for name, group_sinks in sinks.items():
+        exporter = StreamExporter(client, group_sinks, group=name, consumer=name, block_ms=0)
+        exporter.ensure_group("0")
+        exporter.run(idle_exit=True)  # 读空即返回，并关闭 sink（释放锁）
+        assert exporter.exported == 3
+
+    for name in ("c1", "c2"):
+        with open(tmp_path / f"access_log.{name}.csv", newline="", encoding="utf-8") as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == GATEWAY_CSV_COLUMNS and [r[1] for r in rows[1:]] == ["u0", "u1", "u2"]
+        with ArchiveReader(str(tmp_path / f"access_log.{name}.zta")) as r:
+            assert r.rows == 3 and r.dicts["user"] == ["u0", "u1", "u2"]
+    reopened = make_sinks(args, "c1")  # 导出器退出时关闭 sink，锁已释放
+    assert [sink.name for sink in reopened] == ["csv", "archive"]
+    for sink in reopened:
+        sink.close()
+
+
+def test_archive_sink_locks_before_opening(tmp_path):
+    path = str(tmp_path / "access_log.zta")
+    first = ArchiveSink(path)
+    first.write([])
+    first.flush()
+    size = os.path.getsize(path)
+    with pytest.raises(OutputLocked):
+        ArchiveSink(path)  # 不能打开：ArchiveWriter 打开已有归档时会截断文件
+    assert os.path.getsize(path) == size
+    first.close()
+
+    bad = str(tmp_path / "not_an_archive.zta")
+    with open(bad, "w", encoding="utf-8") as f:
+        f.write("ts,user_id\n")
+    with pytest.raises(ValueError):
+        ArchiveSink(bad)
+    os.close(lock_output(bad))  # 打开失败也释放了锁
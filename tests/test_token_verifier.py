@@ -0,0 +1,178 @@
+"""JWKS 验签：RS256 密钥对 + 本地 HTTP 提供的 JWKS；必需 claims、未知 kid 单飞重拉、密钥轮换清缓存、JWKS 故障 503"""
+import http.server
+import json
+import threading
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from token_verifier import KeySourceUnavailable, TokenVerifier
+
+ISSUER = "http://idp.test/realms/test"
+AUDIENCE = "my-app"
+
+
+def new_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+KEYS = {"k1": new_key(), "k2": new_key()}
+OTHER = new_key()
+
+
+def jwk(kid):
+    d = json.loads(RSAAlgorithm.to_jwk(KEYS[kid].public_key()))
+    d.update(kid=kid, use="sig", alg="RS256")
+    return d
+
+
+class JwksServer:
+    """本地 JWKS 桩：kids 决定发布哪些公钥，fetches 记拉取次数，delay 模拟慢 IdP"""
+
+    def __init__(self, kids=("k1",), delay=0.0):
+        self.kids = list(kids)
+        self.delay = delay
+        self.fetches = 0
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                time.sleep(server.delay)
+                body = json.dumps({"keys": [jwk(k) for k in server.kids]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/certs"
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def jwks():
+    server = JwksServer()
+    yield server
+    server.close()
+
+
+def make_verifier(url):
+    return TokenVerifier("jwks", url, issuer=ISSUER, audience=AUDIENCE, refresh_interval=0)
+
+
+def sign(kid="k1", key=None, drop=(), **overrides):
+    now = int(time.time())
+    claims = {"preferred_username": "alice", "iss": ISSUER, "aud": AUDIENCE,
+              "iat": now, "nbf": now, "exp": now + 300}
+    claims.update(overrides)
+    for name in drop:
+        del claims[name]
+    return jwt.encode(claims, key or KEYS[kid], algorithm="RS256", headers={"kid": kid})
+
+
+def test_valid_token_is_accepted_and_cached(jwks):
+    verifier = make_verifier(jwks.url)
+    token = sign()
+    assert verifier.verify(token)["preferred_username"] == "alice"
+    assert verifier.verify(token)["preferred_username"] == "alice"
+    assert len(verifier.claims_cache) == 1
+    assert jwks.fetches == 1
+
+
+@pytest.mark.parametrize("token, error", [
+    (lambda: sign(key=OTHER), jwt.InvalidSignatureError),
+    (lambda: sign(exp=int(time.time()) - 10), jwt.ExpiredSignatureError),
+    (lambda: sign(nbf=int(time.time()) + 300), jwt.ImmatureSignatureError),
+    (lambda: sign(drop=["exp"]), jwt.MissingRequiredClaimError),
+    (lambda: sign(drop=["iat"]), jwt.MissingRequiredClaimError),
+    (lambda: sign(drop=["nbf"]), jwt.MissingRequiredClaimError),
+    (lambda: sign(aud="other-app"), jwt.InvalidAudienceError),
+    (lambda: sign(iss="http://evil.test"), jwt.InvalidIssuerError),
+], ids=["signature", "expired", "future-nbf", "no-exp", "no-iat", "no-nbf", "audience", "issuer"])
+def test_invalid_tokens_are_rejected(jwks, token, error):
+    verifier = make_verifier(jwks.url)
+    with pytest.raises(error):
+        verifier.verify(token())
+    assert len(verifier.claims_cache) == 0
+
+
+def test_unknown_kid_refetches_once_for_concurrent_requests():
+    server = JwksServer(kids=["k1"], delay=0.2)
+    try:
+        verifier = make_verifier(server.url)
+        verifier.keys.min_refetch_interval = 0  # 只靠单飞去重，不靠限频
+        verifier.verify(sign("k1"))
+        server.kids = ["k1", "k2"]
+        token = sign("k2")
+        results, errors = [], []
+
+        def call():
+            try:
+                results.append(verifier.verify(token)["preferred_username"])
+            except Exception as e:  # pragma: no cover - 失败时在断言里报出
+                errors.append(e)
+        threads = [threading.Thread(target=call) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == [] and results == ["alice"] * 8
+        assert server.fetches == 2
+    finally:
+        server.close()
+
+
+def test_unknown_kid_refetch_is_rate_limited(jwks):
+    verifier = make_verifier(jwks.url)
+    verifier.verify(sign("k1"))
+    for _ in range(3):
+        with pytest.raises(jwt.InvalidTokenError, match="kid=k2"):
+            verifier.verify(sign("k2"))
+    assert jwks.fetches == 1  # 距上次拉取不足 min_refetch_interval
+
+
+def test_rotated_out_kid_drops_cached_claims(jwks):
+    verifier = make_verifier(jwks.url)
+    old = sign("k1")
+    verifier.verify(old)
+    jwks.kids = ["k2"]
+    assert verifier.refresh_keys() == {"k2"}
+    assert len(verifier.claims_cache) == 0
+    with pytest.raises(jwt.InvalidTokenError):
+        verifier.verify(old)
+    assert verifier.verify(sign("k2"))["preferred_username"] == "alice"
+
+
+def test_jwks_outage_is_key_source_unavailable(jwks):
+    url = jwks.url
+    jwks.close()
+    verifier = make_verifier(url)
+    with pytest.raises(KeySourceUnavailable):
+        verifier.verify(sign())
+    with pytest.raises(KeySourceUnavailable):  # 限频期内不重拉，仍报不可用而不是令牌无效
+        verifier.verify(sign())
+
+
+def test_jwks_outage_maps_to_503(jwks, monkeypatch):
+    import app as gw
+
+    url = jwks.url
+    jwks.close()
+    monkeypatch.setattr(gw, "token_verifier", make_verifier(url))
+    r = gw.app.test_client().post("/api/access-request", json={"resource": "/"},
+                                  headers={"Authorization": f"Bearer {sign()}"})
+    assert r.status_code == 503
+    r = gw.app.test_client().post("/api/access-request", json={"resource": "/"},
+                                  headers={"Authorization": "Bearer not-a-token"})
+    assert r.status_code == 401
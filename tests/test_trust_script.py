@@ -0,0 +1,88 @@
+"""信任分 Lua 脚本：与逐条调用一致；NOSCRIPT 自动重载；只有脚本功能不可用才回退逐条调用，其他错误原样上抛"""
+import pytest
+import redis
+
+from conftest import T0
+from policy_engine import builtin_document, compile_policy
+from rate_limit import parse_rate_limits
+from state_backend import RedisStateBackend, ScoreSignals
+from trust_script import TrustScoreScript, scripting_unavailable
+
+RULES = parse_rate_limits("/=3/60")
+ROUTE = compile_policy(builtin_document()).match("/")
+FP = "ab" * 32
+
+
+def signals(ip="10.0.0.1", resource="/"):
+    return ScoreSignals(ip, FP, False, False, resource, 12)
+
+
+def test_script_matches_per_call(make_client):
+    scripted = RedisStateBackend(make_client(), "script", rules=RULES)
+    per_call = RedisStateBackend(make_client(), "calls", rules=RULES)
+    for i, ip in enumerate(["10.0.0.1", "10.0.0.1", "10.0.0.2", "10.0.0.2", "10.0.0.2"]):
+        a = scripted.score("alice", signals(ip), T0 + i)
+        b = per_call.score("bob", signals(ip), T0 + i)
+        assert a == b
+    assert scripted._script is not None
+
+
+def test_script_flush_is_reloaded(client):
+    backend = RedisStateBackend(client, "script", rules=RULES)
+    backend.score("alice", signals(), T0)
+    client.script_flush()
+    backend.score("alice", signals(), T0 + 1)
+    backend.score_many("alice", [signals(), signals()], T0 + 2)
+    assert backend._script is not None
+
+
+@pytest.mark.parametrize("error", [
+    redis.exceptions.ReadOnlyError("You can't write against a read only replica."),
+    redis.exceptions.OutOfMemoryError("command not allowed when used memory > 'maxmemory'."),
+    redis.exceptions.ResponseError("Error running script: user_script:12: attempt to compare nil with number"),
+])
+def test_other_errors_propagate_and_keep_script(client, monkeypatch, error):
+    backend = RedisStateBackend(client, "script", rules=RULES)
+
+    def fail(*args, **kwargs):
+        raise error
+    monkeypatch.setattr(TrustScoreScript, "run", fail)
+    monkeypatch.setattr(TrustScoreScript, "run_many", fail)
+
+    with pytest.raises(type(error)):
+        backend.score("alice", signals(), T0)
+    with pytest.raises(type(error)):
+        backend.score_logged("alice", signals(), ROUTE, T0)
+    with pytest.raises(type(error)):
+        backend.score_many("alice", [signals()], T0)
+    assert backend._script is not None
+    assert client.keys("*") == []  # 没有用逐条调用重跑一遍
+
+
+def test_disabled_eval_falls_back_to_per_call(client, monkeypatch):
+    backend = RedisStateBackend(client, "script", rules=RULES)
+
+    def disabled(*args, **kwargs):
+        raise redis.exceptions.ResponseError("ERR unknown command 'evalsha', with args beginning with: ")
+    monkeypatch.setattr(TrustScoreScript, "run", disabled)
+
+    trust_score, flags, decision = backend.score_logged("alice", signals(), ROUTE, T0)
+    assert backend._script is None and not backend.logs_inline
+    assert (trust_score, flags) == (75, ["unknown_device"])
+    assert decision == ROUTE.decide(trust_score)
+    assert client.hget("user:alice:state", "last_ip") == "10.0.0.1"
+    assert backend.score("alice", signals(), T0 + 1) == (100, [])
+
+
+def test_score_logged_without_script_uses_base_path(client):
+    backend = RedisStateBackend(client, "calls", rules=RULES)
+    trust_score, flags, decision = backend.score_logged("alice", signals(), ROUTE, T0)
+    assert decision == ROUTE.decide(trust_score)
+    assert client.xlen("access_stream") == 1
+
+
+def test_scripting_unavailable():
+    assert scripting_unavailable(redis.exceptions.NoScriptError("NOSCRIPT No matching script."))
+    assert scripting_unavailable(redis.exceptions.ResponseError("ERR unknown command `EVAL`"))
+    assert not scripting_unavailable(redis.exceptions.ReadOnlyError("READONLY"))
+    assert not scripting_unavailable(redis.exceptions.ResponseError("BUSY Redis is busy running a script."))
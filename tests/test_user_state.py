@@ -0,0 +1,101 @@
+"""每用户风险状态：单个 HASH（旧版分散 key 首次评分时迁入），批量行为查询一个 pipeline，
+风险排行 ZSET 分页；HTTP 接口用 Flask test client + fakeredis"""
+import pytest
+
+import app as gw
+from conftest import T0, auth_headers
+from rate_limit import parse_rate_limits
+from scoring import FLAG_IP_CHANGE
+from state_backend import STATE_FIELDS, RedisStateBackend, ScoreSignals
+
+RULES = parse_rate_limits("/=5/60")
+SIGNALS = ScoreSignals("10.0.0.2", "ab" * 32, False, False, "/", 12)
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_state_lives_in_one_hash(client, mode):
+    backend = RedisStateBackend(client, mode, rules=RULES)
+    score, flags = backend.score("alice", SIGNALS, T0)
+    state = client.hgetall("user:alice:state")
+    assert set(state) == set(STATE_FIELDS)
+    assert (int(state["trust_score"]), state["last_ip"], int(state["updated_at"])) == (score, "10.0.0.2", T0)
+    assert state["flags"].split(",") == list(flags)
+    assert not client.exists("user:alice:trust_score", "user:alice:last_ip", "user:alice:last_access")
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_legacy_keys_migrate_into_state_hash(client, mode):
+    client.set("user:alice:trust_score", 55)
+    client.set("user:alice:last_ip", "10.0.0.1")
+    backend = RedisStateBackend(client, mode, rules=RULES)
+
+    state = backend.user_states(["alice"], T0)[0]
+    assert (state.trust_score, state.last_ip) == (55, "10.0.0.1")
+
+    _, flags = backend.score("alice", SIGNALS, T0)
+    assert FLAG_IP_CHANGE in flags  # 旧版 last_ip 参与了比较
+    assert client.hget("user:alice:state", "last_ip") == "10.0.0.2"
+    assert not client.exists("user:alice:trust_score", "user:alice:last_ip")
+    assert backend.user_states(["alice"], T0)[0].last_ip == "10.0.0.2"
+
+
+@pytest.mark.parametrize("mode", ["script", "calls"])
+def test_user_states_round_trips(client, monkeypatch, mode):
+    backend = RedisStateBackend(client, mode, rules=RULES)
+    for i, user in enumerate(("alice", "bob", "alice")):
+        backend.score(user, SIGNALS, T0 + i)
+    pipeline_cls = type(client.pipeline())
+    execute = pipeline_cls.execute
+    batches = []
+
+    def counting(pipe, *args, **kwargs):
+        batches.append(len(pipe.command_stack))
+        return execute(pipe, *args, **kwargs)
+
+    monkeypatch.setattr(pipeline_cls, "execute", counting)
+    states = backend.user_states(["bob", "alice"], T0 + 10)
+    assert len(batches) == 1 and [st.access_count for st in states] == [1, 2]
+
+    batches.clear()
+    states = backend.user_states(["bob", "ghost", "alice"], T0 + 10)
+    assert len(batches) == 2  # HASH 为空的 ghost 再回读一次旧版 key
+    assert [st.access_count for st in states] == [1, 0, 2]
+    assert states[1].trust_score is None and states[1].flags == ()
+
+
+def test_bulk_behavior_and_risky_users(make_gateway):
+    _, client = make_gateway()
+    client.set("user:legacy:trust_score", 35)  # 未迁移的用户也能查到
+    client.set("user:legacy:last_ip", "10.9.9.9")
+    tc = gw.app.test_client()
+    tc.post("/api/access-request", json={"resource": "/reports"}, headers=auth_headers("alice"))
+    tc.post("/api/access-request", json={"resource": "/reports"}, headers=auth_headers("bob"))
+    tc.post("/api/access-request", json={"resource": "/reports"}, headers=auth_headers("bob", ip="10.0.0.2"))
+
+    r = tc.get("/api/user-behavior?ids=bob,alice,legacy,bob", headers=auth_headers())
+    users = r.get_json()["users"]
+    assert [u["user_id"] for u in users] == ["bob", "alice", "legacy"]
+    assert users[0]["last_known_ip"] == "10.0.0.2" and "ip_change" in users[0]["last_flags"]
+    assert (users[2]["current_trust_score"], users[2]["last_known_ip"]) == (35, "10.9.9.9")
+    post = tc.post("/api/user-behavior", json={"user_ids": ["bob", "alice", "legacy"]}, headers=auth_headers())
+    assert post.get_json()["users"] == users
+
+    risky = tc.get("/api/risky-users?limit=2", headers=auth_headers()).get_json()
+    assert risky["total"] == 2  # 风险排行只由评分路径维护，旧版 key 不在其中
+    ranked = [(u["rank"], u["current_trust_score"]) for u in risky["users"]]
+    assert [rank for rank, _ in ranked] == [1, 2]
+    assert [score for _, score in ranked] == sorted(score for _, score in ranked)
+    page2 = tc.get("/api/risky-users?offset=1&limit=1", headers=auth_headers()).get_json()["users"]
+    assert [(u["rank"], u["user_id"]) for u in page2] == [(2, risky["users"][1]["user_id"])]
+
+
+def test_bulk_behavior_rejects_bad_input(make_gateway, monkeypatch):
+    make_gateway()
+    monkeypatch.setattr(gw, "BEHAVIOR_BULK_MAX", 2)
+    tc = gw.app.test_client()
+    assert tc.get("/api/user-behavior?ids=,", headers=auth_headers()).status_code == 400
+    assert tc.post("/api/user-behavior", json={"user_ids": "alice"}, headers=auth_headers()).status_code == 400
+    assert tc.get("/api/user-behavior?ids=a&ids=b,c", headers=auth_headers()).status_code == 400
+    r = tc.get("/api/user-behavior?ids=a&ids=b,a", headers=auth_headers())
+    assert r.status_code == 200 and r.get_json()["count"] == 2
+    assert tc.get("/api/risky-users?limit=x", headers=auth_headers()).status_code == 400
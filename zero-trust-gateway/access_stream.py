@@ -0,0 +1,169 @@
+"""
+访问日志流（Redis Streams）的字段编码
+功能点：
+- 每个决策一条 XADD access_stream MAXLEN ~ N * —— 近似裁剪（按宏节点整块删除，O(1) 摊还），
+  流 ID 的毫秒部分即决策时间，不再单独存时间戳
+- 紧凑字段（取代 JSON 字符串）：u=user_id r=resource s=信任分 a=档位序号（POLICY_TIERS 顺序：
+  0=allow 1=allow_restricted 2=require_mfa 3=deny） f=扣分信号位图（SIGNAL_ORDER 顺序，degraded 为最高位）
+  c=reason，仅当与该档位默认 reason 不同（路由自定义 / state_unavailable）时才写
+- Redis 单节点脚本路径：XADD 与风险排行 ZADD 在评分的同一次 EVALSHA 内完成（trust_script.py，
+  档位由脚本按路由阈值判定，与 RoutePolicy.decide 相同）；其余路径（Cluster / 逐条调用 / 降级 /
+  批量接口 / 决策缓存偏离稳态的命中）由 push_logs 一个 pipeline 写入
+- 决策缓存的稳态命中也记一条（流是 SIEM 的完整决策记录）：命中路径只进 StreamLogBuffer 的有界队列，
+  后台线程攒批后一次 push_logs，不增加命中路径的往返；队列满 / 写失败丢弃并计数
+  （zt_access_log_buffer_dropped_total）
+- 下游用消费者组读取、确认（stream_exporter.py）；流本身只保留最近约 N 条
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from prometheus_client import Counter
+
+from scoring import FLAG_DEGRADED, POLICY_TIERS, SIGNAL_ORDER
+
+ACCESS_STREAM_KEY = "access_stream"
+ACCESS_STREAM_MAXLEN = 100000
+
+BUFFER_WRITTEN = Counter("zt_access_log_buffer_written_total", "Buffered access-stream entries written")
+BUFFER_DROPPED = Counter("zt_access_log_buffer_dropped_total",
+                         "Buffered access-stream entries dropped on overflow or write error")
+
+ACTIONS = tuple(t["action"] for t in POLICY_TIERS)
+ACTION_CODES = {action: i for i, action in enumerate(ACTIONS)}
+DEFAULT_REASONS = tuple(t["reason"] for t in POLICY_TIERS)
+FLAG_BITS = {flag: 1 << i for i, flag in enumerate(SIGNAL_ORDER + (FLAG_DEGRADED,))}
+
+# 解码结果：ts_ms 取自流 ID
+AccessEntry = namedtuple("AccessEntry", ["entry_id", "ts_ms", "user_id", "trust_score", "resource",
+                                         "action", "reason", "flags"])
+
+
+def flag_bits(flags):
+    bits = 0
+    for flag in flags:
+        bits |= FLAG_BITS.get(flag, 0)
+    return bits
+
+
+def flags_from_bits(bits):
+    return tuple(flag for flag, bit in FLAG_BITS.items() if bits & bit)
+
+
+def encode_entry(user_id, trust_score, resource, decision, flags=()):
+    """decision 为策略决策（含 action / reason）；返回 XADD 的字段 dict"""
+    code = ACTION_CODES[decision["action"]]
+    fields = {"u": user_id, "r": resource or "", "s": trust_score, "a": code, "f": flag_bits(flags)}
+    reason = decision.get("reason", "")
+    if reason != DEFAULT_REASONS[code]:
+        fields["c"] = reason
+    return fields
+
+
+def decode_entry(entry_id, fields):
+    """XREAD / XREADGROUP 返回的 (id, {字段: 值}) → AccessEntry"""
+    code = int(fields.get("a", 3))
+    return AccessEntry(
+        entry_id,
+        int(entry_id.split("-", 1)[0]),
+        fields.get("u", ""),
+        int(fields.get("s", 0)),
+        fields.get("r", ""),
+        ACTIONS[code],
+        fields.get("c", DEFAULT_REASONS[code]),
+        flags_from_bits(int(fields.get("f", 0))),
+    )
+
+
+def csv_row(entry):
+    """与网关写的 decisions.csv 相同的 6 列（replay.GATEWAY_CSV_COLUMNS）"""
+    ts = datetime.fromtimestamp(entry.ts_ms / 1000).isoformat()
+    return [ts, entry.user_id, entry.trust_score, entry.resource, entry.action, entry.reason]
+
+
+# ========== 后台攒批写入 ==========
+class StreamLogBuffer:
+    """submit() 只入队（满即丢弃并计数）；后台线程每 batch_size 条或 flush_interval 秒调一次 push(entries)。
+    fork 后首次 submit 在子进程里重建队列和线程（同 decision_log.DecisionLogWriter）"""
+
+    def __init__(self, push, max_queue=10000, batch_size=500, flush_interval=0.1):
+        self.push = push
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def submit(self, fields):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(fields)
+        except queue.Full:
+            self._drop(1)
+
+    def _drop(self, n):
+        self.dropped += n
+        BUFFER_DROPPED.inc(n)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, name="access-log-buffer", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def close(self, timeout=2.0):
+        """写出剩余条目；最多等 timeout 秒"""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch, stop = [], False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    fields = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if fields is None:
+                    stop = True
+                    break
+                batch.append(fields)
+            if batch:
+                try:
+                    self.push(batch)
+                    BUFFER_WRITTEN.inc(len(batch))
+                except Exception:
+                    self._drop(len(batch))
+            if stop:
+                return
+
+
+# ========== 脚本内写日志 ==========
+# ARGV（接在评分脚本已有参数之后）：开关(0/1) user_id resource maxlen 三个阈值 四个 reason（""=默认） 风险排行上限
+LOG_OFF_ARGV = ["0", "", "", "0", "0", "0", "0", "", "", "", "", "0"]
+
+
+def script_log_params(user_id, resource, route, maxlen, risk_key, risk_max, stream_key=ACCESS_STREAM_KEY):
+    """route 为 policy_engine.RoutePolicy；返回 (KEYS 尾部 [stream, 风险排行], ARGV 尾部)"""
+    reasons = [d["reason"] if d["reason"] != DEFAULT_REASONS[i] else "" for i, d in enumerate(route.decisions)]
+    return [stream_key, risk_key], [1, user_id, resource or "", maxlen, *route.thresholds, *reasons, risk_max]
@@ -2,24 +2,61 @@
 零信任安全网关 - MVP（报告取证版 / A 档）
 功能点：
 - 统一读取 Bearer Token（Header 优先，Body 备选）
-- 开发期不验签（便于快速跑实验）→ 已留 TODO：可切换为 Keycloak JWKS 严格验签
+- 开发期不验签（便于快速跑实验）→ JWT_VERIFY_MODE=jwks 切换为 Keycloak JWKS 严格验签
+  （token_verifier.py：kid 公钥缓存 + 已验签 claims LRU，两条路由共用 decode_token）
 - 基于上下文的简单信任分计算（IP变更、时间段、频率、设备指纹）
+  已知设备按用户封顶、按最近出现淘汰、可选老化（device_memory.py，DEVICE_MAX_PER_USER / DEVICE_TTL_SECONDS）
+  频率为按前缀配置的真实滑动窗口 / GCRA（rate_limit.py），同一份状态供 /api/user-behavior 读取
+  可选进程内 L1 缓存（l1_cache.py，仅 TRUST_SCORE_MODE=calls）挡在 last_ip / 设备查询前，跨实例经 pub/sub 失效
+  默认一次 EVALSHA 原子完成（trust_script.py），TRUST_SCORE_MODE=calls 回退逐条调用
+  状态存储可插拔（state_backend.py）：STATE_BACKEND=redis | cluster（{user_id} 哈希标签） | memory
 - 决策：allow / allow_restricted / require_mfa / deny，并给出 reason（用于 TopN 统计）
+  阈值 / restrictions / 监控级别 / 敏感前缀按资源前缀配置（policies.yaml → policy_engine.py，热加载）
 - Prometheus 指标：/metrics 暴露 Counter/Histogram（决策数量/延迟）
-- CSV 追加 out/decisions.csv，便于不用 Prometheus 也能做图
+  多 worker 运行（python serve.py，gunicorn）时各 worker 的指标经 multiprocess 目录合并（metrics_export.py）
+  分阶段耗时 zt_stage_latency_seconds{stage} + Redis 命令/往返计数（instrumentation.py）
+  抽样剖析：POST /api/admin/profiling {"sample_every": N} 运行时开关，输出 folded stacks
+- CSV 追加 out/decisions.csv，便于不用 Prometheus 也能做图（decision_log.py 后台批量写，不占请求线程）
+  DECISION_LOG_FORMAT=archive 时改写紧凑列式归档（decision_archive.py，附汇总 CLI 与 CSV 转换）
+- 批量决策 /api/access-request/batch：一次解码 token、一个 pipeline 取状态、一次写日志/指标
+- Redis 慢 / 不可用（resilience.py）：有界连接池 + 超时、断路器、延迟预算内本地降级评分，
+  按前缀 fail-open / fail-closed（policies.yaml on_degraded）；/healthz 与指标报告断路器状态
+  故障注入验证：python fault_redis.py verify（或 proxy 模式放在真实 Redis 前）
+- 每用户行为基线（baseline.py，BASELINE_ENABLED=1 开启，默认关闭）：EWMA 速率 / 24 小时直方图 / 最近 IP 前缀与 ASN，
+  紧凑二进制存于状态 HASH、评分脚本内 O(1) 更新，作为加权信号；常规时段不再按固定规则扣 off_hours
+- 可选短时决策缓存（decision_cache.py，DECISION_CACHE_TTL>0）：同设备 / IP / 资源规则的重复轮询只计频率，
+  不超过 token exp；敏感资源与降级结果不缓存；命中率见 zt_decision_cache_lookups_total；
+  命中也写访问日志流（后台攒批，access_stream.StreamLogBuffer）
+- 每用户风险状态为一个 HASH（user:{id}:state），评分时原子更新
+  批量查询 /api/user-behavior?ids=a,b,c（或 POST {"user_ids": [...]}）：所有用户一个 pipeline 取回
+  风险排行 /api/risky-users?offset=0&limit=50：按最近信任分升序分页（ZSET，随每次决策更新）
+- 访问日志为 Redis Stream access_stream（access_stream.py）：紧凑字段、近似 MAXLEN（ACCESS_STREAM_MAXLEN），
+  单节点脚本路径与评分同一次 EVALSHA 写入；下游用消费者组导出（python stream_exporter.py run）
 """
 
 import os
-import csv
 import time
-import json
-import hashlib
+import atexit
 from datetime import datetime
 from functools import wraps
 
 from flask import Flask, request, jsonify, render_template
-import jwt
-import redis
+
+from access_stream import StreamLogBuffer, encode_entry
+from baseline import NO_ASN, AsnTable, BaselineConfig, ip_prefix_key
+from decision_cache import DEVIATION_FLAGS, DecisionCache, merge_flags
+from decision_log import DecisionLogWriter
+from l1_cache import LocalRiskCache, InvalidationSubscriber
+from rate_limit import parse_rate_limits
+from state_backend import (
+    BACKENDS, ScoreSignals, MemoryStateBackend, RedisStateBackend, RedisClusterStateBackend,
+)
+from token_verifier import KeySourceUnavailable, TokenVerifier
+from device_memory import DevicePolicy
+from instrumentation import instrument_redis, profiler, stage, traced
+from policy_engine import DEFAULT_POLICY_FILE, PolicyEngine
+from resilience import CircuitBreaker, DegradedScorer, ResilientStateBackend, StateUnavailable, make_redis_client
+from scoring import FLAG_DEGRADED, clamp_score, device_fingerprint, is_off_hours, score_from_flags
 
 # ========== 环境变量 ==========
 KEYCLOAK_URL = os.getenv("KEYCLOAK_URL", "http://localhost:8080")
@@ -28,28 +65,112 @@ CLIENT_ID = os.getenv("CLIENT_ID", "my-app")
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 CSV_PATH = os.getenv("CSV_PATH", "out/decisions.csv")
+TRUST_SCORE_MODE = os.getenv("TRUST_SCORE_MODE", "script")  # script | calls
+STATE_BACKEND = os.getenv("STATE_BACKEND", "redis")  # redis | cluster | memory
+MEMORY_BACKEND_STRIPES = int(os.getenv("MEMORY_BACKEND_STRIPES", "64"))
+DEVICE_MAX_PER_USER = int(os.getenv("DEVICE_MAX_PER_USER", "32"))  # 每用户记住的设备数上限，0 = 不限
+DEVICE_TTL_SECONDS = int(os.getenv("DEVICE_TTL_SECONDS", "0"))    # 设备多久未出现即遗忘，0 = 不老化
+DEVICE_FP_BYTES = int(os.getenv("DEVICE_FP_BYTES", "8"))           # 存储的指纹字节数（sha256 截断）
+POLICY_FILE = os.getenv("POLICY_FILE", DEFAULT_POLICY_FILE)  # 默认为本目录的 policies.yaml（与工作目录无关）；不存在则用内置默认并告警
+POLICY_RELOAD_SECONDS = float(os.getenv("POLICY_RELOAD_SECONDS", "5"))  # 0 = 不热加载
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", "0"))  # 每 N 个请求剖析 1 个，0 = 关闭
+PROFILE_DIR = os.getenv("PROFILE_DIR", "out/profiles")
+ADMIN_ROLE = os.getenv("ADMIN_ROLE", "admin")  # 管理接口要求 token 含该 realm 角色
+JWT_VERIFY_MODE = os.getenv("JWT_VERIFY_MODE", "none")  # none（开发期不验签） | jwks
+OIDC_ISSUER = os.getenv("OIDC_ISSUER", f"{KEYCLOAK_URL}/realms/{REALM}")
+JWKS_URL = os.getenv("JWKS_URL", f"{OIDC_ISSUER}/protocol/openid-connect/certs")  # 也可填本地文件路径
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE", CLIENT_ID) or None
+JWKS_REFRESH_SECONDS = int(os.getenv("JWKS_REFRESH_SECONDS", "300"))
+CLAIMS_CACHE_SIZE = int(os.getenv("CLAIMS_CACHE_SIZE", "10000"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "100"))
+BEHAVIOR_BULK_MAX = int(os.getenv("BEHAVIOR_BULK_MAX", "500"))  # 批量行为查询一次最多用户数
+RISKY_USERS_MAX_LIMIT = int(os.getenv("RISKY_USERS_MAX_LIMIT", "500"))
+RATE_LIMIT_ALGO = os.getenv("RATE_LIMIT_ALGO", "sliding_window")  # sliding_window | gcra
+RATE_LIMITS = os.getenv("RATE_LIMITS", "/=30/60")  # 前缀=次数/秒，如 "/admin=10/60,/=30/60"
+L1_CACHE_ENABLED = os.getenv("L1_CACHE_ENABLED", "0") == "1"
+L1_CACHE_SIZE = int(os.getenv("L1_CACHE_SIZE", "10000"))
+L1_CACHE_TTL = float(os.getenv("L1_CACHE_TTL", "30"))
+L1_INVALIDATION_CHANNEL = os.getenv("L1_INVALIDATION_CHANNEL", "zt:l1:invalidate")
+CSV_QUEUE_MAX = int(os.getenv("CSV_QUEUE_MAX", "10000"))
+CSV_BATCH_SIZE = int(os.getenv("CSV_BATCH_SIZE", "500"))
+CSV_FLUSH_INTERVAL = float(os.getenv("CSV_FLUSH_INTERVAL", "1.0"))
+CSV_ROTATE_BYTES = int(os.getenv("CSV_ROTATE_BYTES", "0"))      # 0 = 不按大小轮转
+CSV_ROTATE_SECONDS = int(os.getenv("CSV_ROTATE_SECONDS", "0"))  # 0 = 不按时间轮转
+CSV_OVERFLOW = os.getenv("CSV_OVERFLOW", "drop")                # drop | wait（等 CSV_OVERFLOW_WAIT_MS 后仍满则丢弃）
+CSV_OVERFLOW_WAIT_MS = float(os.getenv("CSV_OVERFLOW_WAIT_MS", "50"))
+DECISION_LOG_FORMAT = os.getenv("DECISION_LOG_FORMAT", "csv")   # csv | archive（列式归档，decision_archive.py）
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH", "out/decisions.zta")
+# 1 = 每个进程写自己的 decisions.<pid>.csv / .zta（多 worker 必须：同一文件只能有一个写者）；serve.py 多 worker 时默认开
+DECISION_LOG_PER_PROCESS = os.getenv("DECISION_LOG_PER_PROCESS", "0") == "1"
+ARCHIVE_CHUNK_ROWS = int(os.getenv("ARCHIVE_CHUNK_ROWS", "65536"))
+ARCHIVE_CHUNK_SECONDS = float(os.getenv("ARCHIVE_CHUNK_SECONDS", "10"))  # 不满一块时最多攒多久
+STATE_LATENCY_BUDGET_MS = float(os.getenv("STATE_LATENCY_BUDGET_MS", "50"))  # 单次状态访问预算，超出按失败计
+REDIS_SOCKET_TIMEOUT_MS = float(os.getenv("REDIS_SOCKET_TIMEOUT_MS", str(STATE_LATENCY_BUDGET_MS)))
+REDIS_CONNECT_TIMEOUT_MS = float(os.getenv("REDIS_CONNECT_TIMEOUT_MS", "200"))
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "64"))          # 每进程最大连接数（gthread 线程数 + 订阅）
+REDIS_POOL_TIMEOUT_MS = float(os.getenv("REDIS_POOL_TIMEOUT_MS", str(STATE_LATENCY_BUDGET_MS)))
+RESILIENCE_ENABLED = os.getenv("RESILIENCE_ENABLED", "1") == "1"  # 断路器 + 降级评分（memory 后端不启用）
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "5"))
+BREAKER_HALF_OPEN_MAX = int(os.getenv("BREAKER_HALF_OPEN_MAX", "1"))
+DEGRADED_PENALTY = int(os.getenv("DEGRADED_PENALTY", "10"))        # 降级评分额外扣分（不确定性）
+DEGRADED_CACHE_USERS = int(os.getenv("DEGRADED_CACHE_USERS", "100000"))
+DECISION_CACHE_TTL = float(os.getenv("DECISION_CACHE_TTL", "0"))  # 秒，0 = 关闭决策缓存；不会超过 token exp
+DECISION_CACHE_USERS = int(os.getenv("DECISION_CACHE_USERS", "100000"))
+BASELINE_ENABLED = os.getenv("BASELINE_ENABLED", "0") == "1"  # 每用户行为基线（baseline.py），默认关闭
+BASELINE_FAST_TAU_SECONDS = int(os.getenv("BASELINE_FAST_TAU_SECONDS", "60"))     # 当前速率的衰减时间常数
+BASELINE_SLOW_TAU_SECONDS = int(os.getenv("BASELINE_SLOW_TAU_SECONDS", "3600"))   # 基线速率的衰减时间常数
+BASELINE_SPIKE_RATIO = float(os.getenv("BASELINE_SPIKE_RATIO", "4"))    # 当前速率超过基线几倍算异常
+BASELINE_SPIKE_MIN_RPM = int(os.getenv("BASELINE_SPIKE_MIN_RPM", "10"))  # 且当前速率至少每分钟这么多次
+BASELINE_WARMUP_EVENTS = int(os.getenv("BASELINE_WARMUP_EVENTS", "50"))  # 速率 / 小时判定前至少积累的事件数
+BASELINE_HOUR_MIN_SHARE = float(os.getenv("BASELINE_HOUR_MIN_SHARE", "0.02"))  # 小时占比低于此值为 unusual_hour
+ASN_DB = os.getenv("ASN_DB", "")  # CSV：network,asn；为空则不做 ASN 判定
+ACCESS_STREAM_MAXLEN = int(os.getenv("ACCESS_STREAM_MAXLEN", "100000"))  # 访问日志流保留条数（近似裁剪）
 
 # ========== Prometheus 指标 ==========
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import Counter, Histogram
+from metrics_export import exporter as metrics_exporter
 DECISIONS = Counter("zt_decisions_total", "Zero Trust decisions", ["action", "reason"])
 LATENCY = Histogram("zt_decision_latency_seconds", "Decision latency seconds")
+BATCH_LATENCY = Histogram("zt_batch_latency_seconds", "Batch decision latency seconds")
+BATCH_SIZE = Histogram("zt_batch_items", "Items per batch decision request",
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
 
 # ========== Flask & Redis ==========
 app = Flask(__name__)
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-
-# ========== TODO（可选，生产化时启用严格验签） ==========
-# from jwt import PyJWKClient
-# OIDC_ISSUER = f"{KEYCLOAK_URL}/realms/{REALM}"
-# JWKS_URL = f"{OIDC_ISSUER}/protocol/openid-connect/certs"
-# _jwk_client = PyJWKClient(JWKS_URL)
-# def decode_and_verify(token: str):
-#     key = _jwk_client.get_signing_key_from_jwt(token).key
-#     return jwt.decode(
-#         token, key, algorithms=["RS256"],
-#         audience=CLIENT_ID, issuer=OIDC_ISSUER,
-#         options={"require": ["exp", "iat", "nbf"], "verify_signature": True}
-#     )
+# 有界连接池 + 读写 / 建连超时：Redis 卡住时单次调用最多阻塞约一个预算（resilience.py）
+redis_client = instrument_redis(make_redis_client(
+    REDIS_HOST, REDIS_PORT,
+    pool_size=REDIS_POOL_SIZE,
+    pool_timeout=REDIS_POOL_TIMEOUT_MS / 1000,
+    socket_timeout=REDIS_SOCKET_TIMEOUT_MS / 1000,
+    connect_timeout=REDIS_CONNECT_TIMEOUT_MS / 1000,
+))
+
+profiler.configure(PROFILE_SAMPLE_EVERY, PROFILE_DIR)
+
+# ========== 令牌验签（JWT_VERIFY_MODE=jwks 时严格验签） ==========
+token_verifier = TokenVerifier(
+    mode=JWT_VERIFY_MODE,
+    jwks_source=JWKS_URL,
+    issuer=OIDC_ISSUER,
+    audience=JWT_AUDIENCE,
+    cache_size=CLAIMS_CACHE_SIZE,
+    refresh_interval=JWKS_REFRESH_SECONDS,
+)
+
+# ========== 策略表（按资源前缀，热加载） ==========
+policy_engine = PolicyEngine(POLICY_FILE, POLICY_RELOAD_SECONDS)
+
+def decode_token(token: str):
+    """两条路由共用的唯一解码入口：命中 claims 缓存时不再重复验签"""
+    return token_verifier.verify(token)
+
+def token_error(e):
+    """解码失败 → (响应体, 状态码)：JWKS 拉不到是 IdP 故障（503），其余才是令牌无效（401）"""
+    if isinstance(e, KeySourceUnavailable):
+        return {"error": f"无法获取签名密钥: {e}"}, 503
+    return {"error": f"令牌无效: {str(e)}"}, 401
 
 # ========== 工具函数 ==========
 def read_bearer_token(req, body_token=None):
@@ -66,133 +187,249 @@ def get_client_ip(req):
         return xff.split(",")[0].strip()
     return req.remote_addr or "0.0.0.0"
 
-def ensure_csv_header(path: str):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    if not os.path.exists(path):
-        with open(path, "w", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["ts", "user_id", "trust_score", "resource", "action", "reason"])
+def build_request_context(req, item):
+    """从请求头 + 请求体（或批量条目）构造信任分上下文"""
+    return {
+        "ip": get_client_ip(req),
+        "user_agent": req.headers.get("User-Agent", ""),
+        "accept_language": req.headers.get("Accept-Language", ""),
+        "resource": item.get("resource", "/") or "/",
+        "sensitive_operation": policy_engine.current().is_sensitive(item.get("resource", "")),
+        # 可选：前端可传 platform/timezone 等补丁
+        "platform": item.get("platform", ""),
+        "timezone": item.get("timezone", ""),
+    }
+
+def http_status_for(action):
+    """返回码：allow/allow_restricted=200；require_mfa=428；deny=403"""
+    if action == "deny":
+        return 403
+    if action == "require_mfa":
+        return 428  # 报告中可统计为 Step-up 次数
+    return 200
+
+# ========== 决策明细 CSV（后台写入） ==========
+CSV_HEADER = ["ts", "user_id", "trust_score", "resource", "action", "reason"]
+def make_decision_log():
+    """DECISION_LOG_FORMAT=csv（默认，CSV_PATH） | archive（ARCHIVE_PATH，列式归档）；队列 / 轮转参数共用；
+    DECISION_LOG_PER_PROCESS=1 时路径加 .<pid>"""
+    options = dict(
+        max_queue=CSV_QUEUE_MAX,
+        batch_size=CSV_BATCH_SIZE,
+        flush_interval=CSV_FLUSH_INTERVAL,
+        rotate_bytes=CSV_ROTATE_BYTES,
+        rotate_seconds=CSV_ROTATE_SECONDS,
+        overflow=CSV_OVERFLOW,
+        wait_timeout=CSV_OVERFLOW_WAIT_MS / 1000,
+        per_process=DECISION_LOG_PER_PROCESS,
+    )
+    if DECISION_LOG_FORMAT == "archive":
+        from decision_archive import ArchiveLogWriter
+        return ArchiveLogWriter(ARCHIVE_PATH, CSV_HEADER, chunk_rows=ARCHIVE_CHUNK_ROWS,
+                                max_chunk_age=ARCHIVE_CHUNK_SECONDS, **options)
+    if DECISION_LOG_FORMAT != "csv":
+        raise ValueError("DECISION_LOG_FORMAT 必须是 csv 或 archive")
+    return DecisionLogWriter(CSV_PATH, CSV_HEADER, **options)
+
+decision_log = make_decision_log()
+atexit.register(decision_log.close)
+
+# ========== 状态后端 ==========
+DEVICE_POLICY = DevicePolicy(DEVICE_MAX_PER_USER, DEVICE_TTL_SECONDS * 1000, DEVICE_FP_BYTES)
+BASELINE_CONFIG = BaselineConfig(
+    BASELINE_FAST_TAU_SECONDS, BASELINE_SLOW_TAU_SECONDS, BASELINE_SPIKE_RATIO, BASELINE_SPIKE_MIN_RPM,
+    BASELINE_WARMUP_EVENTS, round(BASELINE_HOUR_MIN_SHARE * 1000), hour_cap=1024,
+) if BASELINE_ENABLED else None
+asn_table = AsnTable.load(ASN_DB) if ASN_DB else NO_ASN
+
+def make_state_backend(client=None, mode=None, kind=None):
+    """STATE_BACKEND=redis（默认，单节点） | cluster（Redis Cluster，哈希标签） | memory（进程内）
+    显式传入 client 时总是用 Redis 后端（基准 / 测试注入）"""
+    kind = kind or STATE_BACKEND
+    if kind not in BACKENDS:
+        raise ValueError(f"STATE_BACKEND 必须是 {BACKENDS} 之一")
+    rules = parse_rate_limits(RATE_LIMITS)
+    if client is None and kind == "memory":
+        return MemoryStateBackend(RATE_LIMIT_ALGO, rules, stripes=MEMORY_BACKEND_STRIPES,
+                                  device_policy=DEVICE_POLICY, baseline=BASELINE_CONFIG,
+                                  stream_maxlen=ACCESS_STREAM_MAXLEN)
+
+    backend_cls = RedisStateBackend
+    if client is None and kind == "cluster":
+        from redis.cluster import RedisCluster
+        client = instrument_redis(RedisCluster(
+            host=REDIS_HOST, port=REDIS_PORT, decode_responses=True,
+            max_connections=REDIS_POOL_SIZE,
+            socket_timeout=REDIS_SOCKET_TIMEOUT_MS / 1000,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT_MS / 1000,
+        ))
+        backend_cls = RedisClusterStateBackend
+    client = client or redis_client
+    mode = mode or TRUST_SCORE_MODE
+    l1 = subscriber = None
+    if L1_CACHE_ENABLED:
+        if mode == "script":
+            # 脚本路径每次都要一次 EVALSHA，本地缓存省不下往返：只发失效消息（供 calls 模式 / 其他实例）
+            print("⚠️  L1_CACHE_ENABLED=1 只对 TRUST_SCORE_MODE=calls 生效；脚本模式不使用本地缓存，只发布失效消息")
+        l1 = LocalRiskCache(L1_CACHE_SIZE, L1_CACHE_TTL)
+        subscriber = InvalidationSubscriber(client, l1, L1_INVALIDATION_CHANNEL)
+    backend = backend_cls(client, mode, RATE_LIMIT_ALGO, rules,
+                          l1=l1, subscriber=subscriber,
+                          l1_channel=L1_INVALIDATION_CHANNEL if L1_CACHE_ENABLED else "",
+                          device_policy=DEVICE_POLICY, baseline=BASELINE_CONFIG, stream_maxlen=ACCESS_STREAM_MAXLEN)
+    if not RESILIENCE_ENABLED:
+        return backend
+    return ResilientStateBackend(
+        backend,
+        CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, BREAKER_HALF_OPEN_MAX),
+        latency_budget=STATE_LATENCY_BUDGET_MS / 1000,
+        scorer=DegradedScorer(backend.rate_limiter, max_users=DEGRADED_CACHE_USERS, penalty=DEGRADED_PENALTY),
+    )
+
+def make_decision_cache():
+    """DECISION_CACHE_TTL>0 时启用（decision_cache.py），否则 None"""
+    if DECISION_CACHE_TTL <= 0:
+        return None
+    return DecisionCache(DECISION_CACHE_USERS, DECISION_CACHE_TTL)
 
 # ========== 核心类 ==========
 class ZeroTrustGateway:
-    """零信任网关核心：计算信任分 & 执行策略 & 记日志"""
-    def __init__(self):
+    """零信任网关核心：提取信号 & 计算信任分 & 执行策略 & 记日志；状态读写都交给 self.backend"""
+    def __init__(self, client=None, mode=None, backend=None, policies=None, decision_cache=None):
         self.suspicious_ips = set()
         self.user_behavior = {}
+        self.backend = backend or make_state_backend(client, mode)
+        self.policies = policies or policy_engine
+        self.decision_cache = decision_cache if decision_cache is not None else make_decision_cache()
+        self.hit_log = None
+        if self.decision_cache is not None:
+            self.hit_log = StreamLogBuffer(self.backend.push_logs)
+            atexit.register(self.hit_log.close)
+
+    def decide(self, user_id, request_context, token_exp=None):
+        """
+        评分 + 选策略 + 记日志，返回 (信任分, 扣分信号, 决策)
+        启用决策缓存时：稳态的重复请求（同设备 / IP / 资源规则）只计一次频率，跳过完整评分；
+        访问日志条目交给后台攒批写入（状态 HASH / 风险排行不动）；敏感资源不查缓存，降级结果不写缓存（decision_cache.py）
+        """
+        with stage("signal_extract"):
+            signals = self._signals(request_context, datetime.now().hour)
+        route = self.policies.current().match(signals.resource)
+        cache = self.decision_cache
+        if cache is None:
+            return self._decide_uncached(user_id, signals, route)
+        if signals.sensitive:
+            cache.bypass()
+            return self._decide_uncached(user_id, signals, route)
+
+        rule_key = (route.prefix, self.backend.rate_limiter.rule_for(signals.resource).prefix)
+        cached = cache.get(user_id, signals.fingerprint, signals.ip, rule_key)
+        if cached is not None:
+            try:
+                with stage("trust_score"):
+                    volatile = self.backend.count_hit(user_id, signals)
+            except StateUnavailable:
+                cache.invalidate(user_id)
+            else:
+                flags = merge_flags(cached, volatile)
+                trust_score = clamp_score(score_from_flags(flags))
+                with stage("policy"):
+                    policy = route.decide(trust_score)
+                if any(f in DEVIATION_FLAGS for f in volatile):
+                    # 偏离稳态：照常同步写访问日志 / 风险排行
+                    with stage("log_push"):
+                        self._log_access_decision(user_id, trust_score, signals.resource, policy, flags)
+                else:
+                    self.hit_log.submit(encode_entry(user_id, trust_score, signals.resource, policy, flags))
+                return trust_score, flags, policy
+
+        trust_score, flags, policy = self._decide_uncached(user_id, signals, route)
+        cache.put(user_id, signals.fingerprint, signals.ip, rule_key, flags, token_exp)
+        return trust_score, flags, policy
+
+    def _decide_uncached(self, user_id, signals, route):
+        """评分、选策略、写访问日志由后端一起完成（Redis 脚本路径为一次 EVALSHA）"""
+        with stage("trust_score"):
+            return self.backend.score_logged(user_id, signals, route)
 
     def calculate_trust_score(self, user_id, request_context):
         """
         简易信任分：
         - IP 变化：-20
         - 非常规时间（<6 或 >23）：-15
-        - 1分钟频率 > 30：-30
+        - 窗口内频率超限（默认 1 分钟 > 30，按资源前缀可配）：-30
         - 敏感操作：-10
         - 未知设备：-25
         """
-        score = 100
-
-        # 1) IP变化
-        last_ip = redis_client.get(f"user:{user_id}:last_ip")
-        current_ip = request_context.get("ip")
-        if last_ip and last_ip != current_ip:
-            score -= 20
-
-        # 2) 时间段
+        score, _ = self.calculate_trust_score_with_flags(user_id, request_context)
+        return score
+
+    def calculate_trust_score_with_flags(self, user_id, request_context):
+        """返回 (信任分, 触发的扣分信号列表)"""
+        with stage("signal_extract"):
+            signals = self._signals(request_context, datetime.now().hour)
+        return self.backend.score(user_id, signals)
+
+    def calculate_trust_scores_batch(self, user_id, contexts):
+        """同一用户的 N 个上下文：按顺序评分，后端一次往返完成"""
+        if not contexts:
+            return []
         current_hour = datetime.now().hour
-        if current_hour < 6 or current_hour > 23:
-            score -= 15
-
-        # 3) 访问频率（滑动 1 分钟窗口）
-        key_ac = f"user:{user_id}:access_count"
-        access_count = redis_client.incr(key_ac)
-        redis_client.expire(key_ac, 60)
-        if access_count > 30:
-            score -= 30
-
-        # 4) 敏感操作
-        if request_context.get("sensitive_operation"):
-            score -= 10
-
-        # 5) 设备指纹
-        device_fingerprint = self._get_device_fingerprint(request_context)
-        known_device = redis_client.sismember(f"user:{user_id}:devices", device_fingerprint)
-        if not known_device:
-            score -= 25
-            # 学习：把该设备记为认识（仅用于 MVP 演示）
-            redis_client.sadd(f"user:{user_id}:devices", device_fingerprint)
-
-        # 保存状态
-        redis_client.set(f"user:{user_id}:last_ip", current_ip)
-        redis_client.set(f"user:{user_id}:trust_score", score)
-
-        return max(0, min(100, score))
+        return self.backend.score_many(user_id, [self._signals(ctx, current_hour) for ctx in contexts])
+
+    def _signals(self, request_context, current_hour):
+        ip = request_context.get("ip")
+        baseline = BASELINE_CONFIG is not None
+        return ScoreSignals(
+            ip=ip,
+            fingerprint=self._get_device_fingerprint(request_context),
+            off_hours=is_off_hours(current_hour),
+            sensitive=bool(request_context.get("sensitive_operation")),
+            resource=request_context.get("resource"),
+            hour=current_hour,
+            net=ip_prefix_key(ip) if baseline and ip else 0,
+            asn=asn_table.lookup(ip) if baseline and ip else 0,
+        )
 
     def _get_device_fingerprint(self, context):
-        """匿名化设备指纹（最小实现：UA + 语言 + 可选平台/时区）"""
-        raw = "|".join([
-            context.get("user_agent", ""),
-            context.get("accept_language", ""),
-            context.get("platform", ""),
-            context.get("timezone", ""),
-        ])
-        return hashlib.sha256(raw.encode()).hexdigest()
-
-    def enforce_zero_trust_policy(self, user_id, trust_score, resource):
+        """匿名化设备指纹（实现见 scoring.device_fingerprint，离线回放共用）"""
+        return device_fingerprint(context)
+
+    def enforce_zero_trust_policy(self, user_id, trust_score, resource, degraded=False):
+        """选择策略并记录访问日志"""
+        with stage("policy"):
+            policy = self.select_policy(trust_score, resource, degraded)
+        with stage("log_push"):
+            self._log_access_decision(user_id, trust_score, resource, policy, [FLAG_DEGRADED] if degraded else ())
+        return policy
+
+    def select_policy(self, trust_score, resource=None, degraded=False):
         """
-        执行策略 + 返回可解释 reason（用于报告 TopN）
-        映射：
+        信任分 -> 策略 + 可解释 reason（用于报告 TopN），不落日志
+        按 resource 最长前缀取该路由的阈值（默认映射）：
           >=80  : allow / low_risk
           >=60  : allow_restricted / mid_risk_readonly
           >=40  : require_mfa / high_risk_stepup
           else : deny / very_high_risk
+        degraded=True（降级评分）时按该路由的 on_degraded：closed 直接 deny / state_unavailable
+        返回预编译的只读决策对象（不要修改）
         """
-        if trust_score >= 80:
-            policy = {
-                "action": "allow",
-                "restrictions": None,
-                "monitoring_level": "normal",
-                "reason": "low_risk",
-            }
-        elif trust_score >= 60:
-            policy = {
-                "action": "allow_restricted",
-                "restrictions": ["read_only"],
-                "monitoring_level": "enhanced",
-                "reason": "mid_risk_readonly",
-            }
-        elif trust_score >= 40:
-            policy = {
-                "action": "require_mfa",
-                "restrictions": ["minimal_access"],
-                "monitoring_level": "strict",
-                "reason": "high_risk_stepup",
-            }
-        else:
-            policy = {
-                "action": "deny",
-                "restrictions": ["blocked"],
-                "monitoring_level": "alert",
-                "reason": "very_high_risk",
-            }
-
-        self._log_access_decision(user_id, trust_score, resource, policy)
-        return policy
+        return self.policies.current().decide(resource, trust_score, degraded)
 
-    def _log_access_decision(self, user_id, trust_score, resource, decision):
-        entry = {
-            "timestamp": datetime.now().isoformat(),
-            "user_id": user_id,
-            "trust_score": trust_score,
-            "resource": resource,
-            "decision": decision.get("action", ""),
-            "reason": decision.get("reason", ""),
-        }
-        redis_client.lpush("access_logs", json.dumps(entry))
-        redis_client.ltrim("access_logs", 0, 999)
+    def _log_access_decision(self, user_id, trust_score, resource, decision, flags=()):
+        self._log_access_decisions([(user_id, trust_score, resource, decision, flags)])
+
+    def _log_access_decisions(self, records):
+        """records: [(user_id, trust_score, resource, decision, flags), ...]；后端一次写入（含风险排行）"""
+        entries = [encode_entry(*record) for record in records]
+        if entries:
+            # 同一用户多条时以最后一条为准（与状态 HASH 一致）
+            user_scores = {user_id: trust_score for user_id, trust_score, _, _, _ in records}
+            self.backend.push_logs(entries, user_scores)
 
 gateway = ZeroTrustGateway()
 
-# ========== 装饰器（开发期验 token：不验签）==========
+# ========== 装饰器（统一走 decode_token）==========
 def verify_token(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -200,12 +437,13 @@ def verify_token(f):
         if not token:
             return jsonify({"error": "未提供认证令牌"}), 401
         try:
-            # 开发模式：不验签；生产化请切到 decode_and_verify()
-            payload = jwt.decode(token, options={"verify_signature": False})
-            request.user = payload
-            return f(*args, **kwargs)
+            with stage("token_decode"):
+                payload = decode_token(token)
         except Exception as e:
-            return jsonify({"error": f"令牌无效: {str(e)}"}), 401
+            body, status = token_error(e)
+            return jsonify(body), status
+        request.user = payload
+        return f(*args, **kwargs)
     return decorated
 
 # ========== 路由 ==========
@@ -215,21 +453,40 @@ def index():
 
 @app.route("/metrics")
 def metrics():
-    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+    """多 worker 时合并所有 worker 的指标（metrics_export.py）"""
+    payload, content_type = metrics_exporter.render()
+    return payload, 200, {"Content-Type": content_type}
+
+@app.errorhandler(StateUnavailable)
+def state_unavailable(e):
+    """只读查询在状态存储不可用时：503（决策接口不会走到这里，会降级评分）"""
+    return jsonify({"error": f"状态存储不可用: {e}", "degraded": True}), 503
 
 @app.route("/healthz")
 def healthz():
+    """断路器打开时不再 ping，直接报 degraded（200：实例本身仍能降级决策）"""
+    body = {"policy": policy_engine.status()}
+    status = getattr(gateway.backend, "status", None)
+    if status is not None:
+        body.update(status())
+    if gateway.decision_cache is not None:
+        body["decision_cache"] = gateway.decision_cache.status()
     try:
-        redis_client.ping()
-        return jsonify({"status": "ok"}), 200
+        gateway.backend.ping()
+        body["status"] = "ok"
+        return jsonify(body), 200
+    except StateUnavailable as e:
+        body.update(status="degraded", error=str(e))
+        return jsonify(body), 200
     except Exception as e:
-        return jsonify({"status": "err", "error": str(e)}), 500
+        body.update(status="err", error=str(e))
+        return jsonify(body), 500
 
 @app.route("/api/access-request", methods=["POST"])
+@traced("POST /api/access-request")
 def access_request():
     """零信任访问请求（统计友好版）"""
     started = time.time()
-    ensure_csv_header(CSV_PATH)
 
     data = request.get_json(force=True, silent=True) or {}
     token = read_bearer_token(request, data.get("token"))
@@ -238,38 +495,26 @@ def access_request():
         return jsonify({"error": "需要认证令牌"}), 401
 
     try:
-        # 开发模式：不验签；若要严格验签请切换为 decode_and_verify(token)
-        user_info = jwt.decode(token, options={"verify_signature": False})
+        with stage("token_decode"):
+            user_info = decode_token(token)
         user_id = user_info.get("preferred_username", "unknown")
         roles = user_info.get("realm_access", {}).get("roles", [])
     except Exception as e:
-        return jsonify({"error": f"令牌无效: {str(e)}"}), 401
+        body, status = token_error(e)
+        return jsonify(body), status
 
-    request_context = {
-        "ip": get_client_ip(request),
-        "user_agent": request.headers.get("User-Agent", ""),
-        "accept_language": request.headers.get("Accept-Language", ""),
-        "sensitive_operation": (data.get("resource", "") or "/").startswith("/admin"),
-        # 可选：前端可传 platform/timezone 等补丁
-        "platform": data.get("platform", ""),
-        "timezone": data.get("timezone", ""),
-    }
+    with stage("request_context"):
+        request_context = build_request_context(request, data)
 
-    trust_score = gateway.calculate_trust_score(user_id, request_context)
+    trust_score, flags, policy = gateway.decide(user_id, request_context, user_info.get("exp"))
     resource = data.get("resource", "/")
-    policy = gateway.enforce_zero_trust_policy(user_id, trust_score, resource)
+    degraded = FLAG_DEGRADED in flags
 
-    # —— 指标打点 —— #
-    LATENCY.observe(time.time() - started)
     DECISIONS.labels(policy["action"], policy.get("reason", "unknown")).inc()
 
-    # —— 追加 CSV（便于不用 Prometheus 也能画图） —— #
-    try:
-        with open(CSV_PATH, "a", newline="", encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow([datetime.now().isoformat(), user_id, trust_score, resource, policy["action"], policy.get("reason", "")])
-    except Exception:
-        pass
+    # —— 追加 CSV（便于不用 Prometheus 也能画图；只入队，不做文件 I/O） —— #
+    with stage("csv_write"):
+        decision_log.submit([datetime.now().isoformat(), user_id, trust_score, resource, policy["action"], policy.get("reason", "")])
 
     response = {
         "user_id": user_id,
@@ -279,34 +524,174 @@ def access_request():
         "restrictions": policy.get("restrictions", []),
         "monitoring_level": policy["monitoring_level"],
         "reason": policy.get("reason", ""),
+        "degraded": degraded,
         "timestamp": datetime.now().isoformat(),
     }
+    with stage("serialize"):
+        body = jsonify(response)
 
-    # 返回码：allow/allow_restricted=200；require_mfa=428；deny=403
-    action = policy["action"]
-    if action == "deny":
-        code = 403
-    elif action == "require_mfa":
-        code = 428  # 报告中可统计为 Step-up 次数
-    else:
-        code = 200
+    # —— 总延迟：含日志写入与序列化 —— #
+    LATENCY.observe(time.time() - started)
+    return body, http_status_for(policy["action"])
+
+@app.route("/api/access-request/batch", methods=["POST"])
+@traced("POST /api/access-request/batch")
+def access_request_batch():
+    """批量零信任访问请求：items=[{resource, platform, timezone}, ...]，共用一个 token"""
+    started = time.time()
+
+    data = request.get_json(force=True, silent=True) or {}
+    token = read_bearer_token(request, data.get("token"))
+
+    if not token:
+        return jsonify({"error": "需要认证令牌"}), 401
+
+    try:
+        with stage("token_decode"):
+            user_info = decode_token(token)
+        user_id = user_info.get("preferred_username", "unknown")
+        roles = user_info.get("realm_access", {}).get("roles", [])
+    except Exception as e:
+        body, status = token_error(e)
+        return jsonify(body), status
+
+    items = data.get("items")
+    if not isinstance(items, list) or not all(isinstance(it, dict) for it in items):
+        return jsonify({"error": "items 必须是对象数组"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"items 超过上限 {BATCH_MAX_ITEMS}"}), 413
+
+    with stage("request_context"):
+        contexts = [build_request_context(request, it) for it in items]
+    with stage("trust_score"):
+        scored = gateway.calculate_trust_scores_batch(user_id, contexts)
+
+    results = []
+    log_records = []
+    csv_rows = []
+    counts = {}
+    now = datetime.now().isoformat()
+    with stage("policy"):
+        for it, (trust_score, flags) in zip(items, scored):
+            resource = it.get("resource", "/")
+            degraded = FLAG_DEGRADED in flags
+            policy = gateway.select_policy(trust_score, resource, degraded)
+            log_records.append((user_id, trust_score, resource, policy, flags))
+            csv_rows.append([now, user_id, trust_score, resource, policy["action"], policy.get("reason", "")])
+            label = (policy["action"], policy.get("reason", "unknown"))
+            counts[label] = counts.get(label, 0) + 1
+            results.append({
+                "resource": resource,
+                "trust_score": trust_score,
+                "access_decision": policy["action"],
+                "restrictions": policy.get("restrictions", []),
+                "monitoring_level": policy["monitoring_level"],
+                "reason": policy.get("reason", ""),
+                "degraded": degraded,
+                "status": http_status_for(policy["action"]),
+            })
+
+    # —— 日志 / 指标 / CSV 整批一次写入 —— #
+    with stage("log_push"):
+        gateway._log_access_decisions(log_records)
+    BATCH_SIZE.observe(len(items))
+    for (action, reason), n in counts.items():
+        DECISIONS.labels(action, reason).inc(n)
+    with stage("csv_write"):
+        decision_log.submit_many(csv_rows)
+
+    with stage("serialize"):
+        body = jsonify({
+            "user_id": user_id,
+            "roles": roles,
+            "results": results,
+            "timestamp": now,
+        })
+    BATCH_LATENCY.observe(time.time() - started)
+    return body, 200
 
-    return jsonify(response), code
+def behavior_summary(user_id, state):
+    """state: state_backend.UserRisk → /api/user-behavior 的单用户响应"""
+    trust_score = state.trust_score if state.trust_score is not None else 100
+    return {
+        "user_id": user_id,
+        "current_trust_score": int(trust_score),
+        "last_known_ip": state.last_ip or "unknown",
+        "recent_access_count": int(state.access_count),
+        "risk_level": "high" if trust_score < 60 else "medium" if trust_score < 80 else "low",
+        "last_flags": list(state.flags),
+        "last_seen": datetime.fromtimestamp(state.updated_at / 1000).isoformat() if state.updated_at else None,
+    }
+
+def read_user_ids(req):
+    """GET ?ids=a,b,c（可重复 ids=）或 POST {"user_ids": [...]}；去重保序"""
+    if req.method == "POST":
+        data = req.get_json(force=True, silent=True) or {}
+        raw = data.get("user_ids") or []
+        if not isinstance(raw, list):
+            raise ValueError("user_ids 必须是数组")
+    else:
+        raw = [part for value in req.args.getlist("ids") for part in value.split(",")]
+    return list(dict.fromkeys(str(u).strip() for u in raw if str(u).strip()))
 
 @app.route("/api/user-behavior/<user_id>", methods=["GET"])
+@traced("GET /api/user-behavior")
 @verify_token
 def get_user_behavior(user_id):
-    trust_score = redis_client.get(f"user:{user_id}:trust_score") or 100
-    last_ip = redis_client.get(f"user:{user_id}:last_ip") or "unknown"
-    access_count = redis_client.get(f"user:{user_id}:access_count") or 0
+    return jsonify(behavior_summary(user_id, gateway.backend.user_state(user_id)))
 
-    return jsonify({
-        "user_id": user_id,
-        "current_trust_score": int(trust_score),
-        "last_known_ip": last_ip,
-        "recent_access_count": int(access_count),
-        "risk_level": "high" if int(trust_score) < 60 else "medium" if int(trust_score) < 80 else "low"
-    })
+@app.route("/api/user-behavior", methods=["GET", "POST"])
+@traced("bulk /api/user-behavior")
+@verify_token
+def get_user_behavior_bulk():
+    """一次查询多个用户：后端一个 pipeline（HMGET + 频率状态）"""
+    try:
+        user_ids = read_user_ids(request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not user_ids:
+        return jsonify({"error": "需要 ids（GET ?ids=a,b）或 user_ids（POST）"}), 400
+    if len(user_ids) > BEHAVIOR_BULK_MAX:
+        return jsonify({"error": f"一次最多查询 {BEHAVIOR_BULK_MAX} 个用户"}), 400
+    states = gateway.backend.user_states(user_ids)
+    with stage("serialize"):
+        return jsonify({
+            "count": len(user_ids),
+            "users": [behavior_summary(u, st) for u, st in zip(user_ids, states)],
+        })
+
+@app.route("/api/risky-users", methods=["GET"])
+@traced("GET /api/risky-users")
+@verify_token
+def get_risky_users():
+    """风险排行（最近信任分升序）分页：?offset=0&limit=50；每个用户附带完整行为摘要"""
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = min(RISKY_USERS_MAX_LIMIT, max(0, int(request.args.get("limit", 50))))
+    except ValueError:
+        return jsonify({"error": "offset / limit 必须是整数"}), 400
+    total, ranked = gateway.backend.riskiest(offset, limit)
+    user_ids = [user_id for user_id, _ in ranked]
+    states = gateway.backend.user_states(user_ids) if user_ids else []
+    users = []
+    for rank, (user_id, st) in enumerate(zip(user_ids, states), start=offset + 1):
+        users.append({"rank": rank, **behavior_summary(user_id, st)})
+    return jsonify({"total": total, "offset": offset, "limit": limit, "users": users})
+
+@app.route("/api/admin/profiling", methods=["GET", "POST"])
+@verify_token
+def admin_profiling():
+    """抽样剖析开关（仅本进程）：POST {"sample_every": N}，N=0 关闭；GET 查看状态"""
+    roles = request.user.get("realm_access", {}).get("roles", [])
+    if ADMIN_ROLE not in roles:
+        return jsonify({"error": f"需要 {ADMIN_ROLE} 角色"}), 403
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+        try:
+            profiler.configure(sample_every=int(data.get("sample_every", 0)))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": f"sample_every 无效: {e}"}), 400
+    return jsonify(profiler.status())
 
 @app.route("/api/simulate-attack", methods=["POST"])
 def simulate_attack():
@@ -319,10 +704,30 @@ def simulate_attack():
         })
     return jsonify({"message": f"已模拟 {attack_type} 攻击"})
 
+# ========== 进程级初始化（serve.py 调用） ==========
+def warm_up():
+    """主进程（preload）里做一次：输出目录、SCRIPT LOAD、拉 JWKS；worker fork 后直接继承结果"""
+    os.makedirs(os.path.dirname(CSV_PATH) or ".", exist_ok=True)
+    if not gateway.backend.preload():
+        print("⚠️  信任分脚本预加载失败（Redis 未就绪？），将在首次请求时加载")
+    if token_verifier.keys is not None:
+        try:
+            token_verifier.refresh_keys()
+        except Exception as e:
+            print(f"⚠️  JWKS 预取失败（{e}），将在首次验签时拉取")
+
+def init_worker():
+    """每个 worker fork 后调用一次：丢弃从主进程继承的 Redis 连接；
+    JWKS 刷新线程 / 决策日志线程 / L1 订阅线程在本进程首次使用时各自启动"""
+    redis_client.connection_pool.reset()
+    if token_verifier.keys is not None:
+        token_verifier.keys.start()
+
 # ========== 主入口 ==========
 if __name__ == "__main__":
-    os.makedirs(os.path.dirname(CSV_PATH), exist_ok=True)
-    print("🚀 零信任网关启动: http://localhost:5000")
+    # 单进程开发服务器；正式运行用 python serve.py（多 worker + 跨 worker 聚合指标）
+    warm_up()
+    print("🚀 零信任网关启动（单进程）: http://localhost:5000   多 worker：python serve.py")
     print("   健康检查:      /healthz")
     print("   Prom指标:      /metrics")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, threaded=True, debug=os.getenv("FLASK_DEBUG", "0") == "1")
@@ -0,0 +1,445 @@
+"""
+零信任安全网关 - 异步（ASGI）模式
+功能点：
+- /api/access-request、/api/user-behavior/<id>、/healthz、/metrics，决策语义与 app.py 相同
+  （共用 scoring.py 的权重、trust_script 的 Lua、rate_limit 的规则、app.py 的策略表 / 指标 / CSV 写入器）
+- redis.asyncio + BlockingConnectionPool：在途 Redis 调用不再占线程，连接数有上限且可调
+- JWT：claims 缓存命中直接返回；未命中（需 RS256 验签）才丢到线程池，不阻塞事件循环
+- 其余可能阻塞的工作同样不在事件循环里做：策略文件到期检查 / 重新编译、多 worker 指标合并走线程池，
+  决策日志 submit(wait=False) 只入队不等待
+- 纯 ASGI 可调用对象，无额外 Web 框架依赖；uvicorn 运行：
+    python app_async.py            或   uvicorn app_async:app --port 5000
+  ASYNC_WORKERS>1 时启用 prometheus multiprocess 目录，/metrics 合并所有 worker（metrics_export.py），
+  决策日志按 worker 分文件（DECISION_LOG_PER_PROCESS，见 serve.py）
+- 只走 Lua 脚本路径、单节点 Redis key 布局：STATE_BACKEND 不是 redis 时启动即失败（cluster / memory 用 app.py）；
+  批量接口（含批量行为查询 / 风险排行）仍在同步模式里；每次决策同样更新风险排行 ZSET，
+  访问日志流（access_stream.py）与风险排行都在评分的同一次 EVALSHA 内写入
+- 与同步实例共用 Redis 时：L1_CACHE_ENABLED=1 则脚本内照常发布 L1 失效消息（本进程不缓存）
+- 断路器 + 降级评分与同步模式一致（resilience.py，RESILIENCE_ENABLED / BREAKER_* / STATE_LATENCY_BUDGET_MS）：
+  Redis 失败或断路器打开时本地降级评分，flags 带 degraded，按路由 on_degraded 决策，访问日志尽力写入；
+  /healthz 报告断路器状态；行为查询不可用时返回 503
+"""
+
+import os
+import json
+import time
+import asyncio
+from datetime import datetime
+from urllib.parse import unquote
+
+import redis.asyncio as aioredis
+
+from app import (
+    REDIS_HOST, REDIS_PORT, REDIS_SOCKET_TIMEOUT_MS, REDIS_CONNECT_TIMEOUT_MS, RATE_LIMIT_ALGO, RATE_LIMITS, DEVICE_POLICY,
+    BASELINE_CONFIG, ACCESS_STREAM_MAXLEN, STATE_BACKEND, L1_CACHE_ENABLED, L1_INVALIDATION_CHANNEL, asn_table,
+    RESILIENCE_ENABLED, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, BREAKER_HALF_OPEN_MAX,
+    STATE_LATENCY_BUDGET_MS, REDIS_POOL_TIMEOUT_MS, DEGRADED_PENALTY, DEGRADED_CACHE_USERS,
+    DECISIONS, LATENCY, decision_log, policy_engine, token_verifier, token_error, http_status_for, behavior_summary,
+)
+from access_stream import ACCESS_STREAM_KEY, encode_entry, script_log_params
+from baseline import ip_prefix_key
+from l1_cache import invalidation_message, new_instance_id
+from metrics_export import exporter as metrics_exporter, prepare_multiproc_dir
+from rate_limit import RateLimiter, default_key_prefix, parse_rate_limits, now_ms
+from resilience import (
+    CircuitBreaker, DegradedScorer, StateUnavailable, DEGRADED_LOG_DROPS, DEGRADED_SCORES, call_guarded_async,
+)
+from scoring import FLAG_DEGRADED, clamp_score, device_fingerprint, is_off_hours
+from state_backend import RISK_INDEX_KEY, RISK_INDEX_MAX, STATE_FIELDS, ScoreSignals, UserRisk
+from trust_script import TRUST_SCORE_LUA, TrustScoreScript
+
+# ========== 环境变量 ==========
+ASYNC_HOST = os.getenv("ASYNC_HOST", "0.0.0.0")
+ASYNC_PORT = int(os.getenv("ASYNC_PORT", "5000"))
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", "256"))            # 每进程最大连接数
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", str(REDIS_POOL_TIMEOUT_MS / 1000)))  # 等连接的最长秒数
+JWT_VERIFY_THREADS = int(os.getenv("JWT_VERIFY_THREADS", "4"))
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", str(64 * 1024)))
+
+
+# ========== 核心类（异步） ==========
+class AsyncZeroTrustGateway:
+    """与 ZeroTrustGateway 的脚本路径等价的异步实现"""
+
+    def __init__(self, client):
+        self.redis = client
+        self._script = client.register_script(TRUST_SCORE_LUA)
+        self.rate_limiter = RateLimiter(client, RATE_LIMIT_ALGO, parse_rate_limits(RATE_LIMITS))
+        self.instance_id = new_instance_id()
+        self.latency_budget = STATE_LATENCY_BUDGET_MS / 1000
+        self.breaker = None
+        if RESILIENCE_ENABLED:
+            self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, BREAKER_HALF_OPEN_MAX)
+        self.scorer = DegradedScorer(self.rate_limiter, max_users=DEGRADED_CACHE_USERS, penalty=DEGRADED_PENALTY)
+
+    async def preload(self):
+        try:
+            self._script.sha = await self.redis.script_load(TRUST_SCORE_LUA)
+            return True
+        except Exception:
+            return False
+
+    async def decide(self, user_id, request_context, policy):
+        """评分 + 选策略 + 写访问日志流 / 风险排行，一次 EVALSHA；返回 (信任分, 扣分信号, 决策)。
+        policy 为 policy_engine 的当前编译结果（由调用方在事件循环外刷新）。
+        Redis 不可用时同 ResilientStateBackend.score_logged：本地降级评分，按 on_degraded 决策，日志另行尽力写入"""
+        route = policy.match(request_context.get("resource"))
+        signals = self._signals(request_context, datetime.now().hour)
+        now = now_ms()
+        if self.breaker is None:
+            trust_score, flags = await self._score(user_id, signals, route, now)
+            return trust_score, flags, route.decide(trust_score)
+        try:
+            trust_score, flags = await call_guarded_async(self.breaker, self.latency_budget,
+                                                          self._score, user_id, signals, route, now)
+        except StateUnavailable as e:
+            DEGRADED_SCORES.labels(e.cause).inc()
+            trust_score, flags = self.scorer.score(user_id, signals, now)
+            decision = route.decide_degraded(trust_score)
+            await self.push_logs([encode_entry(user_id, trust_score, signals.resource, decision, flags)], {user_id: trust_score})
+            return trust_score, flags, decision
+        self.scorer.remember(user_id, signals.ip, signals.fingerprint)
+        return trust_score, flags, route.decide(trust_score)
+
+    async def calculate_trust_score_with_flags(self, user_id, request_context, route=None):
+        """route（policy_engine.RoutePolicy）非空时脚本内顺带写访问日志；不经断路器"""
+        return await self._score(user_id, self._signals(request_context, datetime.now().hour), route, now_ms())
+
+    def _signals(self, request_context, hour):
+        """同 ZeroTrustGateway._signals"""
+        ip = request_context.get("ip")
+        baseline = BASELINE_CONFIG is not None
+        return ScoreSignals(
+            ip=ip,
+            fingerprint=device_fingerprint(request_context),
+            off_hours=is_off_hours(hour),
+            sensitive=bool(request_context.get("sensitive_operation")),
+            resource=request_context.get("resource"),
+            hour=hour,
+            net=ip_prefix_key(ip) if baseline and ip else 0,
+            asn=asn_table.lookup(ip) if baseline and ip else 0,
+        )
+
+    async def _score(self, user_id, signals, route, now):
+        baseline = None
+        if BASELINE_CONFIG is not None:
+            baseline = (BASELINE_CONFIG, signals.hour, signals.net, signals.asn)
+        log_keys = log_argv = None
+        if route is not None:
+            log_keys, log_argv = script_log_params(user_id, signals.resource, route,
+                                                   ACCESS_STREAM_MAXLEN, RISK_INDEX_KEY, RISK_INDEX_MAX)
+        rule = self.rate_limiter.rule_for(signals.resource)
+        keys = TrustScoreScript._keys(default_key_prefix(user_id), self.rate_limiter.keys(user_id, rule, now),
+                                      log_keys)
+        args = TrustScoreScript._args(
+            signals.ip,
+            signals.fingerprint,
+            signals.off_hours,
+            signals.sensitive,
+            self.rate_limiter.script_args(rule, now),
+            self._l1_notify(user_id),
+            DEVICE_POLICY,
+            baseline,
+            log_argv,
+        )
+        score, flags = TrustScoreScript._parse(await self._script(keys=keys, args=args))
+        return clamp_score(score), flags
+
+    async def push_logs(self, entries, user_scores=None):
+        """同 RedisStateBackend.push_logs（一个 pipeline）；降级路径用，不可用时丢弃并计数"""
+        pipe = self.redis.pipeline(transaction=False)
+        for fields in entries:
+            pipe.xadd(ACCESS_STREAM_KEY, fields, maxlen=ACCESS_STREAM_MAXLEN, approximate=True)
+        if user_scores:
+            pipe.zadd(RISK_INDEX_KEY, user_scores)
+            pipe.zremrangebyrank(RISK_INDEX_KEY, RISK_INDEX_MAX, -1)
+        try:
+            await call_guarded_async(self.breaker, self.latency_budget, pipe.execute)
+        except StateUnavailable:
+            DEGRADED_LOG_DROPS.inc(len(entries))
+
+    def _l1_notify(self, user_id):
+        """同 RedisStateBackend._l1_notify：IP 变化 / 新设备时脚本内 PUBLISH，让同步实例的 L1 失效"""
+        if not L1_CACHE_ENABLED:
+            return None
+        return (L1_INVALIDATION_CHANNEL, invalidation_message(self.instance_id, user_id))
+
+    async def user_behavior(self, user_id):
+        """返回 UserRisk；Redis 不可用 / 断路器打开时抛 StateUnavailable（路由返回 503）"""
+        if self.breaker is None:
+            return await self._user_behavior(user_id)
+        return await call_guarded_async(self.breaker, self.latency_budget, self._user_behavior, user_id)
+
+    async def _user_behavior(self, user_id):
+        """同 RedisStateBackend.user_state，HASH 为空时回读旧版 key"""
+        now = now_ms()
+        prefix = default_key_prefix(user_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmget(f"{prefix}:state", STATE_FIELDS)
+        for key in self.rate_limiter.state_keys(user_id, now):
+            pipe.get(key)
+        raw = await pipe.execute()
+        trust_score, last_ip, updated_at, flags = raw[0]
+        if trust_score is None and last_ip is None:
+            trust_score, last_ip = await self.redis.mget(f"{prefix}:trust_score", f"{prefix}:last_ip")
+        return UserRisk(
+            int(trust_score) if trust_score is not None else None,
+            last_ip,
+            sum(self.rate_limiter.counts_from_state(raw[1:], now).values()),
+            int(updated_at) if updated_at is not None else None,
+            tuple(flags.split(",")) if flags else (),
+        )
+
+
+def check_config():
+    """异步模式只实现了单节点 Redis 的 key 布局：其他状态后端直接拒绝，不悄悄改用单节点布局"""
+    if STATE_BACKEND != "redis":
+        raise RuntimeError(f"异步模式只支持 STATE_BACKEND=redis，当前为 {STATE_BACKEND}；"
+                           "cluster / memory 请用同步模式（app.py / serve.py）")
+
+
+def make_redis():
+    pool = aioredis.BlockingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, decode_responses=True,
+        max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT_MS / 1000, socket_connect_timeout=REDIS_CONNECT_TIMEOUT_MS / 1000,
+        socket_keepalive=True, health_check_interval=30,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+# ========== 请求工具 ==========
+class AsyncRequest:
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.body = body
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+
+    def json(self):
+        try:
+            data = json.loads(self.body or b"{}")
+            return data if isinstance(data, dict) else {}
+        except ValueError:
+            return {}
+
+    def bearer_token(self, body_token=None):
+        """优先读 Authorization: Bearer xxx；否则读 body.token（同 app.read_bearer_token）"""
+        h = self.headers.get("authorization", "")
+        if h.startswith("Bearer "):
+            return h.replace("Bearer ", "", 1).strip()
+        return (body_token or "").strip()
+
+    def client_ip(self):
+        xff = self.headers.get("x-forwarded-for", "")
+        if xff:
+            return xff.split(",")[0].strip()
+        client = self.scope.get("client")
+        return client[0] if client else "0.0.0.0"
+
+
+async def read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_response(send, status, body, content_type="application/json"):
+    if not isinstance(body, (bytes, bytearray)):
+        body = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode()),
+                            (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+# ========== 应用 ==========
+class AsyncGatewayApp:
+    def __init__(self):
+        self.redis = None
+        self.gateway = None
+        self._executor = None
+
+    async def startup(self):
+        from concurrent.futures import ThreadPoolExecutor
+        check_config()
+        self.redis = make_redis()
+        self.gateway = AsyncZeroTrustGateway(self.redis)
+        self._executor = ThreadPoolExecutor(JWT_VERIFY_THREADS, thread_name_prefix="jwt-verify")
+        await self.gateway.preload()
+
+    async def shutdown(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        decision_log.close()
+
+    async def decode_token(self, token):
+        claims = token_verifier.cached(token)
+        if claims is not None:
+            return claims
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, token_verifier.verify, token)
+
+    async def current_policy(self):
+        """策略表到了检查时间就在线程池里 stat / 重新编译，事件循环只取引用"""
+        if policy_engine.reload_due():
+            await asyncio.get_running_loop().run_in_executor(self._executor, policy_engine.reload)
+        return policy_engine.current()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        if self.gateway is None:  # 未走 lifespan 的服务器
+            await self.startup()
+
+        path, method = scope["path"], scope["method"]
+        if path == "/api/access-request" and method == "POST":
+            body = await read_body(receive)
+            if body is None:
+                return await send_response(send, 413, {"error": "请求体过大"})
+            return await self.access_request(AsyncRequest(scope, body), send)
+        if path.startswith("/api/user-behavior/") and method == "GET":
+            user_id = unquote(path[len("/api/user-behavior/"):])
+            return await self.user_behavior(AsyncRequest(scope, b""), user_id, send)
+        if path == "/healthz":
+            return await self.healthz(send)
+        if path == "/metrics":
+            # 多 worker 时要读整个 multiprocess 目录
+            payload, content_type = await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                                     metrics_exporter.render)
+            return await send_response(send, 200, payload, content_type)
+        if path == "/":
+            return await send_response(send, 200, b"<h3>Zero-Trust Gateway (ASGI)</h3>", "text/html; charset=utf-8")
+        return await send_response(send, 404, {"error": "not found"})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    # —— 路由 —— #
+    async def healthz(self, send):
+        """同 app.healthz：断路器打开时不再 ping，直接报 degraded（200：实例本身仍能降级决策）"""
+        gw = self.gateway
+        body = {"policy": policy_engine.status()}
+        if gw.breaker is not None:
+            body.update(breaker=gw.breaker.status(), latency_budget_ms=round(gw.latency_budget * 1000, 3))
+        try:
+            if gw.breaker is None:
+                await self.redis.ping()
+            else:
+                await call_guarded_async(gw.breaker, gw.latency_budget, self.redis.ping)
+            body["status"] = "ok"
+            return await send_response(send, 200, body)
+        except StateUnavailable as e:
+            body.update(status="degraded", error=str(e))
+            return await send_response(send, 200, body)
+        except Exception as e:
+            body.update(status="err", error=str(e))
+            return await send_response(send, 500, body)
+
+    async def access_request(self, req, send):
+        started = time.time()
+        data = req.json()
+        token = req.bearer_token(data.get("token"))
+        if not token:
+            return await send_response(send, 401, {"error": "需要认证令牌"})
+        try:
+            user_info = await self.decode_token(token)
+            user_id = user_info.get("preferred_username", "unknown")
+            roles = user_info.get("realm_access", {}).get("roles", [])
+        except Exception as e:
+            body, status = token_error(e)
+            return await send_response(send, status, body)
+
+        resource = data.get("resource", "/")
+        compiled = await self.current_policy()
+        request_context = {
+            "ip": req.client_ip(),
+            "user_agent": req.headers.get("user-agent", ""),
+            "accept_language": req.headers.get("accept-language", ""),
+            "resource": resource or "/",
+            "sensitive_operation": compiled.is_sensitive(data.get("resource", "")),
+            "platform": data.get("platform", ""),
+            "timezone": data.get("timezone", ""),
+        }
+        trust_score, flags, policy = await self.gateway.decide(user_id, request_context, compiled)
+
+        LATENCY.observe(time.time() - started)
+        DECISIONS.labels(policy["action"], policy.get("reason", "unknown")).inc()
+        decision_log.submit([datetime.now().isoformat(), user_id, trust_score, resource,
+                             policy["action"], policy.get("reason", "")], wait=False)
+
+        response = {
+            "user_id": user_id,
+            "roles": roles,
+            "trust_score": trust_score,
+            "access_decision": policy["action"],
+            "restrictions": policy.get("restrictions", []),
+            "monitoring_level": policy["monitoring_level"],
+            "reason": policy.get("reason", ""),
+            "degraded": FLAG_DEGRADED in flags,
+            "timestamp": datetime.now().isoformat(),
+        }
+        return await send_response(send, http_status_for(policy["action"]), response)
+
+    async def user_behavior(self, req, user_id, send):
+        token = req.bearer_token()
+        if not token:
+            return await send_response(send, 401, {"error": "未提供认证令牌"})
+        try:
+            await self.decode_token(token)
+        except Exception as e:
+            body, status = token_error(e)
+            return await send_response(send, status, body)
+        try:
+            state = await self.gateway.user_behavior(user_id)
+        except StateUnavailable as e:
+            return await send_response(send, 503, {"error": f"状态存储不可用: {e}", "degraded": True})
+        return await send_response(send, 200, behavior_summary(user_id, state))
+
+
+app = AsyncGatewayApp()
+
+# ========== 主入口 ==========
+if __name__ == "__main__":
+    import uvicorn
+
+    check_config()
+    workers = int(os.getenv("ASYNC_WORKERS", "1"))
+    if workers > 1:
+        # worker 是新启动的进程（spawn），重新导入时读到该目录 → 指标跨 worker 合并
+        prepare_multiproc_dir(os.getenv("PROMETHEUS_MULTIPROC_DIR", os.path.join("out", "prometheus-multiproc")))
+        os.environ.setdefault("DECISION_LOG_PER_PROCESS", "1")  # 每个 worker 写自己的决策日志文件（见 serve.py）
+    print(f"🚀 零信任网关（ASGI）启动: http://localhost:{ASYNC_PORT}")
+    uvicorn.run(
+        "app_async:app",
+        host=ASYNC_HOST,
+        port=ASYNC_PORT,
+        workers=workers,
+        loop="auto",            # 装了 uvloop 则自动使用
+        http="auto",            # 装了 httptools 则自动使用
+        backlog=int(os.getenv("ASYNC_BACKLOG", "4096")),
+        timeout_keep_alive=int(os.getenv("ASYNC_KEEPALIVE", "30")),
+        access_log=False,
+    )
@@ -0,0 +1,301 @@
+"""
+每用户行为基线（流式、O(1) 内存 / 每事件 O(1) 更新，不扫历史）
+功能点：
+- 固定规则（<6 或 >23 点、每分钟 > 30 次、任意 IP 变化）不区分用户；基线按用户自己的历史判断“异常”：
+  * 请求速率：两个指数衰减计数（快 ~1 分钟 / 慢 ~1 小时，即不规则时间序列上的 EWMA），
+    快速率 > spike_ratio × 慢速率 且 ≥ spike_min_rpm → rate_anomaly
+  * 24 小时直方图：当前小时占比 < hour_min_share → unusual_hour；占比够高则视为该用户的常规时段，
+    固定规则的 off_hours 不再扣分（夜班员工不会每次都被扣）
+  * 最近 4 个 IP 前缀（IPv4 /24、IPv6 /48）与 4 个 ASN（MRU）：不在其中 → new_network / new_asn
+    （new_network 与同一请求的 ip_change 不重复扣分：已记 ip_change 时去掉，见 scoring.fold_baseline_flags）
+  速率与小时两项在 warmup_events 个事件之后才参与判定；前缀 / ASN 集合非空才参与比较
+- 存储：状态 HASH（user:{id}:state）的 baseline 字段，100 字节定长小端二进制（LAYOUT），
+  评分脚本内读出、判定、写回（trust_script.py，同一次 EVALSHA，原子）
+- baseline_update()：Python 实现（内存后端 / 离线回放 / 基准），与 BASELINE_LUA_FN 逐行对应、结果逐字节一致
+  小时直方图只用整数；速率衰减两边都用 C 库 exp() 后向下取整
+- ASN：可选 ASN_DB（CSV：network,asn，如 203.0.113.0/24,64500），按前缀长度从长到短查表；未配置时 asn=0（不参与）
+"""
+
+import csv
+import math
+import struct
+import ipaddress
+from functools import lru_cache
+from collections import namedtuple
+
+from scoring import FLAG_RATE_ANOMALY, FLAG_UNUSUAL_HOUR, FLAG_NEW_NETWORK, FLAG_NEW_ASN
+
+VERSION = 1
+RECENT_SLOTS = 4
+HOURS = 24
+COUNT_SCALE = 1000          # 衰减计数以 1/1000 事件为单位存整数
+U32_MAX = 0xFFFFFFFF
+U16_MAX = 0xFFFF
+# 版本、保留、事件数（饱和）、上次事件毫秒、快 / 慢衰减计数、24 个小时桶、最近前缀、最近 ASN
+LAYOUT = struct.Struct(f"<BBHQII{HOURS}H{RECENT_SLOTS}I{RECENT_SLOTS}I")
+BASELINE_BYTES = LAYOUT.size
+
+# hour_min_share 以千分比整数传给 Lua，比较只用整数
+BaselineConfig = namedtuple("BaselineConfig", [
+    "fast_tau_s", "slow_tau_s", "spike_ratio", "spike_min_rpm", "warmup_events", "hour_min_permille", "hour_cap",
+])
+DEFAULT_BASELINE = BaselineConfig(fast_tau_s=60, slow_tau_s=3600, spike_ratio=4.0, spike_min_rpm=10,
+                                  warmup_events=50, hour_min_permille=20, hour_cap=1024)
+
+
+def baseline_args(config):
+    """Lua 脚本的配置参数（顺序与 BASELINE_LUA_FN 的 cfg 一致）"""
+    return [config.fast_tau_s, config.slow_tau_s, config.spike_ratio, config.spike_min_rpm,
+            config.warmup_events, config.hour_min_permille, config.hour_cap]
+
+
+# ========== 网络归属 ==========
+def _ipv4_int(ip):
+    """点分十进制 IPv4 的快速解析（规则同 ipaddress：仅 ASCII 数字、无前导零、每段 0..255）；不是则 None"""
+    parts = ip.split(".")
+    if len(parts) != 4:
+        return None
+    value = 0
+    for p in parts:
+        if not (p.isascii() and p.isdigit()) or len(p) > 3 or (len(p) > 1 and p[0] == "0"):
+            return None
+        n = int(p)
+        if n > 255:
+            return None
+        value = value << 8 | n
+    return value
+
+
+@lru_cache(maxsize=65536)
+def ip_prefix_key(ip):
+    """IPv4 /24、IPv6 /48 → 非零 u32；无法解析时 0（不参与比较）"""
+    v4 = _ipv4_int(ip) if isinstance(ip, str) else None
+    if v4 is not None:
+        return (v4 >> 8) + 1
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return 0
+    if addr.version == 4:
+        return (int(addr) >> 8) + 1
+    return ((int(addr) >> 80) % U32_MAX) + 1
+
+
+class AsnTable:
+    """network -> asn；lookup 按前缀长度从长到短各查一次 dict"""
+
+    def __init__(self, entries=()):
+        self._tables = {}   # (version, 前缀长度) -> {网络号: asn}
+        for network, asn in entries:
+            net = ipaddress.ip_network(network, strict=False)
+            self._tables.setdefault((net.version, net.prefixlen), {})[int(net.network_address) >> (
+                net.max_prefixlen - net.prefixlen)] = int(asn)
+        self._order = sorted(self._tables, key=lambda k: -k[1])
+        self.lookup = lru_cache(maxsize=65536)(self._lookup)
+
+    @classmethod
+    def load(cls, path):
+        """CSV：network,asn（可带表头；asn 可写成 AS64500）"""
+        entries = []
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.reader(f):
+                if len(row) < 2 or not row[0].strip() or row[0].startswith("#"):
+                    continue
+                asn = row[1].strip().upper().removeprefix("AS")
+                if not asn.isdigit():
+                    continue  # 表头
+                entries.append((row[0].strip(), int(asn)))
+        return cls(entries)
+
+    def __len__(self):
+        return sum(len(t) for t in self._tables.values())
+
+    def _lookup(self, ip):
+        if not self._order:
+            return 0
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return 0
+        value, bits = int(addr), addr.max_prefixlen
+        for version, plen in self._order:
+            if version == addr.version:
+                asn = self._tables[(version, plen)].get(value >> (bits - plen))
+                if asn is not None:
+                    return asn
+        return 0
+
+
+NO_ASN = AsnTable()
+
+
+# ========== 更新（Python） ==========
+def _decay(count, dt_ms, tau_s):
+    return math.floor(count * math.exp(-dt_ms / (tau_s * 1000.0)))
+
+
+def _recent_push(slots, value):
+    """MRU：value 移到最前，挤掉最旧的；返回新列表"""
+    rest = [v for v in slots if v != value]
+    return [value] + rest[:RECENT_SLOTS - 1]
+
+
+def baseline_update(blob, now, hour, net, asn, config=DEFAULT_BASELINE):
+    """blob：上次写入的字节（空 / 版本不符视为新用户）。先用旧基线判定当前事件，再把事件计入。
+    返回 (新 blob, 当前小时是否为该用户常规时段, [基线信号...])"""
+    if blob and len(blob) == BASELINE_BYTES and blob[0] == VERSION:
+        fields = LAYOUT.unpack(blob)
+    else:
+        fields = (VERSION, 0, 0, now, 0, 0) + (0,) * (HOURS + 2 * RECENT_SLOTS)
+    events, last = fields[2], fields[3]
+    fast, slow = fields[4], fields[5]
+    hist = list(fields[6:6 + HOURS])
+    nets = list(fields[6 + HOURS:6 + HOURS + RECENT_SLOTS])
+    asns = list(fields[6 + HOURS + RECENT_SLOTS:])
+    flags = []
+    warm = events >= config.warmup_events
+
+    # 速率：衰减到 now，计入本次后比较快 / 慢速率（慢速率不含本次）
+    dt = max(0, now - last)
+    fast = _decay(fast, dt, config.fast_tau_s) + COUNT_SCALE
+    slow = _decay(slow, dt, config.slow_tau_s)
+    if (warm and fast * config.slow_tau_s > config.spike_ratio * slow * config.fast_tau_s
+            and fast * 60 >= config.spike_min_rpm * COUNT_SCALE * config.fast_tau_s):
+        flags.append(FLAG_RATE_ANOMALY)
+    slow += COUNT_SCALE
+
+    # 小时直方图
+    total = sum(hist)
+    typical = warm and hist[hour] * 1000 >= config.hour_min_permille * total
+    if warm and not typical:
+        flags.append(FLAG_UNUSUAL_HOUR)
+    hist[hour] += 1
+    if hist[hour] >= config.hour_cap:
+        hist = [h // 2 for h in hist]
+
+    # 最近网络
+    if net and nets[0] and net not in nets:
+        flags.append(FLAG_NEW_NETWORK)
+    if asn and asns[0] and asn not in asns:
+        flags.append(FLAG_NEW_ASN)
+    if net:
+        nets = _recent_push(nets, net)
+    if asn:
+        asns = _recent_push(asns, asn)
+
+    blob = LAYOUT.pack(VERSION, 0, min(events + 1, U16_MAX), now, min(fast, U32_MAX), min(slow, U32_MAX),
+                       *hist, *nets, *asns)
+    return blob, typical, flags
+
+
+def unpack_baseline(blob):
+    """调试 / 基准用：字节 → dict（空或版本不符返回 None）"""
+    if not blob or len(blob) != BASELINE_BYTES or blob[0] != VERSION:
+        return None
+    fields = LAYOUT.unpack(blob)
+    return {
+        "events": fields[2],
+        "last_ms": fields[3],
+        "fast": fields[4] / COUNT_SCALE,
+        "slow": fields[5] / COUNT_SCALE,
+        "hours": list(fields[6:6 + HOURS]),
+        "nets": [n for n in fields[6 + HOURS:6 + HOURS + RECENT_SLOTS] if n],
+        "asns": [a for a in fields[6 + HOURS + RECENT_SLOTS:] if a],
+    }
+
+
+# ========== 更新（Lua，评分脚本内联） ==========
+# baseline_update(blob, now, hour, net, asn, cfg) -> 新 blob, 是否常规时段, {信号...}
+# cfg：{fast_tau_s, slow_tau_s, spike_ratio, spike_min_rpm, warmup_events, hour_min_permille, hour_cap}
+# 只用 string.byte / string.char 编解码（不依赖 struct 库），布局同 LAYOUT
+BASELINE_LUA_FN = f"""
+local function bl_get(s, pos, n)
+  local v = 0
+  for i = n, 1, -1 do v = v * 256 + string.byte(s, pos + i - 1) end
+  return v
+end
+
+local function bl_put(out, v, n)
+  for _ = 1, n do
+    local b = v % 256
+    out[#out + 1] = string.char(b)
+    v = (v - b) / 256
+  end
+end
+
+local function bl_push(slots, value)
+  local out = {{value}}
+  for i = 1, {RECENT_SLOTS} do
+    if #out >= {RECENT_SLOTS} then break end
+    if slots[i] ~= value then out[#out + 1] = slots[i] end
+  end
+  return out
+end
+
+local function bl_has(slots, value)
+  for i = 1, {RECENT_SLOTS} do
+    if slots[i] == value then return true end
+  end
+  return false
+end
+
+local function baseline_update(blob, now, hour, net, asn, cfg)
+  local events, last, fast, slow = 0, now, 0, 0
+  local hist, nets, asns = {{}}, {{}}, {{}}
+  for i = 1, {HOURS} do hist[i] = 0 end
+  for i = 1, {RECENT_SLOTS} do nets[i] = 0; asns[i] = 0 end
+  if blob and #blob == {BASELINE_BYTES} and string.byte(blob, 1) == {VERSION} then
+    events = bl_get(blob, 3, 2)
+    last = bl_get(blob, 5, 8)
+    fast = bl_get(blob, 13, 4)
+    slow = bl_get(blob, 17, 4)
+    for i = 1, {HOURS} do hist[i] = bl_get(blob, 21 + 2 * (i - 1), 2) end
+    for i = 1, {RECENT_SLOTS} do
+      nets[i] = bl_get(blob, {21 + 2 * HOURS} + 4 * (i - 1), 4)
+      asns[i] = bl_get(blob, {21 + 2 * HOURS + 4 * RECENT_SLOTS} + 4 * (i - 1), 4)
+    end
+  end
+  local flags = {{}}
+  local warm = events >= cfg[5]
+
+  local dt = math.max(0, now - last)
+  fast = math.floor(fast * math.exp(-dt / (cfg[1] * 1000.0))) + {COUNT_SCALE}
+  slow = math.floor(slow * math.exp(-dt / (cfg[2] * 1000.0)))
+  if warm and fast * cfg[2] > cfg[3] * slow * cfg[1]
+      and fast * 60 >= cfg[4] * {COUNT_SCALE} * cfg[1] then
+    flags[#flags + 1] = '{FLAG_RATE_ANOMALY}'
+  end
+  slow = slow + {COUNT_SCALE}
+
+  local total = 0
+  for i = 1, {HOURS} do total = total + hist[i] end
+  local h = hour + 1
+  local typical = warm and hist[h] * 1000 >= cfg[6] * total
+  if warm and not typical then
+    flags[#flags + 1] = '{FLAG_UNUSUAL_HOUR}'
+  end
+  hist[h] = hist[h] + 1
+  if hist[h] >= cfg[7] then
+    for i = 1, {HOURS} do hist[i] = math.floor(hist[i] / 2) end
+  end
+
+  if net ~= 0 and nets[1] ~= 0 and not bl_has(nets, net) then
+    flags[#flags + 1] = '{FLAG_NEW_NETWORK}'
+  end
+  if asn ~= 0 and asns[1] ~= 0 and not bl_has(asns, asn) then
+    flags[#flags + 1] = '{FLAG_NEW_ASN}'
+  end
+  if net ~= 0 then nets = bl_push(nets, net) end
+  if asn ~= 0 then asns = bl_push(asns, asn) end
+
+  local out = {{string.char({VERSION}, 0)}}
+  bl_put(out, math.min(events + 1, {U16_MAX}), 2)
+  bl_put(out, now, 8)
+  bl_put(out, math.min(fast, {U32_MAX}), 4)
+  bl_put(out, math.min(slow, {U32_MAX}), 4)
+  for i = 1, {HOURS} do bl_put(out, hist[i], 2) end
+  for i = 1, {RECENT_SLOTS} do bl_put(out, nets[i] or 0, 4) end
+  for i = 1, {RECENT_SLOTS} do bl_put(out, asns[i] or 0, 4) end
+  return table.concat(out), typical, flags
+end
+"""
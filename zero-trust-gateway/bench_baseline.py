@@ -0,0 +1,145 @@
+# bench_baseline.py —— 行为基线的每事件开销：按事件日志逐条回放 baseline_update（baseline.py）
+# 用法：
+#   python bench_baseline.py events.jsonl                       # 事件日志（格式同 replay.py）
+#   python bench_baseline.py --synthetic 200000 --users 2000   # 合成事件：工作时段为主、偶发突发 / 新网段
+#   python bench_baseline.py --synthetic 50000 --lua 5000      # 另用 fakeredis 跑前 N 个事件的 Lua 版本，逐字节比对
+# 基线参数取 BASELINE_* 环境变量（同 app.py）；--asn-db 同 replay.py
+# 输出：ns/事件（只计 baseline_update，另报含 IP 前缀 / ASN 查表的总开销）、每用户字节数、各基线信号触发次数
+# 每用户状态定长（LAYOUT），事件数增加时内存不增长；每事件只做常数次衰减 / 直方图 / 4 槽比较
+import sys
+import time
+import random
+import argparse
+from collections import Counter
+
+import numpy as np
+
+from baseline import BASELINE_BYTES, NO_ASN, AsnTable, baseline_update, ip_prefix_key
+from replay import MS_PER_HOUR, baseline_config_from_env, iter_batches
+from scoring import BASELINE_SIGNALS
+
+
+def synthetic_batches(n, users, seed=7, batch_size=100000):
+    """列式批（同 replay.iter_batches 的 ts_ms/hour/user/ip）；每用户固定工作时段 + 两个常用网段"""
+    rng = random.Random(seed)
+    profiles = [(rng.randrange(6, 12), rng.randrange(8, 11), rng.randrange(1, 250), rng.randrange(1, 250))
+                for _ in range(users)]
+    clock = {u: 1757030400000 + rng.randrange(0, 24) * MS_PER_HOUR for u in range(users)}
+    burst = {}  # user -> 突发剩余事件数（脚本批量拉取）
+    for start in range(0, n, batch_size):
+        m = min(batch_size, n - start)
+        ts, user, ip = np.empty(m, dtype=np.int64), np.empty(m, dtype=object), np.empty(m, dtype=object)
+        for i in range(m):
+            u = rng.randrange(users)
+            first_hour, span, net_a, net_b = profiles[u]
+            if not burst.get(u) and rng.random() < 0.002:
+                burst[u] = 60
+            if burst.get(u):
+                burst[u] -= 1
+                t = clock[u] + rng.randrange(200, 2000)
+            else:
+                t = clock[u] + rng.randrange(30000, 900000)
+            hour = (t // MS_PER_HOUR) % 24
+            if not first_hour <= hour < first_hour + span and rng.random() < 0.97:
+                t += ((first_hour - hour) % 24) * MS_PER_HOUR  # 跳到下一个工作时段
+            clock[u] = t
+            third = net_a if rng.random() < 0.8 else net_b
+            if rng.random() < 0.005:
+                third = rng.randrange(1, 250)
+            ts[i], user[i], ip[i] = t, f"u{u}", f"10.{u % 200}.{third}.{rng.randrange(1, 250)}"
+        yield {"ts_ms": ts, "hour": (ts // MS_PER_HOUR) % 24, "user": user, "ip": ip}
+
+
+def replay_baselines(batches, config, asn_table):
+    """返回 (事件数, 纯更新 ns, 总 ns, {user: blob}, 信号计数, 常规时段事件数)"""
+    blobs, flags_seen, typical_n = {}, Counter(), 0
+    n = update_ns = total_ns = 0
+    for batch in batches:
+        users, ips, ts, hours = batch["user"], batch["ip"], batch["ts_ms"], batch["hour"]
+        t_total = time.perf_counter_ns()
+        for i in range(len(users)):
+            user, ip = users[i], ips[i]
+            net, asn = ip_prefix_key(ip), asn_table.lookup(ip)
+            t0 = time.perf_counter_ns()
+            blob, typical, flags = baseline_update(blobs.get(user, b""), int(ts[i]), int(hours[i]), net, asn, config)
+            update_ns += time.perf_counter_ns() - t0
+            blobs[user] = blob
+            typical_n += typical
+            flags_seen.update(flags)
+        total_ns += time.perf_counter_ns() - t_total
+        n += len(users)
+    return n, update_ns, total_ns, blobs, flags_seen, typical_n
+
+
+def lua_check(batches, limit, config, asn_table):
+    """前 limit 个事件经 BaselineHitScript（fakeredis + lupa）再跑一遍：信号与最终 blob 须与 Python 版一致"""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("需要 fakeredis：pip install fakeredis lupa")
+    from trust_script import BaselineHitScript
+    from rate_limit import default_key_prefix
+
+    server = fakeredis.FakeServer()
+    script = BaselineHitScript(fakeredis.FakeRedis(server=server, decode_responses=True))
+    raw = fakeredis.FakeRedis(server=server)  # blob 是二进制，不解码
+    blobs, mismatches, done, elapsed = {}, 0, 0, 0.0
+    for batch in batches:
+        for i in range(len(batch["user"])):
+            if done >= limit:
+                break
+            user, ip, now, hour = batch["user"][i], batch["ip"][i], int(batch["ts_ms"][i]), int(batch["hour"][i])
+            net, asn = ip_prefix_key(ip), asn_table.lookup(ip)
+            blobs[user], typical, flags = baseline_update(blobs.get(user, b""), now, hour, net, asn, config)
+            t0 = time.perf_counter()
+            _, lua_typical, lua_flags = script.run(user, now, baseline=(config, hour, net, asn))
+            elapsed += time.perf_counter() - t0
+            mismatches += (lua_typical, lua_flags) != (typical, flags)
+            done += 1
+    for user, blob in blobs.items():
+        mismatches += raw.hget(f"{default_key_prefix(user)}:state", "baseline") != blob
+    return done, mismatches, elapsed
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="行为基线每事件开销（回放）")
+    ap.add_argument("inputs", nargs="*", help="事件日志：.jsonl 或 decisions.csv 风格 CSV")
+    ap.add_argument("--synthetic", type=int, default=0, help="不读日志，生成 N 个合成事件")
+    ap.add_argument("--users", type=int, default=1000, help="合成事件的用户数")
+    ap.add_argument("--asn-db", default="", help="CSV：network,asn")
+    ap.add_argument("--batch-size", type=int, default=100000)
+    ap.add_argument("--lua", type=int, default=0, help="前 N 个事件另跑 Lua 版本并比对")
+    args = ap.parse_args(argv)
+    if not args.inputs and not args.synthetic:
+        ap.error("需要事件日志或 --synthetic N")
+
+    config = baseline_config_from_env()
+    asn_table = AsnTable.load(args.asn_db) if args.asn_db else NO_ASN
+
+    def batches():
+        if args.synthetic:
+            return synthetic_batches(args.synthetic, args.users, batch_size=args.batch_size)
+        return iter_batches(args.inputs, args.batch_size)
+
+    n, update_ns, total_ns, blobs, flags_seen, typical_n = replay_baselines(batches(), config, asn_table)
+    if not n:
+        print("没有事件")
+        return 1
+    print(f"回放 {n} 个事件 / {len(blobs)} 个用户")
+    print(f"  baseline_update     {update_ns / n:>8.0f} ns/事件")
+    print(f"  含前缀 / ASN 查表   {total_ns / n:>8.0f} ns/事件（{n / (total_ns / 1e9):,.0f} 事件/s）")
+    print(f"  每用户状态          {BASELINE_BYTES:>8d} 字节（合计 {BASELINE_BYTES * len(blobs) / 1024:.1f} KiB）")
+    print(f"  常规时段事件        {typical_n / n:>8.1%}（off_hours 不再扣分）")
+    for flag in BASELINE_SIGNALS:
+        print(f"  {flag:<20}{flags_seen[flag]:>8d}（{flags_seen[flag] / n:.2%}）")
+
+    if args.lua:
+        done, mismatches, elapsed = lua_check(batches(), args.lua, config, asn_table)
+        print(f"\nLua（fakeredis）{done} 个事件：{elapsed / done * 1e6:.0f} µs/事件（含往返模拟），"
+              f"{'✅ 与 Python 版逐字节一致' if not mismatches else f'❌ {mismatches} 处不一致'}")
+        return 1 if mismatches else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
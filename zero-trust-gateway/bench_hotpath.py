@@ -0,0 +1,235 @@
+# bench_hotpath.py —— 决策热路径微基准 + 回归对比（不依赖 Redis/Keycloak）
+# 用法：
+#   python bench_hotpath.py run --out out/bench_baseline.json          # 记录基线
+#   python bench_hotpath.py compare out/bench_baseline.json            # 现跑一遍并对比，退化超阈值则退出码 1
+#   python bench_hotpath.py compare base.json current.json --threshold 0.15
+# 状态后端：fakeredis（pip install fakeredis lupa；lupa 用于 Lua 脚本路径）；另测一项进程内后端（memory）
+# 指标：ops/s（多轮取最好）、ns_per_op（同一最好轮）、ns_noise（各轮中位数与最好轮之差，本机噪声估计）、
+#       alloc_peak_bytes（N 次调用期间 tracemalloc 峰值增量）、retained_bytes_per_op（N 次调用后仍未释放的内存 / N）
+# 判定退化：单次耗时超过 基线 × (1 + threshold) + 噪声下限；噪声下限取 TIME_SLACK_NS 与两边 ns_noise 的最大值，
+# 亚微秒级阶段（select_policy 等）差几十 ns 就是百分之几十，只按相对值比较会误报
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+# 在导入 app 之前固定环境：临时 CSV、不启用可选缓存
+_TMP = tempfile.mkdtemp(prefix="zt-bench-")
+os.environ.setdefault("CSV_PATH", os.path.join(_TMP, "decisions.csv"))
+os.environ.setdefault("L1_CACHE_ENABLED", "0")
+
+try:
+    import fakeredis
+except ImportError:  # pragma: no cover - 仅提示
+    sys.exit("需要 fakeredis：pip install fakeredis lupa")
+
+import jwt
+import app as gw_app
+
+ALLOC_ITERATIONS = 200
+ALLOC_SLACK_BYTES = 1024
+TIME_SLACK_NS = 250     # 单次耗时的绝对容差：计时器 / 调度抖动量级
+DEFAULT_REPEAT = 9      # 多轮取最好：轮数越多，最好轮越接近无干扰时的耗时
+DEFAULT_MIN_TIME = 0.2  # 每轮最少运行秒数
+
+
+# ====== 场景准备 ======
+def make_fixture():
+    client = fakeredis.FakeRedis(decode_responses=True)
+    gw_app.redis_client = client
+    gw_app.gateway = gw_app.ZeroTrustGateway(client=client)
+    token = jwt.encode({"preferred_username": "bench", "realm_access": {"roles": ["user"]},
+                        "exp": int(time.time()) + 86400}, None, algorithm="none")
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "X-Forwarded-For": "203.0.113.7, 10.0.0.1",
+        "User-Agent": "Mozilla/5.0 bench",
+        "Accept-Language": "zh-CN",
+    }
+    return client, token, headers
+
+
+def build_stages():
+    client, token, headers = make_fixture()
+    gateway = gw_app.gateway
+    flask_app = gw_app.app
+    req_ctx = flask_app.test_request_context("/api/access-request", method="POST", headers=headers)
+    req_ctx.push()
+    req = req_ctx.request
+    test_client = flask_app.test_client()
+    context = {"ip": "203.0.113.7", "user_agent": "Mozilla/5.0 bench", "accept_language": "zh-CN",
+               "resource": "/finance/report", "sensitive_operation": False}
+    policy = gateway.select_policy(75)
+    mem_gateway = gw_app.ZeroTrustGateway(backend=gw_app.make_state_backend(kind="memory"))
+    counter = [0]
+
+    def trust_score():
+        counter[0] += 1
+        gateway.calculate_trust_score(f"bench-{counter[0] % 64}", context)
+
+    def trust_score_memory():
+        counter[0] += 1
+        mem_gateway.calculate_trust_score(f"bench-{counter[0] % 64}", context)
+
+    return {
+        "read_bearer_token": lambda: gw_app.read_bearer_token(req),
+        "get_client_ip": lambda: gw_app.get_client_ip(req),
+        "device_fingerprint": lambda: gateway._get_device_fingerprint(context),
+        "calculate_trust_score": trust_score,
+        "calculate_trust_score_memory": trust_score_memory,
+        "select_policy": lambda: gateway.select_policy(75, "/finance/report"),
+        "enforce_zero_trust_policy": lambda: gateway.enforce_zero_trust_policy("bench", 75, "/finance/report"),
+        "log_access_decision": lambda: gateway._log_access_decision("bench", 75, "/finance/report", policy),
+        "flask_access_request": lambda: test_client.post(
+            "/api/access-request", json={"resource": "/finance/report"}, headers=headers),
+    }
+
+
+# ====== 测量 ======
+def measure_ops(fn, min_time, repeat):
+    """返回各轮的 ops/s（降序，第一个即最好轮）"""
+    rounds = []
+    for _ in range(repeat):
+        n = 0
+        t0 = time.perf_counter()
+        deadline = t0 + min_time
+        while True:
+            for _ in range(50):
+                fn()
+            n += 50
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+        rounds.append(n / (now - t0))
+    return sorted(rounds, reverse=True)
+
+
+def ns_per_op(ops_per_sec):
+    return 1e9 / ops_per_sec if ops_per_sec else 0.0
+
+
+def measure_alloc(fn, iterations=ALLOC_ITERATIONS):
+    fn()  # 预热：排除首次调用的惰性初始化
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for _ in range(iterations):
+            fn()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(0, peak - base), max(0, current - base) / iterations
+
+
+def run_suite(min_time=DEFAULT_MIN_TIME, repeat=DEFAULT_REPEAT, only=None):
+    results = {}
+    for name, fn in build_stages().items():
+        if only and name not in only:
+            continue
+        fn()
+        rounds = measure_ops(fn, min_time, repeat)
+        ops = rounds[0]
+        median = rounds[len(rounds) // 2]
+        peak, retained = measure_alloc(fn)
+        results[name] = {
+            "ops_per_sec": round(ops, 1),
+            "ns_per_op": round(ns_per_op(ops), 1),
+            "ns_noise": round(ns_per_op(median) - ns_per_op(ops), 1),
+            "alloc_peak_bytes": int(peak),
+            "retained_bytes_per_op": round(retained, 1),
+        }
+        print(f"{name:<28}{ops:>14,.0f} ops/s{peak:>12,} B peak{retained:>10.1f} B/op retained")
+    return {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "min_time": min_time,
+            "repeat": repeat,
+        },
+        "stages": results,
+    }
+
+
+def time_slack_ns(base, now):
+    """该阶段的噪声下限：固定容差与两次测量各自噪声估计的最大值（旧版结果没有 ns_noise，按 0）"""
+    return max(TIME_SLACK_NS, base.get("ns_noise", 0.0), now.get("ns_noise", 0.0))
+
+
+def compare(baseline, current, threshold):
+    """返回退化列表：单次耗时超过 基线 × (1 + threshold) + 噪声下限，或分配峰值超过
+    基线 × (1 + threshold) + ALLOC_SLACK_BYTES，视为退化"""
+    regressions = []
+    print(f"\n{'stage':<28}{'base ops/s':>14}{'now ops/s':>14}{'Δ':>8}{'base peak':>12}{'now peak':>12}")
+    for name, base in baseline["stages"].items():
+        now = current["stages"].get(name)
+        if now is None:
+            print(f"{name:<28}{'(缺失)':>14}")
+            continue
+        delta = now["ops_per_sec"] / base["ops_per_sec"] - 1 if base["ops_per_sec"] else 0.0
+        base_ns, now_ns = ns_per_op(base["ops_per_sec"]), ns_per_op(now["ops_per_sec"])
+        mark = ""
+        if base_ns and now_ns > base_ns * (1 + threshold) + time_slack_ns(base, now):
+            regressions.append(f"{name}: 吞吐下降 {-delta:.0%}（{base_ns:,.0f} -> {now_ns:,.0f} ns/op）")
+            mark = "  ⚠ 吞吐"
+        alloc_limit = base["alloc_peak_bytes"] * (1 + threshold) + ALLOC_SLACK_BYTES
+        if now["alloc_peak_bytes"] > alloc_limit:
+            regressions.append(f"{name}: 分配峰值 {base['alloc_peak_bytes']} -> {now['alloc_peak_bytes']} B")
+            mark += "  ⚠ 分配"
+        print(f"{name:<28}{base['ops_per_sec']:>14,.0f}{now['ops_per_sec']:>14,.0f}{delta:>+8.0%}"
+              f"{base['alloc_peak_bytes']:>12,}{now['alloc_peak_bytes']:>12,}{mark}")
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="网关热路径微基准")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_run = sub.add_parser("run", help="跑基准并写 JSON")
+    p_run.add_argument("--out", default="out/bench_baseline.json")
+    p_run.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME, help="每轮最少运行秒数")
+    p_run.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="轮数，取最好一轮")
+    p_run.add_argument("--only", nargs="*", help="只跑指定阶段")
+
+    p_cmp = sub.add_parser("compare", help="与基线对比，退化则退出码 1")
+    p_cmp.add_argument("baseline")
+    p_cmp.add_argument("current", nargs="?", help="已有结果 JSON；省略则现跑一遍")
+    p_cmp.add_argument("--threshold", type=float, default=0.15,
+                       help="允许的相对退化（默认 15%%），另加每阶段的绝对噪声下限")
+    p_cmp.add_argument("--min-time", type=float, default=DEFAULT_MIN_TIME)
+    p_cmp.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "run":
+        result = run_suite(args.min_time, args.repeat, args.only)
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已写入 {args.out}")
+        return 0
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current, "r", encoding="utf-8") as f:
+            current = json.load(f)
+    else:
+        current = run_suite(args.min_time, args.repeat, list(baseline["stages"]))
+    regressions = compare(baseline, current, args.threshold)
+    if regressions:
+        print("\n❌ 性能退化：")
+        for r in regressions:
+            print(f" - {r}")
+        return 1
+    print("\n✅ 无超过阈值的退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+# bench_trust_score.py —— 对比信任分两条路径：逐条调用（calls） vs 单次 EVALSHA（script）
+# 用法：python bench_trust_score.py [-n 5000] [--users 50]
+# 需要可访问的 Redis（REDIS_HOST/REDIS_PORT，与 app.py 一致）；基准 key 前缀为 bench-*
+import argparse
+import time
+
+import redis
+
+from app import REDIS_HOST, REDIS_PORT, ZeroTrustGateway
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(round(p / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[idx]
+
+
+def run_path(client, mode, n, users):
+    gw = ZeroTrustGateway(client=client, mode=mode)
+    gw.backend.preload()
+    contexts = [
+        {"ip": f"10.0.{i % 4}.{i % 200}", "user_agent": f"bench-ua-{i % 3}",
+         "accept_language": "zh-CN", "sensitive_operation": i % 5 == 0}
+        for i in range(64)
+    ]
+    samples = []
+    t_start = time.perf_counter()
+    for i in range(n):
+        user_id = f"bench-{mode}-{i % users}"
+        t0 = time.perf_counter()
+        gw.calculate_trust_score_with_flags(user_id, contexts[i % len(contexts)])
+        samples.append((time.perf_counter() - t0) * 1000)
+    elapsed = time.perf_counter() - t_start
+    samples.sort()
+    return {
+        "mode": mode,
+        "ops_per_sec": n / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 50),
+        "p99_ms": percentile(samples, 99),
+    }
+
+
+def cleanup(client):
+    keys = list(client.scan_iter("user:bench-*"))
+    if keys:
+        client.delete(*keys)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="信任分 calls vs script 基准")
+    ap.add_argument("-n", type=int, default=5000, help="每条路径调用次数")
+    ap.add_argument("--users", type=int, default=50, help="轮换的用户数")
+    args = ap.parse_args()
+
+    client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+    client.ping()
+    cleanup(client)
+    try:
+        results = [run_path(client, mode, args.n, args.users) for mode in ("calls", "script")]
+    finally:
+        cleanup(client)
+
+    print(f"{'mode':<8}{'ops/s':>12}{'p50(ms)':>10}{'p99(ms)':>10}")
+    for r in results:
+        print(f"{r['mode']:<8}{r['ops_per_sec']:>12.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}")
+    base, fast = results
+    if base["ops_per_sec"]:
+        print(f"\nscript / calls 吞吐比: {fast['ops_per_sec'] / base['ops_per_sec']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,532 @@
+# decision_archive.py —— 决策明细的紧凑列式归档 + 向量化汇总 CLI
+# 用法：
+#   python decision_archive.py convert out/decisions.csv out/decisions.zta      # CSV → 归档（可重复追加）
+#   python decision_archive.py info out/decisions.zta
+#   python decision_archive.py summary out/decisions.zta --top 10 --out-dir out/report
+#   python decision_archive.py summary out/*.zta --since 2025-09-05T19:00 --until 2025-09-06
+#   python decision_archive.py summary out/decisions.*.zta     # 多 worker 各写一个文件（serve.py），汇总时一起传
+#
+# 为什么不用 CSV：一行一次文本解析，几百万行扫一遍要几十秒，文件也大。归档按列存定宽类型：
+#   ts_ms int64 | trust_score int16 | latency_us uint32 | 其余（user/resource/action/reason/group/status）
+#   为字典编码的整数，每行约 27 字节；读取时 mmap + np.frombuffer，不做逐行解析。
+# 两种 CSV 行都能转换：run_all.py 的 9 列（含 group/latency_ms/http_status）与网关写的 6 列
+# （缺失列：group/status 为空串，trust_score / latency 记为缺失值）。
+#
+# 文件布局（小端）：
+#   文件头  b"ZTDA" + u16 版本 + 2 字节保留
+#   块 * N  块头 <4sIIQ4x>（b"CHNK", 行数, 字典增量字节数, 块体字节数）
+#           + 字典增量（JSON：{列名: [本块新出现的字符串, ...]}，编码 = 该列字典里的序号）
+#           + 各列数组（按 COLUMNS 顺序，每列补齐到 8 字节）
+# 字典只追加不重排：老块里的编码永远有效，读取方按块顺序重放增量即可。
+# 写到一半崩溃留下的残块：读取时忽略，追加写入前截掉。
+# 单写者：字典编码是写入进程私有的，追加前还会截断文件 —— 两个进程写同一归档会互相破坏。
+#   多进程各写各的（DECISION_LOG_PER_PROCESS / 导出器的 {consumer} 路径），汇总时多文件字典各自映射后合并。
+import os
+import sys
+import csv
+import json
+import mmap
+import time
+import struct
+import argparse
+
+import numpy as np
+
+from decision_log import ROWS_WRITTEN, WRITE_ERRORS, DecisionLogWriter
+from replay import GATEWAY_CSV_COLUMNS, wall_clock_ms
+
+MAGIC = b"ZTDA"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sH2x")
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct("<4sIIQ4x")
+ALIGN = 8
+
+# (列名, dtype, 是否字典编码)
+COLUMNS = (
+    ("ts_ms", "<i8", False),
+    ("user", "<u4", True),
+    ("resource", "<u4", True),
+    ("group", "<u2", True),
+    ("status", "<u2", True),
+    ("action", "<u1", True),
+    ("reason", "<u2", True),
+    ("trust_score", "<i2", False),
+    ("latency_us", "<u4", False),
+)
+DICT_COLUMNS = tuple(name for name, _, coded in COLUMNS if coded)
+MISSING_SCORE = -32768
+MISSING_LATENCY = np.iinfo(np.uint32).max
+
+# 源 CSV 列名 → 归档列名（run_all.py 的 9 列表头是全集）
+SOURCE_FIELDS = {
+    "ts": "ts_ms", "group": "group", "user_id": "user", "trust_score": "trust_score",
+    "resource": "resource", "action": "action", "reason": "reason",
+    "latency_ms": "latency_us", "http_status": "status",
+}
+RUN_ALL_CSV_COLUMNS = ["ts", "group", "user_id", "trust_score", "resource", "action", "reason",
+                       "latency_ms", "http_status"]
+
+
+def _pad(n):
+    return -n % ALIGN
+
+
+def _int_or(value, missing):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return missing
+
+
+def _latency_us(value):
+    try:
+        return min(int(round(float(value) * 1000)), MISSING_LATENCY - 1)
+    except (TypeError, ValueError):
+        return MISSING_LATENCY
+
+
+# ====== 写入 ======
+class ArchiveWriter:
+    """按块追加写入；rows 为与 fields 对齐的序列（fields 取自 SOURCE_FIELDS 的键）。
+    缓冲满 chunk_rows 行写一块；flush() 把未满的缓冲也写成一块"""
+
+    def __init__(self, path, fields=tuple(RUN_ALL_CSV_COLUMNS), chunk_rows=65536):
+        unknown = set(fields) - set(SOURCE_FIELDS)
+        if unknown:
+            raise ValueError(f"未知字段 {sorted(unknown)}，可用：{list(SOURCE_FIELDS)}")
+        self.path = path
+        self.fields = list(fields)
+        self.chunk_rows = chunk_rows
+        self.rows_written = 0
+        self._buf = {f: [] for f in self.fields}
+        self._pending = 0
+        self._dicts = {name: {} for name in DICT_COLUMNS}
+        self._file = self._open(path)
+
+    def _open(self, path):
+        d = os.path.dirname(path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            f = open(path, "wb")
+            f.write(FILE_HEADER.pack(MAGIC, VERSION))
+            return f
+        # 已有归档：重放字典增量，截掉末尾残块后接着写
+        with ArchiveReader(path) as reader:
+            for name in DICT_COLUMNS:
+                self._dicts[name] = {v: i for i, v in enumerate(reader.dicts[name])}
+            end = reader.end
+        f = open(path, "r+b")
+        f.truncate(end)
+        f.seek(end)
+        return f
+
+    def writerow(self, row):
+        self.writerows([row])
+
+    def writerows(self, rows):
+        for row in rows:
+            for f, v in zip(self.fields, row):
+                self._buf[f].append(v)
+            self._pending += 1
+            if self._pending >= self.chunk_rows:
+                self._write_chunk()
+
+    def tell(self):
+        return self._file.tell()
+
+    def flush(self):
+        if self._pending:
+            self._write_chunk()
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _encode(self, name, values):
+        """字典编码：按去重值查字典，新值追加；返回 (编码数组, 本块新增字符串)"""
+        dtype = dict((n, t) for n, t, _ in COLUMNS)[name]
+        uniq, inv = np.unique(np.array(values, dtype=str), return_inverse=True)
+        table = self._dicts[name]
+        added = []
+        codes = np.empty(len(uniq), dtype=np.int64)
+        for i, v in enumerate(uniq.tolist()):
+            code = table.get(v)
+            if code is None:
+                code = table[v] = len(table)
+                added.append(v)
+            codes[i] = code
+        if len(table) > np.iinfo(dtype).max + 1:
+            raise ValueError(f"列 {name} 的不同取值超过 {np.dtype(dtype)} 上限")
+        return codes[inv].astype(dtype), added
+
+    def _write_chunk(self):
+        n = self._pending
+        buf, self._buf = self._buf, {f: [] for f in self.fields}
+        self._pending = 0
+        src = {SOURCE_FIELDS[f]: vals for f, vals in buf.items()}
+
+        arrays, delta = {}, {}
+        for name, dtype, coded in COLUMNS:
+            values = src.get(name)
+            if coded:
+                values = ["" if v is None else str(v) for v in values] if values is not None else [""] * n
+                arrays[name], added = self._encode(name, values)
+                if added:
+                    delta[name] = added
+            elif name == "ts_ms":
+                arrays[name] = wall_clock_ms(values).astype(dtype)
+            elif name == "trust_score":
+                arrays[name] = np.array([_int_or(v, MISSING_SCORE) for v in values] if values is not None
+                                        else np.full(n, MISSING_SCORE), dtype=dtype)
+            else:
+                arrays[name] = np.array([_latency_us(v) for v in values] if values is not None
+                                        else np.full(n, MISSING_LATENCY), dtype=dtype)
+
+        dict_bytes = json.dumps(delta, ensure_ascii=False, separators=(",", ":")).encode() if delta else b""
+        body = bytearray()
+        for name, _, _ in COLUMNS:
+            raw = arrays[name].tobytes()
+            body += raw + b"\0" * _pad(len(raw))
+        self._file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, n, len(dict_bytes), len(body)))
+        self._file.write(dict_bytes + b"\0" * _pad(len(dict_bytes)))
+        self._file.write(body)
+        self.rows_written += n
+
+
+class ArchiveLogWriter(DecisionLogWriter):
+    """网关的后台写入器换成列式归档（DECISION_LOG_FORMAT=archive）：队列 / 批量 / 轮转 / 溢出策略不变，
+    每批行先进内存缓冲，满 chunk_rows 行或距上次落块超过 max_chunk_age 秒时写一块；
+    空闲期间缓冲的行在下一批到来或 close() 时落盘"""
+
+    def __init__(self, path, header, chunk_rows=65536, max_chunk_age=10.0, **kwargs):
+        super().__init__(path, header, **kwargs)
+        self.chunk_rows = chunk_rows
+        self.max_chunk_age = max_chunk_age
+        self._chunk_at = 0.0
+
+    def _open(self):
+        self._file = self._writer = ArchiveWriter(self.path, self.header, self.chunk_rows)
+        self._opened_at = self._chunk_at = time.time()
+
+    def _write_batch(self, rows):
+        try:
+            self._maybe_rotate()
+            if self._file is None:
+                self._open()
+            self._writer.writerows(rows)  # 满 chunk_rows 行时 ArchiveWriter 自己落块
+            if time.time() - self._chunk_at >= self.max_chunk_age:
+                self._file.flush()
+                self._chunk_at = time.time()
+            ROWS_WRITTEN.inc(len(rows))
+        except Exception:
+            WRITE_ERRORS.inc()
+            self._drop(len(rows))
+            self._close_file()
+
+
+# ====== 读取 ======
+class ArchiveReader:
+    """mmap 整个文件；chunks 为 [(行数, {列名: 只读 ndarray 视图})]，dicts 为 {列名: [字符串, ...]}"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if size < FILE_HEADER.size:
+            raise ValueError(f"{path}: 不是决策归档（文件过短）")
+        magic, version = FILE_HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: 不是决策归档（magic={magic!r}）")
+        if version != VERSION:
+            raise ValueError(f"{path}: 不支持的归档版本 {version}")
+        self.dicts = {name: [] for name in DICT_COLUMNS}
+        self.chunks = []
+        self.end = self._scan(size)
+        self.rows = sum(n for n, _ in self.chunks)
+
+    def _scan(self, size):
+        """依次读块头；遇到不完整的块即停（返回有效数据的结尾偏移）"""
+        pos = FILE_HEADER.size
+        while pos + CHUNK_HEADER.size <= size:
+            magic, n, dict_len, body_len = CHUNK_HEADER.unpack_from(self._mm, pos)
+            dict_at = pos + CHUNK_HEADER.size
+            body_at = dict_at + dict_len + _pad(dict_len)
+            end = body_at + body_len
+            if magic != CHUNK_MAGIC or end > size:
+                break
+            if dict_len:
+                for name, added in json.loads(bytes(self._mm[dict_at:dict_at + dict_len])).items():
+                    self.dicts[name].extend(added)
+            cols, off = {}, body_at
+            for name, dtype, _ in COLUMNS:
+                cols[name] = np.frombuffer(self._mm, dtype=dtype, count=n, offset=off)
+                nbytes = n * np.dtype(dtype).itemsize
+                off += nbytes + _pad(nbytes)
+            self.chunks.append((n, cols))
+            pos = end
+        return pos
+
+    def column(self, name):
+        """所有块拼成一个数组（拷贝；单块时直接返回 mmap 视图）"""
+        parts = [cols[name] for _, cols in self.chunks]
+        if not parts:
+            return np.empty(0, dtype=dict((n, t) for n, t, _ in COLUMNS)[name])
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def close(self):
+        self.chunks = []
+        if isinstance(self._mm, mmap.mmap):
+            try:
+                self._mm.close()
+            except BufferError:
+                pass  # 仍有调用方持有视图；随 GC 释放
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ====== CSV → 归档 ======
+def iter_csv_rows(path):
+    """产出与 RUN_ALL_CSV_COLUMNS 对齐的行；decisions.csv 混写（9 列表头 + 网关 6 列行）两种都认"""
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader, None) or []
+        if not set(header) & set(SOURCE_FIELDS):
+            raise ValueError(f"{path}: 无法识别的表头 {header}")
+        for row in reader:
+            if len(row) == len(header):
+                rec = dict(zip(header, row))
+            elif len(row) == len(GATEWAY_CSV_COLUMNS):
+                rec = dict(zip(GATEWAY_CSV_COLUMNS, row))
+            else:
+                continue
+            if rec.get("ts"):
+                yield [rec.get(c, "") for c in RUN_ALL_CSV_COLUMNS]
+
+
+def convert(csv_paths, archive_path, chunk_rows=65536):
+    with ArchiveWriter(archive_path, RUN_ALL_CSV_COLUMNS, chunk_rows) as w:
+        for path in csv_paths:
+            w.writerows(iter_csv_rows(path))
+    return w.rows_written
+
+
+# ====== 汇总（全部向量化） ======
+def _group_counts(codes_a, codes_b, n_b):
+    """两列联合计数：返回 [(a, b, count)]，按 count 降序"""
+    pair = codes_a.astype(np.int64) * n_b + codes_b
+    uniq, counts = np.unique(pair, return_counts=True)
+    order = np.argsort(-counts, kind="stable")
+    return [(int(uniq[i] // n_b), int(uniq[i] % n_b), int(counts[i])) for i in order]
+
+
+def _percentiles(sorted_values, percentiles):
+    """与 latency_histogram 相同的取法：rank = ceil(p/100 * n)"""
+    n = len(sorted_values)
+    ranks = np.maximum(1, np.ceil(np.asarray(percentiles) / 100.0 * n).astype(np.int64))
+    return sorted_values[ranks - 1]
+
+
+class Summary:
+    """一次读入需要的列，所有统计都是 bincount / unique / 排序"""
+
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, readers, since_ms=None, until_ms=None):
+        self.dicts = {name: [] for name in DICT_COLUMNS}
+        cols = {name: [] for name, _, _ in COLUMNS}
+        for r in readers:
+            # 多个归档的字典各自独立：先映射到合并字典再拼接
+            remap = {}
+            for name in DICT_COLUMNS:
+                merged = self.dicts[name]
+                index = {v: i for i, v in enumerate(merged)}
+                for v in r.dicts[name]:
+                    if v not in index:
+                        index[v] = len(merged)
+                        merged.append(v)
+                remap[name] = np.array([index[v] for v in r.dicts[name]], dtype=np.int64)
+            ts = r.column("ts_ms")
+            keep = np.ones(len(ts), dtype=bool)
+            if since_ms is not None:
+                keep &= ts >= since_ms
+            if until_ms is not None:
+                keep &= ts < until_ms
+            for name, _, coded in COLUMNS:
+                values = r.column(name)[keep]
+                cols[name].append(remap[name][values] if coded else values)
+        self.cols = {name: (np.concatenate(parts) if parts else np.empty(0, dtype=np.int64))
+                     for name, parts in cols.items()}
+        self.total = len(self.cols["ts_ms"])
+
+    def label(self, name, code):
+        return self.dicts[name][code]
+
+    def counts_by(self, a, b):
+        n_b = max(1, len(self.dicts[b]))
+        return [(self.label(a, x), self.label(b, y), n) for x, y, n in
+                _group_counts(self.cols[a], self.cols[b], n_b)]
+
+    def top(self, name, n=10):
+        counts = np.bincount(self.cols[name], minlength=len(self.dicts[name]))
+        order = np.argsort(-counts, kind="stable")[:n]
+        return [(self.label(name, int(i)), int(counts[i])) for i in order if counts[i]]
+
+    def score_histogram(self, width=10):
+        """信任分 0..100 按 width 分档：[(下界, 上界, count)]；另返回缺失行数"""
+        s = self.cols["trust_score"]
+        valid = s[s != MISSING_SCORE]
+        hist = np.bincount(np.clip(valid, 0, 100) // width, minlength=100 // width + 1)
+        rows = [(i * width, min(100, i * width + width - 1), int(c)) for i, c in enumerate(hist)]
+        return rows, int(len(s) - len(valid))
+
+    def latency_by_group(self):
+        """每组 + ALL 的 count/p50/p90/p99/p999/max（毫秒）；只算有延迟的行"""
+        lat = self.cols["latency_us"]
+        valid = lat != MISSING_LATENCY
+        lat, group = lat[valid], self.cols["group"][valid]
+        order = np.lexsort((lat, group))
+        lat, group = lat[order], group[order]
+        starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]]) if len(group) else np.empty(0, int)
+        ends = np.r_[starts[1:], len(group)]
+        rows = []
+        for s, e in zip(starts, ends):
+            rows.append((self.label("group", int(group[s])) or "-", self._latency_row(lat[s:e])))
+        if len(lat):
+            rows.append(("ALL", self._latency_row(np.sort(lat))))
+        return rows
+
+    def _latency_row(self, sorted_us):
+        ps = _percentiles(sorted_us, self.PERCENTILES) / 1000.0
+        out = {"count": int(len(sorted_us))}
+        for p, v in zip(self.PERCENTILES, ps):
+            out[f"p{str(p).replace('.', '')}"] = round(float(v), 3)
+        out["max"] = round(float(sorted_us[-1]) / 1000.0, 3)
+        return out
+
+
+def _parse_time(value):
+    return int(wall_clock_ms([value])[0]) if value else None
+
+
+def _write_csv(path, header, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(header)
+        w.writerows(rows)
+
+
+def cmd_convert(args):
+    t0 = time.perf_counter()
+    n = convert(args.inputs, args.archive, args.chunk_rows)
+    elapsed = time.perf_counter() - t0
+    in_bytes = sum(os.path.getsize(p) for p in args.inputs)
+    print(f"转换 {n} 行，用时 {elapsed:.2f}s；CSV {in_bytes:,} 字节 → 归档 {os.path.getsize(args.archive):,} 字节")
+    return 0
+
+
+def cmd_info(args):
+    for path in args.archives:
+        with ArchiveReader(path) as r:
+            sizes = ", ".join(f"{name}={len(r.dicts[name])}" for name in DICT_COLUMNS)
+            print(f"{path}: {r.rows} 行，{len(r.chunks)} 块，{r.end:,} 字节；字典 {sizes}")
+    return 0
+
+
+def cmd_summary(args):
+    readers = [ArchiveReader(p) for p in args.archives]
+    try:
+        t0 = time.perf_counter()
+        s = Summary(readers, _parse_time(args.since), _parse_time(args.until))
+        actions = s.counts_by("action", "reason")
+        by_status = s.counts_by("group", "status")
+        reasons = s.top("reason", args.top)
+        scores, missing_scores = s.score_histogram(args.score_bin)
+        latency = s.latency_by_group()
+        elapsed = time.perf_counter() - t0
+    finally:
+        for r in readers:
+            r.close()
+
+    rate = s.total / elapsed if elapsed else 0.0
+    print(f"汇总 {s.total} 行，用时 {elapsed:.3f}s（{rate:,.0f} 行/s）\n")
+    print(f"{'action':<18}{'reason':<22}{'count':>10}{'share':>8}")
+    for action, reason, n in actions:
+        print(f"{action or '-':<18}{reason or '-':<22}{n:>10}{n / s.total:>8.4f}")
+    print(f"\n{'group':<10}{'http_status':<12}{'count':>10}")
+    for group, status, n in sorted(by_status):
+        print(f"{group or '-':<10}{status or '-':<12}{n:>10}")
+    print(f"\nTop {args.top} reason")
+    for reason, n in reasons:
+        print(f"  {reason or '-':<22}{n:>10}")
+    print("\n信任分分布" + (f"（{missing_scores} 行无分数）" if missing_scores else ""))
+    peak = max((c for _, _, c in scores), default=0) or 1
+    for lo, hi, c in scores:
+        print(f"  {lo:>3}-{hi:<3}{c:>10}  {'#' * int(40 * c / peak)}")
+    if latency:
+        print(f"\n{'group':<8}{'count':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'p999':>9}{'max':>9}  (ms)")
+        for g, r in latency:
+            print(f"{g:<8}{r['count']:>8}{r['p50']:>9}{r['p90']:>9}{r['p99']:>9}{r['p999']:>9}{r['max']:>9}")
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+        # summary.csv / latency.csv 与 run_all.py 的输出同格式
+        _write_csv(os.path.join(args.out_dir, "summary.csv"), ["group", "http_status", "count"],
+                   sorted(by_status))
+        _write_csv(os.path.join(args.out_dir, "latency.csv"),
+                   ["group", "count", "p50_ms", "p90_ms", "p99_ms", "p999_ms", "max_ms"],
+                   [[g, r["count"], r["p50"], r["p90"], r["p99"], r["p999"], r["max"]] for g, r in latency])
+        _write_csv(os.path.join(args.out_dir, "decisions_by_reason.csv"), ["action", "reason", "count", "share"],
+                   [[a, r, n, f"{n / s.total:.4f}"] for a, r, n in actions])
+        _write_csv(os.path.join(args.out_dir, "top_reasons.csv"), ["reason", "count"], reasons)
+        _write_csv(os.path.join(args.out_dir, "score_histogram.csv"), ["score_from", "score_to", "count"], scores)
+        print(f"\n报表目录：{args.out_dir}")
+    return 0
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="决策明细列式归档 / 汇总")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("convert", help="decisions.csv（9 列 / 6 列混写均可）→ 归档；目标已存在时追加")
+    p.add_argument("inputs", nargs="+")
+    p.add_argument("archive")
+    p.add_argument("--chunk-rows", type=int, default=65536)
+    p.set_defaults(func=cmd_convert)
+
+    p = sub.add_parser("info", help="行数 / 块数 / 字典大小")
+    p.add_argument("archives", nargs="+")
+    p.set_defaults(func=cmd_info)
+
+    p = sub.add_parser("summary", help="按 action/reason/group 计数、TopN reason、信任分分布、延迟分位")
+    p.add_argument("archives", nargs="+")
+    p.add_argument("--since", help="起始时间（含），ISO 格式，如 2025-09-05T19:00")
+    p.add_argument("--until", help="截止时间（不含）")
+    p.add_argument("--top", type=int, default=10)
+    p.add_argument("--score-bin", type=int, default=10, help="信任分分档宽度")
+    p.add_argument("--out-dir", help="写出 summary.csv / latency.csv 等报表 CSV")
+    p.set_defaults(func=cmd_summary)
+
+    args = ap.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
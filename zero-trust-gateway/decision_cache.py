@@ -0,0 +1,126 @@
+"""
+短时决策缓存：同一用户 + 设备 + IP + 资源规则的重复请求（轮询）跳过完整评分
+功能点：
+- 键：user_id → 身份 (设备指纹, IP) + {(策略路由前缀, 频率规则前缀): 稳态扣分信号}
+  同一用户换了设备 / IP 的请求一律未命中，并在回源后整体替换该用户的条目
+- 只缓存“稳态”结果：ip_change / unknown_device / new_network / new_asn 是一次性的
+  （回源后状态已更新，下一次不会再扣），degraded（降级评分）与 sensitive_operation（/admin 等敏感前缀）
+  一律不缓存、也不查缓存
+- 随时间变化的信号（off_hours / high_frequency / rate_anomaly / unusual_hour）不进缓存：
+  命中时由后端 count_hit 重新给出 —— 一次轻量往返，只计频率、更新行为基线，不读写其余状态；
+  分数由信号重算、策略按当前策略表现选（热加载立即生效）；出现偏离稳态的信号时照常同步写访问日志 / 风险排行，
+  稳态命中的访问日志条目交给后台攒批写入（access_stream.StreamLogBuffer）—— 流里仍是每个决策一条；
+  稳态命中不更新用户状态 HASH（updated_at 停在上次完整评分）与风险排行（分数未变）
+- 条目过期 = min(写入时刻 + ttl, token exp)：缓存永远不会比令牌活得久
+- 多实例时别的实例看到的 IP / 设备变化最多滞后 ttl 才反映到本实例的命中上：ttl 宜短（秒级）
+- Prometheus：zt_decision_cache_lookups_total{result=hit|miss|bypass}；
+  命中率 = rate(hit) / rate(hit + miss)，/healthz 另报本进程累计命中率
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+from scoring import (
+    SIGNAL_ORDER, FLAG_IP_CHANGE, FLAG_UNKNOWN_DEVICE, FLAG_SENSITIVE, FLAG_DEGRADED, FLAG_OFF_HOURS,
+    FLAG_HIGH_FREQUENCY, FLAG_RATE_ANOMALY, FLAG_UNUSUAL_HOUR, FLAG_NEW_NETWORK, FLAG_NEW_ASN,
+)
+
+CACHE_LOOKUPS = Counter("zt_decision_cache_lookups_total", "Decision cache lookups", ["result"])
+
+# 出现这些信号的结果不缓存
+UNCACHEABLE_FLAGS = frozenset((FLAG_IP_CHANGE, FLAG_UNKNOWN_DEVICE, FLAG_NEW_NETWORK, FLAG_NEW_ASN,
+                               FLAG_SENSITIVE, FLAG_DEGRADED))
+# 命中时由后端重新给出，缓存里不存
+VOLATILE_FLAGS = frozenset((FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY, FLAG_RATE_ANOMALY, FLAG_UNUSUAL_HOUR))
+# 命中时出现则照常写访问日志 / 风险排行
+DEVIATION_FLAGS = frozenset((FLAG_HIGH_FREQUENCY, FLAG_RATE_ANOMALY, FLAG_UNUSUAL_HOUR,
+                             FLAG_NEW_NETWORK, FLAG_NEW_ASN))
+
+
+def merge_flags(cached, volatile):
+    """缓存的稳态信号 + 命中时重新得出的信号，按 SIGNAL_ORDER 排列"""
+    present = set(cached).union(volatile)
+    return [f for f in SIGNAL_ORDER if f in present]
+
+
+class DecisionCache:
+    """user_id -> [指纹, IP, {规则键: (扣分信号, 过期时刻)}]；用户数按 LRU 封顶，过期按 time.time()"""
+
+    def __init__(self, max_users=100000, ttl=2.0):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, fingerprint, ip, rule_key, now=None):
+        """命中返回缓存的稳态扣分信号（不含 VOLATILE_FLAGS），否则 None"""
+        now = time.time() if now is None else now
+        with self._lock:
+            e = self._users.get(user_id)
+            hit = None
+            if e is not None and e[0] == fingerprint and e[1] == ip:
+                item = e[2].get(rule_key)
+                if item is not None:
+                    if item[1] > now:
+                        hit = item[0]
+                        self._users.move_to_end(user_id)
+                    else:
+                        del e[2][rule_key]
+            if hit is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        CACHE_LOOKUPS.labels("miss" if hit is None else "hit").inc()
+        return hit
+
+    def put(self, user_id, fingerprint, ip, rule_key, flags, token_exp=None, now=None):
+        """回源后调用；不可缓存的结果只清掉该用户旧条目。返回是否写入"""
+        now = time.time() if now is None else now
+        expires = now + self.ttl
+        if token_exp is not None:
+            expires = min(expires, float(token_exp))
+        cacheable = expires > now and not UNCACHEABLE_FLAGS.intersection(flags)
+        with self._lock:
+            e = self._users.get(user_id)
+            if e is None or e[0] != fingerprint or e[1] != ip:
+                if not cacheable:
+                    self._users.pop(user_id, None)
+                    return False
+                e = self._users[user_id] = [fingerprint, ip, {}]
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            if not cacheable:
+                e[2].pop(rule_key, None)
+                return False
+            e[2][rule_key] = (tuple(f for f in flags if f not in VOLATILE_FLAGS), expires)
+            self._users.move_to_end(user_id)
+        return True
+
+    def bypass(self):
+        CACHE_LOOKUPS.labels("bypass").inc()
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+    def __len__(self):
+        return len(self._users)
+
+    def status(self):
+        total = self.hits + self.misses
+        return {
+            "ttl_seconds": self.ttl,
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
@@ -0,0 +1,190 @@
+"""
+决策明细 CSV 的后台缓冲写入器
+功能点：
+- 请求线程只做 queue.put：文件 I/O 完全移出决策延迟路径；事件循环里用 submit(..., wait=False)，
+  wait 策略下也不等待（满即丢弃并计数）
+- 有界队列 + 后台线程按条数/时间批量刷盘，文件句柄常驻
+- 按大小或时间轮转（decisions.csv -> decisions.csv.20250905-190636）
+- 单写者：一个文件只能有一个进程写（两个进程追加同一 CSV 会交错半批、轮转时互相 os.replace）。
+  per_process=True 时每个进程写自己的文件 decisions.<pid>.csv（多 worker 部署；读取方按文件列表合并）
+- 队列满时的策略：wait（最多等待 wait_timeout 秒，仍满则丢弃）| drop（直接丢弃）；
+  不存在无限期阻塞的选项 —— 请求线程绝不因日志卡住。旧名 block 视同 wait
+- 丢弃行一律计数：队列溢出与写盘失败丢掉的行都进 dropped / zt_csv_rows_dropped_total
+- close() 干净刷盘（投递哨兵与等待都有超时，队列满时不会卡住退出）；fork 后首次写入会在子进程里重建队列和线程
+- Prometheus：queued / written / dropped / errors 计数
+"""
+
+import os
+import csv
+import time
+import queue
+import threading
+from datetime import datetime
+
+from prometheus_client import Counter
+
+ROWS_QUEUED = Counter("zt_csv_rows_queued_total", "Decision CSV rows queued")
+ROWS_WRITTEN = Counter("zt_csv_rows_written_total", "Decision CSV rows written")
+ROWS_DROPPED = Counter("zt_csv_rows_dropped_total", "Decision CSV rows dropped on overflow or write error")
+WRITE_ERRORS = Counter("zt_csv_write_errors_total", "Decision CSV write/rotate errors")
+
+OVERFLOW_POLICIES = ("wait", "drop")
+OVERFLOW_ALIASES = {"block": "wait"}  # 旧名
+
+_STOP = object()
+
+
+def process_path(path, pid=None):
+    """out/decisions.csv -> out/decisions.<pid>.csv（扩展名不变，读取方用 out/decisions.*.csv 通配）"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid() if pid is None else pid}{ext}"
+
+
+class DecisionLogWriter:
+    """单文件 CSV 追加写入器；submit()/submit_many() 线程安全且不做 I/O。
+    per_process=True：实际写 process_path(path)，fork 后各 worker 自动换成自己的文件"""
+
+    def __init__(self, path, header, max_queue=10000, batch_size=500, flush_interval=1.0,
+                 rotate_bytes=0, rotate_seconds=0, overflow="drop", wait_timeout=0.05, per_process=False):
+        overflow = OVERFLOW_ALIASES.get(overflow, overflow)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow 必须是 {OVERFLOW_POLICIES} 之一")
+        self.base_path = path
+        self.per_process = per_process
+        self.path = process_path(path) if per_process else path
+        self.header = list(header)
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.overflow = overflow
+        self.wait_timeout = wait_timeout
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._file = None
+        self._writer = None
+        self._opened_at = 0.0
+
+    # —— 生产者侧 —— #
+    def submit(self, row, wait=True):
+        self.submit_many([row], wait)
+
+    def submit_many(self, rows, wait=True):
+        """wait=False：不论溢出策略都不等待（异步模式在事件循环里调用）"""
+        self._ensure_started()
+        for row in rows:
+            try:
+                if wait and self.overflow == "wait":
+                    self._queue.put(row, timeout=self.wait_timeout)
+                else:
+                    self._queue.put_nowait(row)
+                ROWS_QUEUED.inc()
+            except queue.Full:
+                self._drop(1)
+
+    def _drop(self, n):
+        self.dropped += n
+        ROWS_DROPPED.inc(n)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # 首次使用，或 fork 之后：父进程的线程不会被继承
+            if self.per_process:
+                self.path = process_path(self.base_path)
+            self._queue = queue.Queue(maxsize=self.max_queue)
+            self._file = None
+            self._writer = None
+            self._thread = threading.Thread(target=self._run, name="decision-log", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def close(self, timeout=5.0):
+        """投递哨兵并等待剩余行刷盘；总共最多等 timeout 秒（队列一直满就放弃，不卡住 atexit）"""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+
+    # —— 消费者侧 —— #
+    def _run(self):
+        while True:
+            batch = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stop = True
+                    break
+                batch.append(row)
+            if batch:
+                self._write_batch(batch)
+            if stop:
+                self._close_file()
+                return
+
+    def _write_batch(self, rows):
+        try:
+            self._maybe_rotate()
+            if self._file is None:
+                self._open()
+            self._writer.writerows(rows)
+            self._file.flush()
+            ROWS_WRITTEN.inc(len(rows))
+        except Exception:
+            WRITE_ERRORS.inc()
+            self._drop(len(rows))
+            self._close_file()
+
+    def _open(self):
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(self.header)
+        self._opened_at = time.time()
+
+    def _maybe_rotate(self):
+        if self._file is None:
+            return
+        by_size = self.rotate_bytes > 0 and self._file.tell() >= self.rotate_bytes
+        by_time = self.rotate_seconds > 0 and time.time() - self._opened_at >= self.rotate_seconds
+        if not (by_size or by_time):
+            return
+        self._close_file()
+        target = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        n = 1
+        while os.path.exists(target):
+            target = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S')}.{n}"
+            n += 1
+        os.replace(self.path, target)
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:
+                pass
+        self._file = None
+        self._writer = None
@@ -0,0 +1,56 @@
+"""
+每用户已知设备的紧凑存储（有上限、按最近使用淘汰、可选老化）
+功能点：
+- 成员是截断的二进制指纹：sha256 前 DEVICE_FP_BYTES 字节（默认 8 字节，原来是 64 字符 hex）
+- Redis 布局：有序集合 user:{id}:device_seen，member=指纹字节，score=最近一次出现的毫秒时间
+  每次出现 ZADD 刷新 score；新设备使集合超过 max_devices 时按 (score, member) 从小到大淘汰
+- ttl_ms > 0 时先删掉 ttl 内未出现的设备（ZREMRANGEBYSCORE），整个 key 也带 PEXPIRE
+- “未知设备”判定与学习语义不变：不在集合里 → 扣分并学习；旧版 SET（user:{id}:devices）
+  里有该设备 hex 的视为已知，并顺手 SREM，旧集合随使用逐渐清空
+- memory_device_seen()：进程内等价实现（内存后端 / 离线回放），淘汰顺序与 Redis 相同
+- 指标：zt_device_set_size（每次评分后的集合大小）、zt_device_evictions_total{reason=cap|ttl}
+"""
+
+from collections import namedtuple
+
+from prometheus_client import Counter, Histogram
+
+DEVICE_SET_SIZE = Histogram("zt_device_set_size", "Known devices per user after scoring",
+                            buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+DEVICE_EVICTIONS = Counter("zt_device_evictions_total", "Known devices evicted", ["reason"])
+
+# max_devices=0 / ttl_ms=0 表示不限
+DevicePolicy = namedtuple("DevicePolicy", ["max_devices", "ttl_ms", "fp_bytes"])
+DEFAULT_DEVICE_POLICY = DevicePolicy(max_devices=32, ttl_ms=0, fp_bytes=8)
+
+
+def compact_fingerprint(fp_hex, nbytes=DEFAULT_DEVICE_POLICY.fp_bytes):
+    """64 字符 hex → 前 nbytes 字节"""
+    return bytes.fromhex(fp_hex[:nbytes * 2])
+
+
+def memory_device_seen(devices, member, now, policy):
+    """devices: {member: 最近出现毫秒}；返回 (是否已知, 集合大小, 按上限淘汰数, 按老化淘汰数)"""
+    evicted_ttl = 0
+    if policy.ttl_ms > 0:
+        cutoff = now - policy.ttl_ms
+        stale = [m for m, seen in devices.items() if seen <= cutoff]
+        for m in stale:
+            del devices[m]
+        evicted_ttl = len(stale)
+    known = member in devices
+    devices[member] = now
+    evicted_cap = 0
+    if policy.max_devices > 0 and len(devices) > policy.max_devices:
+        evicted_cap = len(devices) - policy.max_devices
+        for m, _ in sorted(devices.items(), key=lambda kv: (kv[1], kv[0]))[:evicted_cap]:
+            del devices[m]
+    return known, len(devices), evicted_cap, evicted_ttl
+
+
+def observe_device_set(size, evicted_cap=0, evicted_ttl=0):
+    DEVICE_SET_SIZE.observe(size)
+    if evicted_cap:
+        DEVICE_EVICTIONS.labels("cap").inc(evicted_cap)
+    if evicted_ttl:
+        DEVICE_EVICTIONS.labels("ttl").inc(evicted_ttl)
@@ -0,0 +1,268 @@
+# fault_redis.py —— 故障注入的 Redis 替身：验证断路器 + 降级评分（resilience.py）
+# 用法：
+#   python fault_redis.py verify                                   # 进程内：fakeredis + 注入，跑 健康→宕机→变慢→恢复 四个阶段
+#   python fault_redis.py verify --budget-ms 20 --reset-seconds 0.5
+#   python fault_redis.py proxy --listen 127.0.0.1:6380 --upstream 127.0.0.1:6379 --delay-ms 200
+#       # TCP 代理放在真实 Redis 前面，网关 REDIS_PORT=6380；运行中按键切换：d=宕机 u=恢复 s=变慢 f=正常
+# 注入方式与 instrumentation.instrument_redis 相同：原地替换 execute_command / pipeline().execute
+#   down：直接抛 ConnectionError（模拟连接被拒）
+#   delay_ms：每次往返先睡这么久；超过 socket_timeout 时睡满超时后抛 TimeoutError（与 redis-py 行为一致）
+#   error_rate：按概率抛 ConnectionError
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import threading
+
+import redis
+
+
+class Faults:
+    """当前注入的故障；各字段可在运行中直接改"""
+
+    def __init__(self, delay_ms=0.0, error_rate=0.0, down=False, socket_timeout_ms=None, seed=None):
+        self.delay_ms = delay_ms
+        self.error_rate = error_rate
+        self.down = down
+        self.socket_timeout_ms = socket_timeout_ms
+        self.calls = 0
+        self.injected = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def set(self, delay_ms=0.0, error_rate=0.0, down=False):
+        self.delay_ms, self.error_rate, self.down = delay_ms, error_rate, down
+
+    def before_call(self):
+        with self._lock:
+            self.calls += 1
+            fail = self.down or (self.error_rate and self._rng.random() < self.error_rate)
+            if fail:
+                self.injected += 1
+        if fail:
+            raise redis.exceptions.ConnectionError("injected: connection refused")
+        if self.delay_ms:
+            timeout = self.socket_timeout_ms
+            if timeout is not None and self.delay_ms > timeout:
+                time.sleep(timeout / 1000)
+                with self._lock:
+                    self.injected += 1
+                raise redis.exceptions.TimeoutError("injected: Timeout reading from socket")
+            time.sleep(self.delay_ms / 1000)
+
+
+def inject_faults(client, faults):
+    """原地包装同步客户端（fakeredis / redis-py）；返回 client"""
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    def faulty_execute_command(*args, **options):
+        faults.before_call()
+        return execute_command(*args, **options)
+
+    def faulty_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def faulty_execute(*e_args, **e_kwargs):
+            if pipe.command_stack:
+                faults.before_call()
+            return execute(*e_args, **e_kwargs)
+
+        pipe.execute = faulty_execute
+        return pipe
+
+    client.execute_command = faulty_execute_command
+    client.pipeline = faulty_pipeline
+    return client
+
+
+# ========== verify：进程内四阶段 ==========
+def _setup_env(args):
+    """必须在导入 app 之前"""
+    tmp = tempfile.mkdtemp(prefix="zt-fault-")
+    os.environ.setdefault("CSV_PATH", os.path.join(tmp, "decisions.csv"))
+    os.environ.setdefault("POLICY_FILE", os.path.join(tmp, "missing.yaml"))  # 用内置默认策略（/admin fail-closed）
+    os.environ["L1_CACHE_ENABLED"] = "0"
+    os.environ["STATE_BACKEND"] = "redis"
+    os.environ["RESILIENCE_ENABLED"] = "1"
+    os.environ["STATE_LATENCY_BUDGET_MS"] = str(args.budget_ms)
+    os.environ["REDIS_SOCKET_TIMEOUT_MS"] = str(args.budget_ms)
+    os.environ["BREAKER_FAILURE_THRESHOLD"] = str(args.threshold)
+    os.environ["BREAKER_RESET_SECONDS"] = str(args.reset_seconds)
+
+
+def _request(client, headers, resource):
+    t0 = time.perf_counter()
+    resp = client.post("/api/access-request", json={"resource": resource}, headers=headers)
+    return resp.status_code, resp.get_json(), (time.perf_counter() - t0) * 1000
+
+
+def verify(args):
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("需要 fakeredis：pip install fakeredis lupa")
+    _setup_env(args)
+    import jwt
+    import app as gw_app
+
+    faults = Faults(socket_timeout_ms=args.budget_ms, seed=7)
+    client = inject_faults(fakeredis.FakeRedis(decode_responses=True), faults)
+    gw_app.redis_client = client
+    gw_app.gateway = gw_app.ZeroTrustGateway(client=client)
+    backend = gw_app.gateway.backend
+    test_client = gw_app.app.test_client()
+
+    token = jwt.encode({"preferred_username": "fault", "realm_access": {"roles": ["user"]},
+                        "exp": int(time.time()) + 3600}, None, algorithm="none")
+    headers = {"Authorization": f"Bearer {token}", "X-Forwarded-For": "203.0.113.9",
+               "User-Agent": "Mozilla/5.0 fault", "Accept-Language": "zh-CN"}
+    failures = []
+
+    def check(cond, message):
+        print(f"   {'✓' if cond else '✗'} {message}")
+        if not cond:
+            failures.append(message)
+
+    def phase(name, n, resources=("/", "/admin")):
+        rows = [_request(test_client, headers, resources[i % len(resources)]) for i in range(n)]
+        health = test_client.get("/healthz").get_json()
+        worst = max(ms for _, _, ms in rows)
+        print(f"== {name}: breaker={backend.breaker.state} healthz={health['status']} "
+              f"最慢 {worst:.1f}ms  注入 {faults.injected}/{faults.calls}")
+        return rows, health
+
+    # 1. 健康：正常打分，断路器 closed
+    rows, health = phase("健康", 6)
+    check(backend.breaker.state == "closed", "断路器保持 closed")
+    check(not any(body["degraded"] for _, body, _ in rows), "没有降级决策")
+    check(health["status"] == "ok", "/healthz ok")
+
+    # 2. 宕机：连续失败打开断路器；之后不再碰 Redis，fail-open 路由降级放行，/admin fail-closed 拒绝
+    faults.set(down=True)
+    rows, health = phase("宕机", args.threshold + 6)
+    check(backend.breaker.state == "open", "连续失败后断路器 open")
+    check(all(body["degraded"] for _, body, _ in rows), "全部为降级决策")
+    admin, public = [body for _, body, _ in rows[1::2]], [body for _, body, _ in rows[0::2]]
+    check(all(b["access_decision"] == "deny" and b["reason"] == "state_unavailable" for b in admin),
+          "/admin fail-closed：deny / state_unavailable")
+    check(all(b["reason"] != "state_unavailable" for b in public), "/ fail-open：照常按降级分决策")
+    calls_before = faults.calls
+    _request(test_client, headers, "/")
+    check(faults.calls == calls_before, "断路器打开期间不再调用 Redis")
+    check(health["status"] == "degraded" and health["breaker"]["state"] == "open", "/healthz 报 degraded + open")
+    check(test_client.get("/api/risky-users", headers=headers).status_code == 503, "只读查询直接 503")
+
+    # 3. 变慢：半开试探超时 → 重新 open；每个请求耗时不超过 ~预算
+    faults.set(delay_ms=args.budget_ms * 4)
+    time.sleep(args.reset_seconds + 0.05)
+    rows, health = phase("变慢", 6, resources=("/",))
+    check(backend.breaker.state == "open", "半开试探超时后重新 open")
+    worst = max(ms for _, _, ms in rows)
+    check(worst < args.budget_ms * 3, f"决策耗时受预算约束（最慢 {worst:.1f}ms < {args.budget_ms * 3:.0f}ms）")
+
+    # 4. 恢复：reset 后半开试探成功 → closed，回到正常打分
+    faults.set()
+    time.sleep(args.reset_seconds + 0.05)
+    rows, health = phase("恢复", 4)
+    check(backend.breaker.state == "closed", "试探成功后断路器 closed")
+    check(not rows[-1][1]["degraded"], "恢复后不再降级")
+    check(health["status"] == "ok", "/healthz ok")
+
+    metrics = test_client.get("/metrics").get_data(as_text=True)
+    for name in ("zt_breaker_state", "zt_breaker_transitions_total", "zt_degraded_scores_total"):
+        check(name in metrics, f"/metrics 含 {name}")
+
+    if failures:
+        print(f"❌ {len(failures)} 项未通过")
+        return 1
+    print("✅ 全部通过")
+    return 0
+
+
+# ========== proxy：真实 Redis 前的 TCP 故障代理 ==========
+async def _pipe(reader, writer, faults):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            if faults.delay_ms:
+                await asyncio.sleep(faults.delay_ms / 1000)
+            if faults.down:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve_proxy(args, faults):
+    up_host, up_port = args.upstream.rsplit(":", 1)
+    host, port = args.listen.rsplit(":", 1)
+
+    async def handle(reader, writer):
+        faults.calls += 1
+        if faults.down:
+            writer.close()
+            return
+        try:
+            up_reader, up_writer = await asyncio.open_connection(up_host, int(up_port))
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(_pipe(reader, up_writer, faults), _pipe(up_reader, writer, faults))
+
+    server = await asyncio.start_server(handle, host, int(port))
+    print(f"🔌 故障代理 {args.listen} → {args.upstream}  delay={faults.delay_ms}ms down={faults.down}")
+    if sys.stdin.isatty():
+        print("   键入 d=宕机 u=恢复 s=变慢 f=正常 后回车")
+        loop = asyncio.get_running_loop()
+        loop.add_reader(sys.stdin, lambda: _on_key(sys.stdin.readline().strip(), faults, args))
+    async with server:
+        await server.serve_forever()
+
+
+def _on_key(key, faults, args):
+    if key == "d":
+        faults.down = True
+    elif key == "u":
+        faults.down = False
+    elif key == "s":
+        faults.delay_ms = args.delay_ms or 200
+    elif key == "f":
+        faults.set()
+    print(f"   delay={faults.delay_ms}ms down={faults.down}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="故障注入的 Redis 替身")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    v = sub.add_parser("verify", help="进程内四阶段验证断路器与降级")
+    v.add_argument("--budget-ms", type=float, default=20.0)
+    v.add_argument("--threshold", type=int, default=3)
+    v.add_argument("--reset-seconds", type=float, default=0.3)
+    p = sub.add_parser("proxy", help="TCP 代理，放在真实 Redis 前注入延迟 / 断连")
+    p.add_argument("--listen", default="127.0.0.1:6380")
+    p.add_argument("--upstream", default="127.0.0.1:6379")
+    p.add_argument("--delay-ms", type=float, default=0.0)
+    p.add_argument("--down", action="store_true")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "verify":
+        return verify(args)
+    try:
+        asyncio.run(_serve_proxy(args, Faults(delay_ms=args.delay_ms, down=args.down)))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
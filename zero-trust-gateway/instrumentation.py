@@ -0,0 +1,233 @@
+"""
+请求分阶段计时 + Redis 调用计数 + 抽样剖析
+功能点：
+- 每个请求一个 RequestTrace（contextvars，线程 / 协程各自独立）；with stage("xxx") 记录阶段耗时，
+  请求结束时统一写入 zt_stage_latency_seconds{stage}；没有活动请求时 stage() 为空操作
+- instrument_redis(client)：包一层 execute_command / pipeline().execute，
+  按命令名计 zt_redis_commands_total{command}，按往返计 zt_redis_round_trips_total，
+  并给当前请求累加，结束时写每请求命令数 / 往返数直方图
+- 抽样剖析：每 N 个请求抽 1 个，用 sys.setprofile 记录该请求线程的调用栈，
+  输出 folded stack（"a;b;c 微秒"，flamegraph.pl / speedscope 可直接读）；运行时经管理接口开关
+  只对本进程生效（多 worker 时每个进程各自开关）
+"""
+
+import os
+import sys
+import time
+import threading
+import itertools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from prometheus_client import Counter, Histogram
+
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+STAGE_LATENCY = Histogram("zt_stage_latency_seconds", "Per-stage request latency seconds", ["stage"],
+                          buckets=STAGE_BUCKETS)
+REDIS_COMMANDS = Counter("zt_redis_commands_total", "Redis commands sent", ["command"])
+REDIS_ROUND_TRIPS = Counter("zt_redis_round_trips_total", "Redis network round trips")
+REDIS_COMMANDS_PER_REQUEST = Histogram("zt_redis_commands_per_request", "Redis commands per request",
+                                       buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64, 128))
+REDIS_ROUND_TRIPS_PER_REQUEST = Histogram("zt_redis_round_trips_per_request", "Redis round trips per request",
+                                          buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16))
+PROFILES_CAPTURED = Counter("zt_profiles_captured_total", "Sampled request profiles written")
+
+_current = ContextVar("zt_request_trace", default=None)
+
+
+class RequestTrace:
+    __slots__ = ("name", "stages", "commands", "round_trips", "profile", "_token")
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.commands = 0
+        self.round_trips = 0
+        self.profile = None
+        self._token = None
+
+
+@contextmanager
+def stage(name):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.stages.append((name, time.perf_counter() - t0))
+
+
+def begin_request(name):
+    trace = RequestTrace(name)
+    trace._token = _current.set(trace)
+    if profiler.should_sample():
+        trace.profile = profiler.start()
+    return trace
+
+
+def end_request(trace):
+    if trace.profile is not None:
+        profiler.finish(trace.profile, trace.name)
+    _current.reset(trace._token)
+    for name, seconds in trace.stages:
+        STAGE_LATENCY.labels(name).observe(seconds)
+    REDIS_COMMANDS_PER_REQUEST.observe(trace.commands)
+    REDIS_ROUND_TRIPS_PER_REQUEST.observe(trace.round_trips)
+
+
+def traced(name):
+    """路由装饰器：整个视图函数算一个请求"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            trace = begin_request(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                end_request(trace)
+        return wrapper
+    return decorator
+
+
+# ========== Redis 调用计数 ==========
+def _command_name(args):
+    name = args[0] if args else "?"
+    if isinstance(name, bytes):
+        name = name.decode()
+    return str(name).split(" ")[0].upper()
+
+
+def _account(names):
+    for name in names:
+        REDIS_COMMANDS.labels(name).inc()
+    REDIS_ROUND_TRIPS.inc()
+    trace = _current.get()
+    if trace is not None:
+        trace.commands += len(names)
+        trace.round_trips += 1
+
+
+def instrument_redis(client):
+    """原地包装同步 redis-py 客户端（含 RedisCluster / fakeredis）；重复调用无副作用
+    单条命令 = 1 次往返；pipeline.execute() = 1 次往返（Cluster 下按节点可能多次，这里按 1 计）"""
+    if getattr(client, "_zt_instrumented", False):
+        return client
+    execute_command = client.execute_command
+    make_pipeline = client.pipeline
+
+    def counted_execute_command(*args, **options):
+        _account([_command_name(args)])
+        return execute_command(*args, **options)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = make_pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*e_args, **e_kwargs):
+            names = [_command_name(getattr(c, "args", None) or c[0]) for c in pipe.command_stack]
+            if names:
+                _account(names)
+            return execute(*e_args, **e_kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+    client.execute_command = counted_execute_command
+    client.pipeline = counted_pipeline
+    client._zt_instrumented = True
+    return client
+
+
+# ========== 抽样剖析（folded stacks） ==========
+class _StackRecorder:
+    """sys.setprofile 回调：按调用栈累计自身耗时（微秒）"""
+
+    __slots__ = ("root", "names", "frames", "folded")
+
+    def __init__(self, root):
+        self.root = root
+        self.names = [root]
+        self.frames = []     # [开始时间, 子调用耗时]
+        self.folded = {}
+
+    @staticmethod
+    def _label(frame, event, arg):
+        if event == "c_call":
+            module = getattr(arg, "__module__", None) or "builtins"
+            return f"{module}.{getattr(arg, '__qualname__', getattr(arg, '__name__', '?'))}"
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == "call" or event == "c_call":
+            self.names.append(self._label(frame, event, arg))
+            self.frames.append([now, 0.0])
+        elif self.frames and event in ("return", "c_return", "c_exception"):
+            started, child = self.frames.pop()
+            elapsed = now - started
+            key = ";".join(self.names)
+            self.names.pop()
+            self.folded[key] = self.folded.get(key, 0.0) + (elapsed - child)
+            if self.frames:
+                self.frames[-1][1] += elapsed
+
+
+class SampledProfiler:
+    """每 sample_every 个请求剖析 1 个（0 = 关闭）；结果追加到 out_dir/profile-<pid>.folded"""
+
+    def __init__(self, sample_every=0, out_dir="out/profiles"):
+        self.sample_every = int(sample_every)
+        self.out_dir = out_dir
+        self.captured = 0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def configure(self, sample_every=None, out_dir=None):
+        if sample_every is not None:
+            if int(sample_every) < 0:
+                raise ValueError("sample_every 不能为负数")
+            self.sample_every = int(sample_every)
+        if out_dir:
+            self.out_dir = out_dir
+        return self.status()
+
+    def status(self):
+        return {"sample_every": self.sample_every, "enabled": self.sample_every > 0,
+                "output": self.output_path(), "captured": self.captured}
+
+    def output_path(self):
+        return os.path.join(self.out_dir, f"profile-{os.getpid()}.folded")
+
+    def should_sample(self):
+        n = self.sample_every
+        return n > 0 and next(self._counter) % n == 0
+
+    def start(self):
+        if sys.getprofile() is not None:
+            return None  # 已有其他剖析器（例如 cProfile）在跑
+        recorder = _StackRecorder("request")
+        sys.setprofile(recorder)
+        return recorder
+
+    def finish(self, recorder, name):
+        sys.setprofile(None)
+        root = name.replace(";", ":").replace(" ", "_")
+        lines = []
+        for stack, seconds in recorder.folded.items():
+            us = int(seconds * 1e6)
+            if us > 0:
+                lines.append(f"{root}{stack[len(recorder.root):]} {us}\n")
+        with self._lock:
+            os.makedirs(self.out_dir, exist_ok=True)
+            with open(self.output_path(), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            self.captured += 1
+        PROFILES_CAPTURED.inc()
+
+
+profiler = SampledProfiler()
@@ -0,0 +1,158 @@
+"""
+进程内 L1 缓存：每用户风险状态（last_ip + 已知设备指纹）
+功能点：
+- LRU + TTL，条目数有上限；只缓存“正”信息（设备已知），未知设备一律回源
+- 跨实例失效走 Redis pub/sub：某实例学到新设备或看到 IP 变化时 PUBLISH user_id，
+  其他实例收到后丢弃本地条目；消息带实例 id，自己发的忽略
+- 订阅线程断线重连时清空整个缓存（期间可能漏消息）
+- 只用于逐条调用路径（TRUST_SCORE_MODE=calls）：脚本路径每次请求本来就要一次 EVALSHA（频率计数），
+  脚本内读 HASH / ZSET 几乎不花时间，本地缓存省不下往返；脚本模式的实例只负责发失效消息
+- Prometheus：hit / miss（按 kind 区分）与 invalidation 计数
+"""
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+L1_HITS = Counter("zt_l1_cache_hits_total", "L1 risk-state cache hits", ["kind"])
+L1_MISSES = Counter("zt_l1_cache_misses_total", "L1 risk-state cache misses", ["kind"])
+L1_INVALIDATIONS = Counter("zt_l1_cache_invalidations_total", "L1 entries invalidated", ["source"])
+
+
+def new_instance_id():
+    return uuid.uuid4().hex[:12]
+
+
+def invalidation_message(instance_id, user_id):
+    """失效消息：发送方实例 id | user_id（收到自己发的忽略）"""
+    return f"{instance_id}|{user_id}"
+
+
+class LocalRiskCache:
+    """user_id -> {last_ip, devices, expires}"""
+
+    def __init__(self, max_entries=10000, ttl=30.0, max_devices=64):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_devices = max_devices
+        self.instance_id = new_instance_id()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, user_id, create=False):
+        e = self._entries.get(user_id)
+        now = time.monotonic()
+        if e is not None and e["expires"] <= now:
+            del self._entries[user_id]
+            e = None
+        if e is None:
+            if not create:
+                return None
+            e = {"last_ip": None, "devices": set(), "expires": now + self.ttl}
+            self._entries[user_id] = e
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        self._entries.move_to_end(user_id)
+        return e
+
+    # —— 读 —— #
+    def get_last_ip(self, user_id):
+        """返回 (命中, last_ip)"""
+        with self._lock:
+            e = self._entry(user_id)
+            if e is not None and e["last_ip"] is not None:
+                L1_HITS.labels("last_ip").inc()
+                return True, e["last_ip"]
+        L1_MISSES.labels("last_ip").inc()
+        return False, None
+
+    def is_known_device(self, user_id, fingerprint):
+        """True=本地确认已知；False=本地不知道（需回源）"""
+        with self._lock:
+            e = self._entry(user_id)
+            if e is not None and fingerprint in e["devices"]:
+                L1_HITS.labels("device").inc()
+                return True
+        L1_MISSES.labels("device").inc()
+        return False
+
+    # —— 写（回源或本实例写入后调用） —— #
+    def remember(self, user_id, last_ip=None, devices=()):
+        with self._lock:
+            e = self._entry(user_id, create=True)
+            if last_ip is not None:
+                e["last_ip"] = last_ip
+            for fp in devices:
+                if len(e["devices"]) >= self.max_devices:
+                    break
+                e["devices"].add(fp)
+
+    def invalidate(self, user_id, source="local"):
+        with self._lock:
+            if self._entries.pop(user_id, None) is not None:
+                L1_INVALIDATIONS.labels(source).inc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # —— 跨实例失效 —— #
+    def message_for(self, user_id):
+        return invalidation_message(self.instance_id, user_id)
+
+    def handle_message(self, data):
+        origin, _, user_id = (data or "").partition("|")
+        if origin and origin != self.instance_id and user_id:
+            self.invalidate(user_id, source="pubsub")
+
+
+class InvalidationSubscriber:
+    """后台订阅失效频道；fork 之后需在子进程里重新 start()"""
+
+    def __init__(self, client, cache, channel, reconnect_delay=1.0):
+        self.client = client
+        self.cache = cache
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._pid = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="l1-invalidation", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            pubsub = None
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                while not self._stop.is_set():
+                    msg = pubsub.get_message(timeout=1.0)
+                    if msg and msg.get("type") == "message":
+                        data = msg["data"]
+                        if isinstance(data, bytes):
+                            data = data.decode("utf-8", "replace")
+                        self.cache.handle_message(data)
+            except Exception:
+                # 断线期间可能漏掉失效消息：保守起见整体清空
+                self.cache.clear()
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
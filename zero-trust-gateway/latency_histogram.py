@@ -0,0 +1,74 @@
+"""
+HDR 风格对数-线性延迟直方图（纯 Python，无依赖）
+功能点：
+- 记录整数微秒；小于 2^bits 的值精确计数，之上按 2 的幂分段、每段 2^(bits-1) 个线性子桶
+  默认 bits=8 → 相对误差 < 1%，内存与样本数无关
+- percentile() 返回桶上界（保守估计），merge() 合并多个直方图
+"""
+
+import math
+
+
+class LatencyHistogram:
+    def __init__(self, bits=8):
+        self.bits = bits
+        self.linear = 1 << bits
+        self.half = 1 << (bits - 1)
+        self.counts = {}
+        self.count = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, v):
+        if v < self.linear:
+            return v
+        e = v.bit_length() - self.bits
+        return self.linear + (e - 1) * self.half + ((v >> e) - self.half)
+
+    def _upper(self, idx):
+        if idx < self.linear:
+            return idx
+        e, sub = divmod(idx - self.linear, self.half)
+        e += 1
+        return ((sub + self.half + 1) << e) - 1
+
+    def record_us(self, us):
+        v = max(0, int(us))
+        i = self._index(v)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = max(self.max, v)
+
+    def record_seconds(self, seconds):
+        self.record_us(seconds * 1e6)
+
+    def percentile_us(self, p):
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(p / 100.0 * self.count))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._upper(idx), self.max)
+        return self.max
+
+    def percentile_ms(self, p):
+        return self.percentile_us(p) / 1000.0
+
+    def merge(self, other):
+        for idx, n in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + n
+        self.count += other.count
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def summary_ms(self, percentiles=(50, 90, 99, 99.9)):
+        out = {"count": self.count}
+        for p in percentiles:
+            out[f"p{str(p).replace('.', '')}"] = round(self.percentile_ms(p), 3)
+        out["max"] = round(self.max / 1000.0, 3)
+        return out
@@ -0,0 +1,122 @@
+"""
+/metrics 输出（单进程 / 多 worker 通用）
+功能点：
+- 未设置 PROMETHEUS_MULTIPROC_DIR：默认 registry，行为与原来相同
+- 多 worker（serve.py / app_async 多进程启动时设置该目录）：prometheus_client multiprocess 模式，
+  每个 worker 把 Counter / Histogram 写进目录下自己的 mmap 文件，/metrics 由 MultiProcessCollector
+  合并所有文件 —— 不再是“哪个 worker 接到抓取就返回哪个 worker 的数”
+- 合并成本 ≈ 文件数 × 序列数，且与抓取次数成正比：
+  * 结果缓存 METRICS_CACHE_SECONDS（默认 1s），并发 / 重复抓取只合并一次
+  * worker 退出（崩溃、max_requests 回收）时把它的计数并入 *_archive.db 后删除原文件，
+    文件数恒为“存活 worker 数 + 1”，不随重启次数增长
+- 合并与归并互斥（目录下 .lock 文件，flock 共享/独占）：抓取不会看到“已并入归档但原文件还在”的重复计数
+- prepare_multiproc_dir()：启动前清空目录（上次运行遗留的文件会被重复累加）；必须早于导入任何定义指标的模块
+"""
+
+import os
+import time
+import shutil
+import threading
+
+# prometheus_client 一律在函数内导入：prepare_multiproc_dir() 必须先于它的首次导入执行
+MULTIPROC_ENV = "PROMETHEUS_MULTIPROC_DIR"
+METRICS_CACHE_SECONDS = float(os.getenv("METRICS_CACHE_SECONDS", "1.0"))
+ARCHIVE_PID = "archive"
+_LOCK_NAME = ".lock"
+
+
+def multiproc_dir():
+    return os.environ.get(MULTIPROC_ENV) or os.environ.get(MULTIPROC_ENV.lower())
+
+
+def prepare_multiproc_dir(path):
+    """清空并设置 PROMETHEUS_MULTIPROC_DIR；在导入 prometheus_client 指标之前调用"""
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    os.environ[MULTIPROC_ENV] = path
+    return path
+
+
+class _DirLock:
+    """目录级读写锁（flock）：合并取共享锁，归并取独占锁"""
+
+    def __init__(self, path, exclusive):
+        self.path = os.path.join(path, _LOCK_NAME)
+        self.exclusive = exclusive
+        self._fd = None
+
+    def __enter__(self):
+        import fcntl
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        return self
+
+    def __exit__(self, *exc):
+        import fcntl
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+
+class MetricsExporter:
+    """render() -> (payload bytes, content type)；多进程模式下带短 TTL 缓存"""
+
+    def __init__(self, cache_seconds=METRICS_CACHE_SECONDS):
+        self.cache_seconds = cache_seconds
+        self._cached = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def render(self):
+        from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+        path = multiproc_dir()
+        if not path:
+            return generate_latest(), CONTENT_TYPE_LATEST
+        if self._cached is not None and time.monotonic() < self._expires:
+            return self._cached, CONTENT_TYPE_LATEST
+        with self._lock:
+            # 等锁期间别的线程可能已经生成过
+            if self._cached is None or time.monotonic() >= self._expires:
+                self._cached = self._collect(path)
+                self._expires = time.monotonic() + self.cache_seconds
+            return self._cached, CONTENT_TYPE_LATEST
+
+    @staticmethod
+    def _collect(path):
+        from prometheus_client import CollectorRegistry, generate_latest
+        from prometheus_client.multiprocess import MultiProcessCollector
+
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry, path=path)
+        with _DirLock(path, exclusive=False):
+            return generate_latest(registry)
+
+
+def mark_worker_dead(pid, path=None):
+    """worker 退出后在主进程调用：删除其 live gauge 文件，Counter / Histogram 并入归档文件"""
+    from prometheus_client import multiprocess
+    from prometheus_client.mmap_dict import MmapedDict
+
+    path = path or multiproc_dir()
+    if not path:
+        return 0
+    multiprocess.mark_process_dead(pid, path)
+    merged = 0
+    with _DirLock(path, exclusive=True):
+        for typ in ("counter", "histogram"):
+            dead = os.path.join(path, f"{typ}_{pid}.db")
+            if not os.path.exists(dead):
+                continue
+            archive = MmapedDict(os.path.join(path, f"{typ}_{ARCHIVE_PID}.db"))
+            try:
+                for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(dead):
+                    current, _ = archive.read_value(key)
+                    archive.write_value(key, current + value, timestamp)
+                    merged += 1
+            finally:
+                archive.close()
+            os.remove(dead)
+    return merged
+
+
+exporter = MetricsExporter()
@@ -0,0 +1,282 @@
+"""
+声明式策略表 → 编译后的决策引擎（按资源前缀）
+功能点：
+- 策略文件（YAML / JSON，见 policies.yaml）按资源前缀配置：阈值、各档 restrictions /
+  monitoring_level / reason、是否敏感操作；子前缀继承最近的父前缀，再覆盖自己写的字段
+- 加载时编译：每条路由预先生成 4 个只读决策对象（MappingProxyType，restrictions 为 tuple），
+  请求时只做比较 + 取引用，不再每次新建 dict / list
+- 字符级前缀字典树：最长前缀匹配一次 O(资源路径长度)，与规则条数无关（数千条同样快）
+  语义与原 str.startswith 一致（/admin 也匹配 /administrator）
+- 热加载：按 mtime 轮询，新表完整编译成功后一次引用替换（原子，读方无锁）；
+  编译失败保留旧表，记录 last_error 并计数
+- 无策略文件时用内置默认：80/60/40 + /admin 敏感，与原硬编码一致
+- on_degraded：状态存储不可用（resilience.py 降级评分）时该前缀的处理，open = 按降级分数照常分档，
+  closed = 直接 deny（reason=state_unavailable）；内置默认 / 为 open，/admin 为 closed
+"""
+
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from prometheus_client import Counter
+
+from scoring import DEFAULT_THRESHOLDS, POLICY_TIERS, SENSITIVE_PREFIX
+
+POLICY_RELOADS = Counter("zt_policy_reloads_total", "Policy file reload attempts", ["result"])
+
+ACTIONS = tuple(t["action"] for t in POLICY_TIERS)
+TIER_FIELDS = ("restrictions", "monitoring_level", "reason")
+ROUTE_FIELDS = ("prefix", "thresholds", "sensitive", "tiers", "on_degraded")
+DEGRADED_MODES = ("open", "closed")
+# 默认策略文件：与本模块同目录，不随启动目录变化
+DEFAULT_POLICY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "policies.yaml")
+
+
+# ========== 前缀字典树 ==========
+class PrefixTrie:
+    """按字符的前缀树；节点是 dict，值存在空串键下（空串不会是路径字符）"""
+
+    __slots__ = ("_root", "size")
+
+    def __init__(self):
+        self._root = {}
+        self.size = 0
+
+    def insert(self, prefix, value):
+        node = self._root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        if "" not in node:
+            self.size += 1
+        node[""] = value
+
+    def longest(self, key, default=None):
+        """key 的最长已登记前缀对应的值"""
+        node = self._root
+        best = node.get("", default)
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                break
+            if "" in node:
+                best = node[""]
+        return best
+
+
+# ========== 编译结果 ==========
+class RoutePolicy(namedtuple("RoutePolicy", ["prefix", "thresholds", "decisions", "sensitive", "fail_closed"])):
+    """一条路由的编译结果；decisions 与 POLICY_TIERS 一一对应"""
+
+    __slots__ = ()
+
+    def decide_degraded(self, trust_score):
+        """降级评分时：fail-closed 直接拒绝，fail-open 按分数照常分档"""
+        return DEGRADED_DENY if self.fail_closed else self.decide(trust_score)
+
+    def decide(self, trust_score):
+        t_allow, t_restricted, t_mfa = self.thresholds
+        if trust_score >= t_allow:
+            return self.decisions[0]
+        if trust_score >= t_restricted:
+            return self.decisions[1]
+        if trust_score >= t_mfa:
+            return self.decisions[2]
+        return self.decisions[3]
+
+
+class CompiledPolicy:
+    """不可变：热加载时整体替换，不原地修改"""
+
+    def __init__(self, trie, default_route, version, source):
+        self._trie = trie
+        self.default_route = default_route
+        self.version = version
+        self.source = source
+
+    @property
+    def route_count(self):
+        return self._trie.size
+
+    def match(self, resource):
+        return self._trie.longest(resource or "/", self.default_route)
+
+    def decide(self, resource, trust_score, degraded=False):
+        route = self.match(resource)
+        return route.decide_degraded(trust_score) if degraded else route.decide(trust_score)
+
+    def is_sensitive(self, resource):
+        return self.match(resource).sensitive
+
+
+def _freeze_decision(action, spec):
+    restrictions = spec.get("restrictions")
+    return MappingProxyType({
+        "action": action,
+        "restrictions": tuple(restrictions) if restrictions is not None else None,
+        "monitoring_level": spec["monitoring_level"],
+        "reason": spec["reason"],
+    })
+
+
+# fail-closed 路由在降级时的固定决策
+DEGRADED_DENY = _freeze_decision("deny", {"restrictions": ["blocked"], "monitoring_level": "alert",
+                                          "reason": "state_unavailable"})
+
+
+def _check_thresholds(where, thresholds):
+    thresholds = tuple(int(t) for t in thresholds)
+    if len(thresholds) != 3 or list(thresholds) != sorted(thresholds, reverse=True):
+        raise ValueError(f"{where}: thresholds 需为 3 个递减值，如 [80, 60, 40]")
+    return thresholds
+
+
+def _merge_route(where, base, spec):
+    """base：父路由的 (thresholds, {action: tier dict}, sensitive, on_degraded)；spec：文件里的覆盖项"""
+    thresholds, tiers, sensitive, on_degraded = base
+    if "thresholds" in spec:
+        thresholds = _check_thresholds(where, spec["thresholds"])
+    if "sensitive" in spec:
+        sensitive = bool(spec["sensitive"])
+    if "on_degraded" in spec:
+        on_degraded = spec["on_degraded"]
+        if on_degraded not in DEGRADED_MODES:
+            raise ValueError(f"{where}: on_degraded 必须是 {list(DEGRADED_MODES)} 之一")
+    overrides = spec.get("tiers") or {}
+    unknown = set(overrides) - set(ACTIONS)
+    if unknown:
+        raise ValueError(f"{where}: 未知档位 {sorted(unknown)}，可选 {list(ACTIONS)}")
+    merged = {}
+    for action in ACTIONS:
+        tier = dict(tiers[action])
+        override = overrides.get(action) or {}
+        bad = set(override) - set(TIER_FIELDS)
+        if bad:
+            raise ValueError(f"{where}.{action}: 未知字段 {sorted(bad)}")
+        tier.update(override)
+        merged[action] = tier
+    return thresholds, merged, sensitive, on_degraded
+
+
+def _route_policy(prefix, merged):
+    thresholds, tiers, sensitive, on_degraded = merged
+    decisions = tuple(_freeze_decision(a, tiers[a]) for a in ACTIONS)
+    return RoutePolicy(prefix, thresholds, decisions, sensitive, on_degraded == "closed")
+
+
+def compile_policy(doc, version="builtin", source=None):
+    """doc: {"defaults": {...}, "routes": [{"prefix": "/admin", ...}, ...]} → CompiledPolicy"""
+    doc = doc or {}
+    builtin = (DEFAULT_THRESHOLDS, {t["action"]: {k: t[k] for k in TIER_FIELDS} for t in POLICY_TIERS}, False,
+               "open")
+    defaults = _merge_route("defaults", builtin, doc.get("defaults") or {})
+
+    specs = doc.get("routes") or []
+    seen = set()
+    for i, spec in enumerate(specs):
+        prefix = spec.get("prefix") if isinstance(spec, dict) else None
+        if not isinstance(prefix, str) or not prefix.startswith("/"):
+            raise ValueError(f"routes[{i}]: prefix 必须是以 / 开头的字符串")
+        bad = set(spec) - set(ROUTE_FIELDS)
+        if bad:
+            raise ValueError(f"routes[{i}] ({prefix}): 未知字段 {sorted(bad)}")
+        if prefix in seen:
+            raise ValueError(f"routes[{i}]: 重复的 prefix {prefix}")
+        seen.add(prefix)
+
+    # 短前缀先编译，子前缀继承已编译的最近父前缀
+    trie = PrefixTrie()
+    merged_by_prefix = {}
+    parents = PrefixTrie()
+    for spec in sorted(specs, key=lambda s: len(s["prefix"])):
+        prefix = spec["prefix"]
+        base = parents.longest(prefix, defaults)
+        merged = _merge_route(prefix, base, spec)
+        merged_by_prefix[prefix] = merged
+        parents.insert(prefix, merged)
+        trie.insert(prefix, _route_policy(prefix, merged))
+
+    default_route = trie.longest("/") or _route_policy("/", defaults)
+    return CompiledPolicy(trie, default_route, version, source)
+
+
+def builtin_document():
+    """内置默认：原硬编码行为"""
+    return {"routes": [{"prefix": SENSITIVE_PREFIX, "sensitive": True, "on_degraded": "closed"}]}
+
+
+def load_document(path):
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith(".json"):
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        raise RuntimeError("YAML 策略文件需要 PyYAML：pip install pyyaml（或改用 .json）")
+    return yaml.safe_load(text)
+
+
+# ========== 热加载 ==========
+class PolicyEngine:
+    """current() 供每次决策调用：最多每 reload_interval 秒 stat 一次文件，mtime 变化才重新编译"""
+
+    def __init__(self, path=None, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.last_error = None
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._compiled = compile_policy(builtin_document())
+        self.reload(force=True)
+
+    def current(self):
+        if self.reload_due():
+            self.reload()
+        return self._compiled
+
+    def reload_due(self):
+        """下一次 current() 是否会 stat（可能还要重新编译）文件；异步模式据此先把 reload 丢到线程池"""
+        return bool(self.path) and self.reload_interval > 0 and time.monotonic() >= self._next_check
+
+    def reload(self, force=False):
+        """返回是否换上了新表；失败时保留旧表"""
+        if not self._lock.acquire(blocking=False):
+            return False  # 其他线程正在加载，本次沿用当前表
+        try:
+            self._next_check = time.monotonic() + self.reload_interval
+            try:
+                mtime = os.stat(self.path).st_mtime_ns if self.path else None
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self._mtime and not force:
+                return False
+            if mtime is None:
+                if self.path:
+                    # 只在启动或文件被删时提示一次（mtime 未变时不会走到这里）
+                    print(f"⚠️  策略文件 {self.path} 不存在，使用内置默认策略（{SENSITIVE_PREFIX} 敏感、降级时拒绝）")
+                compiled = compile_policy(builtin_document())
+            else:
+                try:
+                    compiled = compile_policy(load_document(self.path), version=str(mtime), source=self.path)
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    self._mtime = mtime  # 同一版本不反复重试，等文件再次修改
+                    POLICY_RELOADS.labels("error").inc()
+                    print(f"⚠️  策略文件加载失败，继续使用版本 {self._compiled.version}: {self.last_error}")
+                    return False
+            self._compiled = compiled  # 单次引用赋值：读方要么看到旧表，要么看到新表
+            self._mtime = mtime
+            self.last_error = None
+            POLICY_RELOADS.labels("ok").inc()
+            return True
+        finally:
+            self._lock.release()
+
+    def status(self):
+        compiled = self._compiled
+        return {"version": compiled.version, "source": compiled.source,
+                "routes": compiled.route_count, "last_error": self.last_error}
@@ -0,0 +1,233 @@
+"""
+访问频率估计 / 限流
+功能点：
+- sliding_window：两桶加权滑动窗口，est = prev * (1 - 已过比例) + cur
+  每用户每规则最多两个计数 key（当前桶/上一桶），2 个窗口后自然过期 → O(1) 内存
+- gcra：通用信元速率算法（令牌桶等价），每用户每规则只存一个 TAT 时间戳
+- 一次检查 = 一次 Redis 操作（Lua）；sliding_window 无脚本时退化为一次 pipeline 往返
+- 按资源前缀配置规则，最长前缀匹配，如 RATE_LIMITS="/admin=10/60,/=30/60"
+- recent_count()：同一份状态给 /api/user-behavior 的 recent_access_count 用
+- key_prefix 可注入：Redis Cluster 下用 user:{id} 哈希标签，与该用户其他状态同槽
+"""
+
+import math
+import time
+from collections import namedtuple
+
+from redis.exceptions import NoScriptError
+
+ALGORITHMS = ("sliding_window", "gcra")
+
+RateRule = namedtuple("RateRule", ["prefix", "limit", "window"])  # window 单位：秒
+
+# 供其他脚本内联复用：rate_hit(k1, k2, algo, now_ms, limit, window_ms) -> over, count
+RATE_HIT_LUA_FN = """
+local function rate_hit(k1, k2, algo, now, limit, window)
+  if algo == 'gcra' then
+    local interval = window / limit
+    local tat = tonumber(redis.call('GET', k1)) or now
+    if tat < now then tat = now end
+    local new_tat = tat + interval
+    local over = 0
+    if new_tat - now > window then
+      over = 1
+    else
+      tat = new_tat
+      redis.call('SET', k1, string.format('%d', math.ceil(tat)), 'PX', math.ceil(tat - now))
+    end
+    return over, math.ceil((tat - now) / interval)
+  end
+  local cur = redis.call('INCR', k1)
+  redis.call('PEXPIRE', k1, window * 2)
+  local prev = tonumber(redis.call('GET', k2)) or 0
+  local est = prev * (1 - (now % window) / window) + cur
+  local over = 0
+  if est > limit then over = 1 end
+  return over, math.floor(est)
+end
+"""
+
+# KEYS: 1=当前桶/TAT 2=上一桶（gcra 时不用）  ARGV: 1=algo 2=now_ms 3=limit 4=window_ms
+RATE_HIT_LUA = RATE_HIT_LUA_FN + """
+local over, count = rate_hit(KEYS[1], KEYS[2], ARGV[1], tonumber(ARGV[2]),
+                             tonumber(ARGV[3]), tonumber(ARGV[4]))
+return {over, count}
+"""
+
+
+def parse_rate_limits(spec):
+    """'/admin=10/60,/=30/60' -> [RateRule('/admin', 10, 60), RateRule('/', 30, 60)]（长前缀在前）"""
+    rules = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        prefix, _, rate = part.partition("=")
+        limit, _, window = rate.partition("/")
+        rules.append(RateRule(prefix.strip() or "/", int(limit), int(window or 60)))
+    if not any(r.prefix == "/" for r in rules):
+        rules.append(RateRule("/", 30, 60))
+    rules.sort(key=lambda r: len(r.prefix), reverse=True)
+    return rules
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def sliding_estimate(cur, prev, now, window_ms):
+    """与 Lua 相同的加权估计（浮点，超限判断用 est > limit）"""
+    return (prev or 0) * (1 - (now % window_ms) / window_ms) + (cur or 0)
+
+
+def estimate_sliding(cur, prev, now, window_ms):
+    """展示用的整数次数（纯读，不计数）"""
+    return int(sliding_estimate(cur, prev, now, window_ms))
+
+
+def estimate_gcra(tat, now, rule):
+    if not tat:
+        return 0
+    interval = rule.window * 1000 / rule.limit
+    return math.ceil(max(0, int(tat) - now) / interval)
+
+
+def memory_rate_hit(state, key, algorithm, now, rule):
+    """进程内等价实现（离线回放 / 内存后端）：state 为 dict，返回 (是否超限, 次数)"""
+    window_ms = rule.window * 1000
+    if algorithm == "gcra":
+        interval = window_ms / rule.limit
+        tat = max(state.get(key, now), now)
+        new_tat = tat + interval
+        if new_tat - now > window_ms:
+            return True, math.ceil((tat - now) / interval)
+        state[key] = math.ceil(new_tat)
+        return False, math.ceil((new_tat - now) / interval)
+    bucket = now // window_ms
+    buckets = state.setdefault(key, {})
+    buckets[bucket] = buckets.get(bucket, 0) + 1
+    for b in [b for b in buckets if b < bucket - 1]:
+        del buckets[b]
+    est = sliding_estimate(buckets[bucket], buckets.get(bucket - 1, 0), now, window_ms)
+    return est > rule.limit, int(est)
+
+
+def memory_rate_peek(state, key, algorithm, now, rule):
+    """memory_rate_hit 的只读版本：估计窗口内次数，不计数"""
+    if algorithm == "gcra":
+        return estimate_gcra(state.get(key), now, rule)
+    window_ms = rule.window * 1000
+    bucket = now // window_ms
+    buckets = state.get(key, {})
+    return estimate_sliding(buckets.get(bucket, 0), buckets.get(bucket - 1, 0), now, window_ms)
+
+
+def default_key_prefix(user_id):
+    return f"user:{user_id}"
+
+
+class RateLimiter:
+    """按前缀规则的频率估计器；状态 key：{key_prefix(id)}:rate:{prefix}:{桶号|tat}"""
+
+    def __init__(self, client, algorithm="sliding_window", rules=None, key_prefix=default_key_prefix):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm 必须是 {ALGORITHMS} 之一")
+        self.client = client
+        self.algorithm = algorithm
+        self.rules = list(rules) if rules else parse_rate_limits("/=30/60")
+        self.key_prefix = key_prefix
+        self._script = client.register_script(RATE_HIT_LUA)
+
+    def rule_for(self, resource):
+        resource = resource or "/"
+        for rule in self.rules:
+            if resource.startswith(rule.prefix):
+                return rule
+        return self.rules[-1]
+
+    def keys(self, user_id, rule, now):
+        base = f"{self.key_prefix(user_id)}:rate:{rule.prefix}"
+        if self.algorithm == "gcra":
+            return [f"{base}:tat", f"{base}:tat"]
+        bucket = now // (rule.window * 1000)
+        return [f"{base}:{bucket}", f"{base}:{bucket - 1}"]
+
+    def script_args(self, rule, now):
+        return [self.algorithm, now, rule.limit, rule.window * 1000]
+
+    # —— 计数（写） —— #
+    def hit(self, user_id, resource, now=None):
+        """返回 (是否超限, 估计的窗口内次数)"""
+        return self.hit_many(user_id, [resource], now)[0]
+
+    def hit_many(self, user_id, resources, now=None):
+        """同一用户的多次命中；一次往返"""
+        now = now_ms() if now is None else now
+        rules = [self.rule_for(r) for r in resources]
+        if self.algorithm == "gcra":
+            return self._hit_many_scripted(user_id, rules, now)
+
+        # sliding_window：每条规则 INCRBY n + PEXPIRE + GET 上一桶，本地推演每次命中的计数
+        per_rule = {}
+        for rule in rules:
+            per_rule[rule] = per_rule.get(rule, 0) + 1
+        pipe = self.client.pipeline(transaction=False)
+        for rule, n in per_rule.items():
+            cur_key, prev_key = self.keys(user_id, rule, now)
+            pipe.incrby(cur_key, n)
+            pipe.pexpire(cur_key, rule.window * 2000)
+            pipe.get(prev_key)
+        raw = pipe.execute()
+        state = {}
+        for i, (rule, n) in enumerate(per_rule.items()):
+            cur_after, _, prev = raw[3 * i: 3 * i + 3]
+            state[rule] = [int(cur_after) - n, int(prev or 0)]
+        out = []
+        for rule in rules:
+            st = state[rule]
+            st[0] += 1
+            est = sliding_estimate(st[0], st[1], now, rule.window * 1000)
+            out.append((est > rule.limit, int(est)))
+        return out
+
+    def _hit_many_scripted(self, user_id, rules, now):
+        for attempt in (0, 1):
+            pipe = self.client.pipeline(transaction=False)
+            for rule in rules:
+                keys = self.keys(user_id, rule, now)
+                pipe.evalsha(self._script.sha, len(keys), *keys, *self.script_args(rule, now))
+            try:
+                return [(bool(over), int(count)) for over, count in pipe.execute()]
+            except NoScriptError:
+                if attempt:
+                    raise
+                self._script.sha = self.client.script_load(RATE_HIT_LUA)
+
+    # —— 只读估计 —— #
+    def recent_counts(self, user_id, now=None):
+        """{前缀: 估计的窗口内次数}；一次 pipeline，不改变状态"""
+        now = now_ms() if now is None else now
+        pipe = self.client.pipeline(transaction=False)
+        for key in self.state_keys(user_id, now):
+            pipe.get(key)
+        return self.counts_from_state(pipe.execute(), now)
+
+    def state_keys(self, user_id, now):
+        """recent_counts 需要 GET 的 key（每条规则两个），供异步客户端复用"""
+        keys = []
+        for rule in self.rules:
+            keys.extend(self.keys(user_id, rule, now)[:2])
+        return keys
+
+    def counts_from_state(self, raw, now):
+        counts = {}
+        for i, rule in enumerate(self.rules):
+            a, b = raw[2 * i], raw[2 * i + 1]
+            if self.algorithm == "gcra":
+                counts[rule.prefix] = estimate_gcra(a, now, rule)
+            else:
+                counts[rule.prefix] = estimate_sliding(int(a or 0), int(b or 0), now, rule.window * 1000)
+        return counts
+
+    def recent_count(self, user_id, now=None):
+        return sum(self.recent_counts(user_id, now).values())
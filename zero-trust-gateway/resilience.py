@@ -0,0 +1,325 @@
+"""
+状态存储（Redis）慢 / 不可用时的降级：在延迟预算内给出决策，而不是卡住或返回 500
+功能点：
+- make_redis_client()：BlockingConnectionPool（连接数上限 + 等连接超时）+ socket 读写 / 建连超时，
+  任何一次 Redis 调用最多阻塞约一个预算
+- CircuitBreaker：closed 时连续 failure_threshold 次失败（异常，或超过预算的慢调用）→ open；
+  open 期间不碰 Redis；reset_timeout 秒后 half_open 放行 half_open_max 个试探，成功 → closed，失败 → open
+- ResilientStateBackend：包在 Redis 类后端外层（memory 后端不需要）
+  * score / score_many：断路器放行才调用；失败或打开 → 本地降级评分，flags 附加 degraded
+  * score_logged：内层在评分脚本里写日志时整体一次调用，失败则降级评分后照常 push_logs；否则拆成 score + push_logs
+  * push_logs：不可用时丢弃并计数，不影响决策
+  * ping / user_states / riskiest：不可用时抛 StateUnavailable（路由返回 503）
+- 降级评分（DegradedScorer）：off_hours / sensitive 照常；ip_change / unknown_device 查本地记录
+  （成功路径顺手记下的每用户 last_ip + 最近几个设备，LRU 有界）；本地没有该用户时按“无变化 / 已知”处理；
+  频率用进程内窗口（只看得到本 worker 的请求）；另扣 penalty 表示不确定
+- call_guarded / call_guarded_async：同一套断路器 + 预算计数，同步后端与异步模式（app_async.py）共用
+- fail-open / fail-closed 按资源前缀配置：policies.yaml 的 on_degraded（policy_engine.py）
+- 指标：zt_breaker_state（0=closed 1=half_open 2=open）、zt_breaker_transitions_total{to}、
+  zt_state_calls_total{result=ok|error|slow|rejected}、zt_degraded_scores_total{cause}、
+  zt_degraded_log_drops_total
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+import redis
+from prometheus_client import Counter, Gauge
+
+from rate_limit import memory_rate_hit, now_ms
+from scoring import (
+    BASE_SCORE, DEFAULT_WEIGHTS, clamp_score,
+    FLAG_IP_CHANGE, FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY, FLAG_SENSITIVE, FLAG_UNKNOWN_DEVICE, FLAG_DEGRADED,
+)
+from state_backend import StateBackend
+
+BREAKER_STATES = ("closed", "half_open", "open")
+BREAKER_STATE = Gauge("zt_breaker_state", "State-store circuit breaker state (0=closed 1=half_open 2=open)",
+                      multiprocess_mode="livemax")
+BREAKER_TRANSITIONS = Counter("zt_breaker_transitions_total", "State-store circuit breaker transitions", ["to"])
+STATE_CALLS = Counter("zt_state_calls_total", "State-store calls by outcome", ["result"])
+DEGRADED_SCORES = Counter("zt_degraded_scores_total", "Trust scores computed locally in degraded mode", ["cause"])
+DEGRADED_LOG_DROPS = Counter("zt_degraded_log_drops_total", "Access-log entries dropped while degraded")
+
+# 视为“状态存储不可用”的异常：连接 / 超时 / 池耗尽都是 RedisError 子类
+STATE_ERRORS = (redis.exceptions.RedisError, OSError)
+
+
+class StateUnavailable(Exception):
+    """cause: open（断路器打开，未调用） | error（调用失败）"""
+
+    def __init__(self, message, cause="error"):
+        super().__init__(message)
+        self.cause = cause
+
+
+def make_redis_client(host, port, pool_size=64, pool_timeout=0.05, socket_timeout=0.05, connect_timeout=0.2):
+    """超时单位：秒；pool_timeout 为等空闲连接的最长时间（池满即失败，不无限排队）"""
+    pool = redis.BlockingConnectionPool(
+        host=host, port=port, decode_responses=True,
+        max_connections=pool_size, timeout=pool_timeout,
+        socket_timeout=socket_timeout, socket_connect_timeout=connect_timeout,
+        socket_keepalive=True, health_check_interval=30,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+# ========== 断路器 ==========
+class CircuitBreaker:
+    """线程安全；closed 状态下 allow() 不加锁"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=5.0, half_open_max=1):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.half_open_max = max(1, half_open_max)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_failure = None
+        self._trials = 0
+        self._lock = threading.Lock()
+        BREAKER_STATE.set(0)
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self._transition("half_open")
+            if self.state == "closed":
+                return True
+            if self._trials >= self.half_open_max:
+                return False
+            self._trials += 1
+            return True
+
+    def record_success(self):
+        if self.state == "closed" and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != "closed":
+                self._transition("closed")
+
+    def record_failure(self, detail=""):
+        with self._lock:
+            self.last_failure = detail
+            if self.state == "half_open":
+                self._transition("open")
+            elif self.state == "closed":
+                self.failures += 1
+                if self.failures >= self.failure_threshold:
+                    self._transition("open")
+
+    def _transition(self, state):
+        self.state = state
+        self._trials = 0
+        if state == "open":
+            self.opened_at = time.monotonic()
+        else:
+            self.failures = 0
+        BREAKER_STATE.set(BREAKER_STATES.index(state))
+        BREAKER_TRANSITIONS.labels(state).inc()
+
+    def status(self):
+        out = {"state": self.state, "failures": self.failures, "last_failure": self.last_failure}
+        if self.state == "open":
+            out["retry_in_seconds"] = round(max(0.0, self.opened_at + self.reset_timeout - time.monotonic()), 3)
+        return out
+
+
+# ========== 带预算的调用 ==========
+def _admit(breaker):
+    if not breaker.allow():
+        STATE_CALLS.labels("rejected").inc()
+        raise StateUnavailable("状态存储断路器打开", cause="open")
+
+
+def _failed(breaker, e):
+    STATE_CALLS.labels("error").inc()
+    breaker.record_failure(f"{type(e).__name__}: {e}")
+    return StateUnavailable(str(e))
+
+
+def _finished(breaker, elapsed, latency_budget):
+    if elapsed > latency_budget:
+        # 结果照用，但按失败计：持续变慢同样会打开断路器
+        STATE_CALLS.labels("slow").inc()
+        breaker.record_failure(f"slow: {elapsed * 1000:.1f}ms")
+    else:
+        STATE_CALLS.labels("ok").inc()
+        breaker.record_success()
+
+
+def call_guarded(breaker, latency_budget, fn, *args):
+    """断路器放行才调用 fn；失败 / 打开抛 StateUnavailable，超预算的慢调用结果照用但计一次失败"""
+    _admit(breaker)
+    t0 = time.perf_counter()
+    try:
+        result = fn(*args)
+    except STATE_ERRORS as e:
+        raise _failed(breaker, e) from e
+    _finished(breaker, time.perf_counter() - t0, latency_budget)
+    return result
+
+
+async def call_guarded_async(breaker, latency_budget, fn, *args):
+    """同 call_guarded，fn 为协程函数"""
+    _admit(breaker)
+    t0 = time.perf_counter()
+    try:
+        result = await fn(*args)
+    except STATE_ERRORS as e:
+        raise _failed(breaker, e) from e
+    _finished(breaker, time.perf_counter() - t0, latency_budget)
+    return result
+
+
+# ========== 本地降级评分 ==========
+class DegradedScorer:
+    """user_id -> [last_ip, {设备指纹前缀: None}（最近 max_devices 个）, 频率状态]；用户数按 LRU 封顶"""
+
+    FP_CHARS = 16  # 本地只存指纹前 8 字节（hex），与 DEVICE_FP_BYTES 默认一致
+
+    def __init__(self, rate_limiter=None, max_users=100000, max_devices=8, penalty=10):
+        self.rate_limiter = rate_limiter
+        self.max_users = max_users
+        self.max_devices = max_devices
+        self.penalty = penalty
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, user_id):
+        """返回 (条目, 是否原本就有)；调用方持锁"""
+        e = self._users.get(user_id)
+        if e is not None:
+            self._users.move_to_end(user_id)
+            return e, True
+        e = self._users[user_id] = [None, OrderedDict(), {}]
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return e, False
+
+    def _learn(self, e, ip, fingerprint):
+        e[0] = ip
+        devices = e[1]
+        fp = (fingerprint or "")[:self.FP_CHARS]
+        devices[fp] = None
+        devices.move_to_end(fp)
+        if len(devices) > self.max_devices:
+            devices.popitem(last=False)
+
+    def remember(self, user_id, ip, fingerprint):
+        """成功路径调用：记下最近状态，供降级时比较"""
+        with self._lock:
+            e, _ = self._entry(user_id)
+            self._learn(e, ip, fingerprint)
+
+    def score(self, user_id, signals, now):
+        flags = []
+        with self._lock:
+            e, known_user = self._entry(user_id)
+            if known_user and e[0] and e[0] != signals.ip:
+                flags.append(FLAG_IP_CHANGE)
+            if signals.off_hours:
+                flags.append(FLAG_OFF_HOURS)
+            if self.rate_limiter is not None:
+                rule = self.rate_limiter.rule_for(signals.resource)
+                over, _ = memory_rate_hit(e[2], rule.prefix, self.rate_limiter.algorithm, now, rule)
+                if over:
+                    flags.append(FLAG_HIGH_FREQUENCY)
+            if signals.sensitive:
+                flags.append(FLAG_SENSITIVE)
+            if known_user and (signals.fingerprint or "")[:self.FP_CHARS] not in e[1]:
+                flags.append(FLAG_UNKNOWN_DEVICE)
+            self._learn(e, signals.ip, signals.fingerprint)
+        score = BASE_SCORE - sum(DEFAULT_WEIGHTS[f] for f in flags) - self.penalty
+        flags.append(FLAG_DEGRADED)
+        return clamp_score(score), flags
+
+
+# ========== 带断路器的后端 ==========
+class ResilientStateBackend(StateBackend):
+    """inner 的其余属性（redis / l1 / rate_limiter ...）原样透出"""
+
+    def __init__(self, inner, breaker=None, latency_budget=0.05, scorer=None):
+        self.inner = inner
+        self.breaker = breaker or CircuitBreaker()
+        self.latency_budget = latency_budget
+        self.scorer = scorer or DegradedScorer(getattr(inner, "rate_limiter", None))
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def _call(self, fn, *args):
+        return call_guarded(self.breaker, self.latency_budget, fn, *args)
+
+    def _degraded(self, user_id, signals_list, now, cause):
+        DEGRADED_SCORES.labels(cause).inc(len(signals_list))
+        now = now_ms() if now is None else now
+        return [self.scorer.score(user_id, s, now) for s in signals_list]
+
+    def preload(self):
+        try:
+            return self.inner.preload()
+        except STATE_ERRORS:
+            return False
+
+    def ping(self):
+        self._call(self.inner.ping)
+
+    def score(self, user_id, signals, now=None):
+        try:
+            result = self._call(self.inner.score, user_id, signals, now)
+        except StateUnavailable as e:
+            return self._degraded(user_id, [signals], now, e.cause)[0]
+        self.scorer.remember(user_id, signals.ip, signals.fingerprint)
+        return result
+
+    def score_many(self, user_id, signals_list, now=None):
+        if not signals_list:
+            return []
+        try:
+            results = self._call(self.inner.score_many, user_id, signals_list, now)
+        except StateUnavailable as e:
+            return self._degraded(user_id, signals_list, now, e.cause)
+        last = signals_list[-1]
+        self.scorer.remember(user_id, last.ip, last.fingerprint)
+        return results
+
+    @property
+    def logs_inline(self):
+        return self.inner.logs_inline
+
+    def score_logged(self, user_id, signals, route, now=None):
+        if not self.logs_inline:
+            return super().score_logged(user_id, signals, route, now)
+        try:
+            result = self._call(self.inner.score_logged, user_id, signals, route, now)
+        except StateUnavailable as e:
+            trust_score, flags = self._degraded(user_id, [signals], now, e.cause)[0]
+            return trust_score, flags, self._decide_and_log(user_id, signals.resource, route, trust_score, flags)
+        self.scorer.remember(user_id, signals.ip, signals.fingerprint)
+        return result
+
+    def count_hit(self, user_id, signals, now=None):
+        """不降级：抛 StateUnavailable，由调用方改走完整评分（会降级）"""
+        return self._call(self.inner.count_hit, user_id, signals, now)
+
+    def push_logs(self, entries, user_scores=None):
+        try:
+            self._call(self.inner.push_logs, entries, user_scores)
+        except StateUnavailable:
+            DEGRADED_LOG_DROPS.inc(len(entries))
+
+    def user_states(self, user_ids, now=None):
+        return self._call(self.inner.user_states, user_ids, now)
+
+    def riskiest(self, offset=0, limit=50):
+        return self._call(self.inner.riskiest, offset, limit)
+
+    def status(self):
+        return {"breaker": self.breaker.status(), "latency_budget_ms": round(self.latency_budget * 1000, 3)}
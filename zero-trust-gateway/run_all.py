@@ -1,9 +1,19 @@
-# run_all.py  —— 取 token → 跑三组请求 → 生成 out/decisions.csv & out/summary.csv
-import os, time, csv, json
+# run_all.py  —— 取 token → 按 GROUPS 加权混合做开环压测 → 生成 out/decisions.csv & out/summary.csv & out/latency.csv
+# 用法：
+#   python run_all.py                                  # Keycloak 取 token，默认 50 rps / 32 并发 / 150 次
+#   python run_all.py --local-token --users 20 --rps 500 --requests 20000
+#   python run_all.py --rps 0 --concurrency 64         # rps<=0：闭环，尽力而为
+# 开环：第 i 个请求的计划发出时间 = start + i/rps；延迟从“计划时间”算起，
+# 网关变慢导致排队时这段等待也计入延迟（避免 coordinated omission）。
+import os, csv, time, random, asyncio, argparse
 import requests
+import aiohttp
+import jwt
 from collections import Counter, defaultdict
 from datetime import datetime
 
+from latency_histogram import LatencyHistogram
+
 # ====== 配置（按需修改：与你的 app.py/Keycloak 保持一致） ======
 KC_BASE    = os.getenv("KC_BASE", "http://localhost:8080")
 REALM      = os.getenv("KC_REALM", "my-company")
@@ -17,7 +27,13 @@ API_URL    = os.getenv("GATEWAY_URL", "http://localhost:5000/api/access-request"
 OUT_DIR    = "out"
 DETAIL_CSV = os.path.join(OUT_DIR, "decisions.csv")
 SUMMARY_CSV= os.path.join(OUT_DIR, "summary.csv")
+LATENCY_CSV= os.path.join(OUT_DIR, "latency.csv")
+
+LOAD_RPS         = float(os.getenv("LOAD_RPS", "50"))
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "32"))
 
+# (组名, 资源, 权重, 闭环时每次请求后的 sleep 秒数, 额外请求头)
+# 权重即原来的“次数”：默认总请求数 = 权重之和，各组按权重比例随机混合
 GROUPS = [
     ("OK",     "/finance/report", 50, 0.00, {}),                 # 合法访问
     ("STEPUP", "/admin/panel",    50, 0.10, {}),                 # 中风险（轻微延时）
@@ -26,7 +42,7 @@ GROUPS = [
         "Accept-Language": "fr-FR"
     }),
 ]
-# 备注：你的网关规则是：1分钟>30次会降分；也可把 DENY 次数调大或缩短 sleep 进一步触发 403
+# 备注：你的网关规则是：1分钟>30次会降分；也可把 DENY 权重调大或提高 --rps 进一步触发 403
 
 # ====== 工具函数 ======
 def get_token():
@@ -43,6 +59,27 @@ def get_token():
     r.raise_for_status()
     return r.json()["access_token"]
 
+def mint_local_token(username, ttl=3600):
+    """本地签发的无签名 token（alg=none），仅用于网关开发模式（JWT_VERIFY_MODE=none）"""
+    now = int(time.time())
+    payload = {
+        "preferred_username": username,
+        "realm_access": {"roles": ["user"]},
+        "iss": "local-loadgen",
+        "iat": now,
+        "exp": now + ttl,
+    }
+    return jwt.encode(payload, None, algorithm="none")
+
+def build_tokens(args):
+    if not args.local_token:
+        return [get_token()]
+    if args.users.isdigit():
+        names = [f"user{i}" for i in range(int(args.users))]
+    else:
+        names = [u.strip() for u in args.users.split(",") if u.strip()]
+    return [mint_local_token(n) for n in names or [USERNAME]]
+
 def ensure_csv_header(path):
     os.makedirs(os.path.dirname(path), exist_ok=True)
     if not os.path.exists(path):
@@ -50,58 +87,123 @@ def ensure_csv_header(path):
             w = csv.writer(f)
             w.writerow(["ts","group","user_id","trust_score","resource","action","reason","latency_ms","http_status"])
 
-def post_once(token, resource, extra_headers=None):
+def build_plan(total, seed):
+    """按权重生成组序列（可复现）"""
+    rnd = random.Random(seed)
+    weights = [g[2] for g in GROUPS]
+    return rnd.choices(range(len(GROUPS)), weights=weights, k=total)
+
+async def post_once(session, token, resource, extra_headers=None):
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     if extra_headers:
         headers.update(extra_headers)
     body = {"resource": resource}
-    t0 = time.perf_counter()
     try:
-        resp = requests.post(API_URL, headers=headers, json=body, timeout=10)
-        latency_ms = int((time.perf_counter() - t0) * 1000)
-        try:
-            data = resp.json()
-        except Exception:
-            data = {}
-        return resp.status_code, latency_ms, data
-    except requests.RequestException as e:
-        latency_ms = int((time.perf_counter() - t0) * 1000)
-        return "ERR", latency_ms, {"error": str(e)}
+        async with session.post(API_URL, headers=headers, json=body) as resp:
+            try:
+                data = await resp.json(content_type=None)
+            except Exception:
+                data = {}
+            return resp.status, data
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return "ERR", {"error": str(e)}
+
+# ====== 压测主体 ======
+class Recorder:
+    """汇总：状态码计数 + 每组直方图 + 明细 CSV 行"""
+    def __init__(self, writer):
+        self.writer = writer
+        self.summary = defaultdict(Counter)
+        self.hists = defaultdict(LatencyHistogram)
+
+    def record(self, name, resource, code, latency_s, data):
+        action  = data.get("access_decision") or ""
+        reason  = data.get("reason") or ""
+        user_id = data.get("user_id") or ""
+        trust   = data.get("trust_score") if isinstance(data.get("trust_score"), int) else ""
+        latency_ms = int(latency_s * 1000)
+        self.writer.writerow([datetime.now().isoformat(), name, user_id, trust, resource, action, reason, latency_ms, code])
+        self.summary[name][code] += 1
+        self.hists[name].record_seconds(latency_s)
+
+async def run_load(tokens, plan, rps, concurrency, timeout, recorder):
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=30)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        async def one(i, gi, intended):
+            name, resource, _, sleep_s, extra_h = GROUPS[gi]
+            async with sem:
+                code, data = await post_once(session, tokens[i % len(tokens)], resource, extra_h)
+                recorder.record(name, resource, code, time.perf_counter() - intended, data)
+                if rps <= 0 and sleep_s > 0:
+                    await asyncio.sleep(sleep_s)
+
+        start = time.perf_counter()
+        tasks = []
+        for i, gi in enumerate(plan):
+            if rps > 0:
+                intended = start + i / rps
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                intended = time.perf_counter()
+            tasks.append(asyncio.create_task(one(i, gi, intended)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
 
 # ====== 主流程 ======
 def main():
-    token = get_token()
-    ensure_csv_header(DETAIL_CSV)
+    ap = argparse.ArgumentParser(description="零信任网关开环压测")
+    ap.add_argument("--rps", type=float, default=LOAD_RPS, help="目标请求速率（<=0 为闭环）")
+    ap.add_argument("--concurrency", type=int, default=LOAD_CONCURRENCY, help="最大在途请求数 / 连接池大小")
+    ap.add_argument("--requests", type=int, default=sum(g[2] for g in GROUPS), help="总请求数")
+    ap.add_argument("--timeout", type=float, default=10.0)
+    ap.add_argument("--local-token", action="store_true", help="本地签发无签名 token，不依赖 Keycloak")
+    ap.add_argument("--users", default=USERNAME, help="--local-token 时的用户：逗号列表或人数")
+    ap.add_argument("--seed", type=int, default=42)
+    args = ap.parse_args()
 
-    summary = defaultdict(Counter)
+    tokens = build_tokens(args)
+    plan = build_plan(args.requests, args.seed)
+    ensure_csv_header(DETAIL_CSV)
 
+    print(f"==> {len(plan)} 个请求，{len(tokens)} 个 token，rps={args.rps or '闭环'}，并发={args.concurrency}")
     with open(DETAIL_CSV, "a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-
-        for name, resource, times, sleep_s, extra_h in GROUPS:
-            print(f"==> Run {name}: {resource} x{times}")
-            for i in range(times):
-                code, latency_ms, data = post_once(token, resource, extra_h)
-                action  = data.get("access_decision") or ""
-                reason  = data.get("reason") or ""
-                user_id = data.get("user_id") or ""
-                trust   = data.get("trust_score") if isinstance(data.get("trust_score"), int) else ""
-                w.writerow([datetime.now().isoformat(), name, user_id, trust, resource, action, reason, latency_ms, code])
-                summary[name][code] += 1
-                if sleep_s > 0:
-                    time.sleep(sleep_s)
+        recorder = Recorder(csv.writer(f))
+        elapsed = asyncio.run(run_load(tokens, plan, args.rps, args.concurrency, args.timeout, recorder))
 
     # 输出汇总
     with open(SUMMARY_CSV, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["group","http_status","count"])
-        for g, cnt in summary.items():
+        for g, cnt in recorder.summary.items():
             for code, n in sorted(cnt.items(), key=lambda x: str(x[0])):
                 w.writerow([g, code, n])
 
+    overall = LatencyHistogram()
+    rows = []
+    for g, h in recorder.hists.items():
+        overall.merge(h)
+        rows.append((g, h.summary_ms()))
+    rows.append(("ALL", overall.summary_ms()))
+    with open(LATENCY_CSV, "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["group","count","p50_ms","p90_ms","p99_ms","p999_ms","max_ms"])
+        for g, s in rows:
+            w.writerow([g, s["count"], s["p50"], s["p90"], s["p99"], s["p999"], s["max"]])
+
+    print(f"\n{'group':<8}{'count':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'p999':>9}{'max':>9}  (ms)")
+    for g, s in rows:
+        print(f"{g:<8}{s['count']:>8}{s['p50']:>9}{s['p90']:>9}{s['p99']:>9}{s['p999']:>9}{s['max']:>9}")
+    print(f"\n实际吞吐：{len(plan) / elapsed:.1f} req/s（{elapsed:.2f}s）")
+
     print("\n✅ 完成。结果文件：")
     print(f" - {DETAIL_CSV} （明细：含 action/reason/latency_ms）")
     print(f" - {SUMMARY_CSV}（每组状态码统计）")
+    print(f" - {LATENCY_CSV}（每组 p50/p90/p99/p999 延迟）")
 
 if __name__ == "__main__":
     main()
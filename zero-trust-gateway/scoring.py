@@ -0,0 +1,109 @@
+"""
+信任分 / 策略的共享定义（无 Redis、无 Flask 依赖）
+功能点：
+- 扣分信号名、默认权重、非常规时段判断、设备指纹：实时路径（app.py / trust_script.py）
+  与离线回放（replay.py）共用同一份定义，保证结果一致
+- 固定规则五项 + 行为基线四项（baseline.py，按每用户历史判定）；基线认定为常规时段时不记 off_hours；
+  new_network 并入 ip_change：同一次请求已记 ip_change 时不再记 new_network（换到新网段只扣一次）
+- 默认阈值 80/60/40 对应 allow / allow_restricted / require_mfa / deny
+"""
+
+import hashlib
+
+# ========== 扣分信号 ==========
+FLAG_IP_CHANGE = "ip_change"
+FLAG_OFF_HOURS = "off_hours"
+FLAG_HIGH_FREQUENCY = "high_frequency"
+FLAG_SENSITIVE = "sensitive_operation"
+FLAG_UNKNOWN_DEVICE = "unknown_device"
+# 每用户行为基线（baseline.py）给出的信号
+FLAG_RATE_ANOMALY = "rate_anomaly"
+FLAG_UNUSUAL_HOUR = "unusual_hour"
+FLAG_NEW_NETWORK = "new_network"
+FLAG_NEW_ASN = "new_asn"
+
+# 不是扣分信号：状态存储不可用、分数由本地降级评分得出时附加（resilience.py）
+FLAG_DEGRADED = "degraded"
+
+# 回放特征矩阵的列顺序，也是 Lua 脚本里信号的判定顺序
+SIGNAL_ORDER = (FLAG_IP_CHANGE, FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY, FLAG_SENSITIVE, FLAG_UNKNOWN_DEVICE,
+                FLAG_RATE_ANOMALY, FLAG_UNUSUAL_HOUR, FLAG_NEW_NETWORK, FLAG_NEW_ASN)
+BASELINE_SIGNALS = SIGNAL_ORDER[5:]
+
+BASE_SCORE = 100
+DEFAULT_WEIGHTS = {
+    FLAG_IP_CHANGE: 20,
+    FLAG_OFF_HOURS: 15,
+    FLAG_HIGH_FREQUENCY: 30,
+    FLAG_SENSITIVE: 10,
+    FLAG_UNKNOWN_DEVICE: 25,
+    FLAG_RATE_ANOMALY: 20,
+    FLAG_UNUSUAL_HOUR: 10,
+    FLAG_NEW_NETWORK: 5,
+    FLAG_NEW_ASN: 15,
+}
+
+# 内置默认的敏感操作前缀；按前缀的配置见 policy_engine.py / policies.yaml
+SENSITIVE_PREFIX = "/admin"
+
+# ========== 策略档位 ==========
+DEFAULT_THRESHOLDS = (80, 60, 40)
+POLICY_TIERS = (
+    {"action": "allow", "restrictions": None, "monitoring_level": "normal", "reason": "low_risk"},
+    {"action": "allow_restricted", "restrictions": ["read_only"], "monitoring_level": "enhanced",
+     "reason": "mid_risk_readonly"},
+    {"action": "require_mfa", "restrictions": ["minimal_access"], "monitoring_level": "strict",
+     "reason": "high_risk_stepup"},
+    {"action": "deny", "restrictions": ["blocked"], "monitoring_level": "alert", "reason": "very_high_risk"},
+)
+
+
+def is_off_hours(hour):
+    return hour < 6 or hour > 23
+
+
+def is_sensitive(resource):
+    return (resource or "/").startswith(SENSITIVE_PREFIX)
+
+
+def device_fingerprint(context):
+    """匿名化设备指纹（最小实现：UA + 语言 + 可选平台/时区）"""
+    raw = "|".join([
+        context.get("user_agent", ""),
+        context.get("accept_language", ""),
+        context.get("platform", ""),
+        context.get("timezone", ""),
+    ])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def score_from_flags(flags, weights=DEFAULT_WEIGHTS):
+    """未截断的原始分（与 Redis 中保存的 trust_score 一致）"""
+    return BASE_SCORE - sum(weights[f] for f in flags)
+
+
+def fold_baseline_flags(ip_changed, baseline_flags):
+    """new_network 并入 ip_change：本次已记 ip_change 时去掉 new_network（Lua 脚本 / 回放同一规则）"""
+    if ip_changed and FLAG_NEW_NETWORK in baseline_flags:
+        return [f for f in baseline_flags if f != FLAG_NEW_NETWORK]
+    return baseline_flags
+
+
+def clamp_score(score):
+    return max(0, min(100, score))
+
+
+def tier_index(trust_score, thresholds=DEFAULT_THRESHOLDS):
+    for i, t in enumerate(thresholds):
+        if trust_score >= t:
+            return i
+    return len(thresholds)
+
+
+def select_policy(trust_score, thresholds=DEFAULT_THRESHOLDS):
+    """信任分 -> 策略 dict（每次返回新副本，调用方可修改）"""
+    tier = POLICY_TIERS[tier_index(trust_score, thresholds)]
+    policy = dict(tier)
+    if tier["restrictions"] is not None:
+        policy["restrictions"] = list(tier["restrictions"])
+    return policy
@@ -0,0 +1,112 @@
+# serve.py —— 多 worker 运行同步网关（gunicorn + gthread），指标跨 worker 聚合
+# 用法：
+#   python serve.py                                     # WEB_WORKERS 个进程 × WEB_THREADS 个线程，:5000
+#   WEB_WORKERS=8 WEB_THREADS=16 python serve.py
+#   python serve.py --workers 4 --bind 0.0.0.0:5000 --max-requests 50000
+#
+# 启动顺序（preload_app=True）：
+#   1. 主进程清空 PROMETHEUS_MULTIPROC_DIR 并设置环境变量 —— 必须在导入 app（定义指标）之前
+#   2. 主进程导入 app 并 warm_up()：SCRIPT LOAD、拉 JWKS、编译策略表，只做一次
+#   3. fork 出 worker；post_fork 里 init_worker()：丢弃继承的 Redis 连接，启动本进程的 JWKS 刷新线程
+#   4. worker 退出（崩溃 / max_requests 回收）时主进程把它的指标文件并入归档（metrics_export.mark_worker_dead）
+# STATE_BACKEND=memory 时状态在各 worker 内存里互不相通：多 worker 请用 redis / cluster
+# 决策日志：CSV / 归档文件只能有一个写者（归档追加前会截掉残块、字典编码各进程私有，CSV 会交错、轮转会互相覆盖），
+#   多 worker 时默认 DECISION_LOG_PER_PROCESS=1，每个 worker 写 out/decisions.<pid>.csv（或 .zta）；
+#   worker 回收后换新 pid、新文件。读取时传全部文件：
+#     python decision_archive.py summary out/decisions.*.zta
+#     python decision_archive.py convert out/decisions.*.csv out/decisions.zta
+#     python replay.py out/decisions.*.csv ...                 # 多个输入按 ts 归并
+# Windows 没有 gunicorn：退回单进程 python app.py
+import os
+import sys
+import argparse
+
+from metrics_export import prepare_multiproc_dir
+
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:5000")
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", str(os.cpu_count() or 1)))
+WEB_THREADS = int(os.getenv("WEB_THREADS", "8"))                # 每 worker 线程数（I/O 主要在等 Redis）
+WEB_TIMEOUT = int(os.getenv("WEB_TIMEOUT", "30"))
+WEB_KEEPALIVE = int(os.getenv("WEB_KEEPALIVE", "5"))
+WEB_BACKLOG = int(os.getenv("WEB_BACKLOG", "2048"))
+WEB_MAX_REQUESTS = int(os.getenv("WEB_MAX_REQUESTS", "0"))      # >0 时 worker 处理这么多请求后回收
+WEB_MAX_REQUESTS_JITTER = int(os.getenv("WEB_MAX_REQUESTS_JITTER", "0"))
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", os.path.join("out", "prometheus-multiproc"))
+
+
+def gunicorn_options(args):
+    return {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        "timeout": WEB_TIMEOUT,
+        "keepalive": WEB_KEEPALIVE,
+        "backlog": WEB_BACKLOG,
+        "max_requests": args.max_requests,
+        "max_requests_jitter": WEB_MAX_REQUESTS_JITTER,
+        "preload_app": True,
+        "accesslog": None,
+        "post_fork": _post_fork,
+        "child_exit": _child_exit,
+        "when_ready": _when_ready,
+    }
+
+
+# —— gunicorn 钩子 —— #
+def _post_fork(server, worker):
+    import app
+    app.init_worker()
+
+
+def _child_exit(server, worker):
+    from metrics_export import mark_worker_dead
+    mark_worker_dead(worker.pid)
+
+
+def _when_ready(server):
+    print(f"🚀 零信任网关启动: http://{server.cfg.bind[0]}  "
+          f"workers={server.cfg.workers} threads={server.cfg.threads}  指标目录 {METRICS_DIR}")
+    print("   健康检查:      /healthz")
+    print("   Prom指标:      /metrics（所有 worker 合并）")
+
+
+def run_gunicorn(options):
+    from gunicorn.app.base import BaseApplication
+
+    class GatewayApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import app
+            app.warm_up()
+            if app.STATE_BACKEND == "memory" and self.cfg.workers > 1:
+                print("⚠️  STATE_BACKEND=memory：各 worker 的用户状态互不共享")
+            return app.app
+
+    GatewayApplication().run()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="零信任网关多 worker 运行")
+    ap.add_argument("--bind", default=WEB_BIND)
+    ap.add_argument("--workers", type=int, default=WEB_WORKERS)
+    ap.add_argument("--threads", type=int, default=WEB_THREADS)
+    ap.add_argument("--max-requests", type=int, default=WEB_MAX_REQUESTS)
+    args = ap.parse_args(argv)
+
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        sys.exit("需要 gunicorn：pip install gunicorn（Windows 下请用单进程 python app.py）")
+
+    prepare_multiproc_dir(METRICS_DIR)
+    if args.workers > 1:
+        os.environ.setdefault("DECISION_LOG_PER_PROCESS", "1")  # 同 prepare_multiproc_dir：必须在导入 app 之前
+    run_gunicorn(gunicorn_options(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,690 @@
+"""
+信任分状态后端（可插拔）
+功能点：
+- StateBackend：网关只通过这组接口读写每用户状态（last_ip / 设备集合 / trust_score / 频率）、
+  访问日志与风险排行；信号提取（指纹、时间段、敏感操作）与策略选择仍在网关里
+- MemoryStateBackend：进程内实现，按 user_id 分条加锁（lock striping），
+  单机部署 / 基准 / 调试用，语义与 Lua 脚本一致（频率用 rate_limit.memory_rate_hit）
+- RedisStateBackend：原单节点 Redis 实现（EVALSHA 脚本路径 + 逐条调用回退 + 逐条路径可选 L1 缓存；
+  配置了失效频道时两种路径都在 IP 变化 / 学到新设备时 PUBLISH，见 l1_cache.py）
+  key 布局：user:alice:state（HASH：last_ip / trust_score / updated_at / flags，评分脚本内原子更新）
+           / :device_seen（有上限 ZSET，见 device_memory.py） / :rate:...
+  旧版 user:alice:last_ip / :trust_score 在该用户下次评分时读入 HASH 后删除；查询时 HASH 为空才回读旧 key
+- 批量查询 user_states()：所有用户的 HMGET + 频率状态放进一个 pipeline，一次往返
+- 风险排行：全局 ZSET risk:users（member=user_id，score=最近一次信任分），随访问日志一起写入，
+  只保留分数最低的 RISK_INDEX_MAX 个；riskiest() 分页读取
+- 访问日志：Redis Stream access_stream（紧凑字段，近似 MAXLEN，见 access_stream.py）；
+  score_logged() 评分 + 选策略 + 写日志：单节点脚本路径在同一次 EVALSHA 内 XADD，
+  其余情况评分后再 push_logs（一个 pipeline）；内存后端为有界 deque
+- RedisClusterStateBackend：同一实现，key 改为 user:{alice}:...（哈希标签）
+  → 同一用户的所有 key 落在同一槽，脚本与 pipeline 不会 CROSSSLOT
+- 可选行为基线（baseline=BaselineConfig，见 baseline.py）：内存后端存在 _UserState 里，
+  Redis 存在状态 HASH 的 baseline 字段，由评分脚本原子更新；signals.hour 为 None 时跳过
+"""
+
+import heapq
+import threading
+from collections import deque, namedtuple
+
+import redis
+
+from access_stream import ACCESS_STREAM_KEY, ACCESS_STREAM_MAXLEN, encode_entry, script_log_params
+from baseline import baseline_update
+from l1_cache import invalidation_message, new_instance_id
+from device_memory import DEFAULT_DEVICE_POLICY, compact_fingerprint, memory_device_seen, observe_device_set
+from instrumentation import stage
+from rate_limit import RateLimiter, memory_rate_hit, memory_rate_peek, now_ms, default_key_prefix
+from scoring import (
+    BASE_SCORE, DEFAULT_WEIGHTS, clamp_score, fold_baseline_flags,
+    FLAG_IP_CHANGE, FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY, FLAG_SENSITIVE, FLAG_UNKNOWN_DEVICE, FLAG_DEGRADED,
+)
+from trust_script import BaselineHitScript, TrustScoreScript, scripting_unavailable
+
+BACKENDS = ("redis", "cluster", "memory")
+RISK_INDEX_KEY = "risk:users"
+RISK_INDEX_MAX = 10000
+STATE_FIELDS = ("trust_score", "last_ip", "updated_at", "flags")
+
+# 一次评分所需的全部信号（由网关从请求上下文提取）；hour / net（IP 前缀键）/ asn 供行为基线使用
+ScoreSignals = namedtuple("ScoreSignals", ["ip", "fingerprint", "off_hours", "sensitive", "resource",
+                                           "hour", "net", "asn"], defaults=(None, 0, 0))
+# 只读查询结果：trust_score / last_ip / updated_at（毫秒）未评过分时为 None，flags 为上次扣分信号
+UserRisk = namedtuple("UserRisk", ["trust_score", "last_ip", "access_count", "updated_at", "flags"])
+
+
+def hash_tag_key_prefix(user_id):
+    """Cluster 布局：只对 {} 内的 user_id 计算槽位"""
+    return f"user:{{{user_id}}}"
+
+
+def _volatile_flags(off_hours, over, baseline_flags):
+    """决策缓存命中时重新得出的信号（顺序同 SIGNAL_ORDER）"""
+    flags = [FLAG_OFF_HOURS] if off_hours else []
+    if over:
+        flags.append(FLAG_HIGH_FREQUENCY)
+    flags.extend(baseline_flags)
+    return flags
+
+
+class StateBackend:
+    """后端接口；score/score_many 返回截断到 0~100 的分数与扣分信号"""
+
+    baseline = None  # BaselineConfig；None = 不启用行为基线
+    logs_inline = False  # score_logged() 是否在评分的同一次往返里写访问日志
+
+    def _baseline_params(self, signals):
+        """(BaselineConfig, hour, net, asn)；未启用或信号不带小时时 None"""
+        if self.baseline is None or signals.hour is None:
+            return None
+        return self.baseline, signals.hour, signals.net, signals.asn
+
+    def preload(self):
+        """预热（如 SCRIPT LOAD）；失败返回 False，不影响后续调用"""
+        return True
+
+    def ping(self):
+        """健康检查；不可用时抛异常"""
+
+    def score(self, user_id, signals, now=None):
+        """评分并更新该用户状态，返回 (trust_score, flags)"""
+        raise NotImplementedError
+
+    def score_many(self, user_id, signals_list, now=None):
+        """同一用户按顺序评分，结果与逐个 score() 相同"""
+        return [self.score(user_id, s, now) for s in signals_list]
+
+    def score_logged(self, user_id, signals, route, now=None):
+        """评分 + 按 route（policy_engine.RoutePolicy）选策略 + 写访问日志 / 风险排行，
+        返回 (trust_score, flags, decision)；默认实现为 score() 之后再 push_logs()"""
+        trust_score, flags = self.score(user_id, signals, now)
+        return trust_score, flags, self._decide_and_log(user_id, signals.resource, route, trust_score, flags)
+
+    def _decide_and_log(self, user_id, resource, route, trust_score, flags):
+        with stage("policy"):
+            if FLAG_DEGRADED in flags:
+                decision = route.decide_degraded(trust_score)
+            else:
+                decision = route.decide(trust_score)
+        with stage("log_push"):
+            self.push_logs([encode_entry(user_id, trust_score, resource, decision, flags)], {user_id: trust_score})
+        return decision
+
+    def push_logs(self, entries, user_scores=None):
+        """追加访问日志（access_stream.encode_entry 的字段 dict），只保留最近约 stream_maxlen 条；
+        user_scores={user_id: trust_score} 同时更新风险排行"""
+        raise NotImplementedError
+
+    def count_hit(self, user_id, signals, now=None):
+        """决策缓存命中时：只计一次频率、更新行为基线，不读写其余状态。
+        返回随时间变化的信号：off_hours（基线未认定为常规时段时）/ high_frequency / 基线信号"""
+        raise NotImplementedError
+
+    def user_state(self, user_id, now=None):
+        """返回该用户的 UserRisk"""
+        return self.user_states([user_id], now)[0]
+
+    def user_states(self, user_ids, now=None):
+        """按 user_ids 顺序返回 UserRisk 列表"""
+        raise NotImplementedError
+
+    def riskiest(self, offset=0, limit=50):
+        """风险排行（信任分升序，同分按 user_id）：返回 (排行总人数, [(user_id, trust_score), ...])"""
+        raise NotImplementedError
+
+
+# ========== 进程内（分条加锁） ==========
+class _UserState:
+    __slots__ = ("last_ip", "devices", "trust_score", "updated_at", "flags", "rate", "baseline")
+
+    def __init__(self):
+        self.last_ip = None
+        self.devices = {}  # 截断指纹 -> 最近出现毫秒
+        self.trust_score = None
+        self.updated_at = None
+        self.flags = ()
+        self.rate = {}
+        self.baseline = b""  # baseline.LAYOUT 打包的字节，与 Redis 中一致
+
+
+class _NoClient:
+    """RateLimiter 需要 register_script；内存后端不会真正调用"""
+
+    def register_script(self, script):
+        return None
+
+
+class MemoryStateBackend(StateBackend):
+    """stripes 把用户散到 N 把锁上：不同用户的请求基本不争同一把锁"""
+
+    def __init__(self, algorithm="sliding_window", rules=None, stripes=64, device_policy=DEFAULT_DEVICE_POLICY,
+                 baseline=None, stream_maxlen=ACCESS_STREAM_MAXLEN):
+        # 只借用规则匹配，不访问 Redis
+        self.rate_limiter = RateLimiter(_NoClient(), algorithm, rules)
+        self.device_policy = device_policy
+        self.baseline = baseline
+        self._locks = [threading.Lock() for _ in range(max(1, stripes))]
+        self._shards = [{} for _ in self._locks]
+        self._logs = deque(maxlen=stream_maxlen)
+        self._risk = {}  # user_id -> 最近一次信任分
+        self._logs_lock = threading.Lock()
+
+    def _stripe(self, user_id):
+        i = hash(user_id) % len(self._locks)
+        return self._locks[i], self._shards[i]
+
+    def _baseline_locked(self, st, signals, now):
+        params = self._baseline_params(signals)
+        if params is None:
+            return False, ()
+        st.baseline, typical, flags = baseline_update(st.baseline, now, *params[1:], config=params[0])
+        return typical, flags
+
+    def _score_locked(self, st, signals, now):
+        score = BASE_SCORE
+        flags = []
+        if st.last_ip and st.last_ip != signals.ip:
+            score -= DEFAULT_WEIGHTS[FLAG_IP_CHANGE]
+            flags.append(FLAG_IP_CHANGE)
+        typical, baseline_flags = self._baseline_locked(st, signals, now)
+        if signals.off_hours and not typical:
+            score -= DEFAULT_WEIGHTS[FLAG_OFF_HOURS]
+            flags.append(FLAG_OFF_HOURS)
+        rule = self.rate_limiter.rule_for(signals.resource)
+        over, _ = memory_rate_hit(st.rate, rule.prefix, self.rate_limiter.algorithm, now, rule)
+        if over:
+            score -= DEFAULT_WEIGHTS[FLAG_HIGH_FREQUENCY]
+            flags.append(FLAG_HIGH_FREQUENCY)
+        if signals.sensitive:
+            score -= DEFAULT_WEIGHTS[FLAG_SENSITIVE]
+            flags.append(FLAG_SENSITIVE)
+        policy = self.device_policy
+        member = compact_fingerprint(signals.fingerprint, policy.fp_bytes)
+        known, count, evicted_cap, evicted_ttl = memory_device_seen(st.devices, member, now, policy)
+        observe_device_set(count, evicted_cap, evicted_ttl)
+        if not known:
+            score -= DEFAULT_WEIGHTS[FLAG_UNKNOWN_DEVICE]
+            flags.append(FLAG_UNKNOWN_DEVICE)
+        for flag in fold_baseline_flags(FLAG_IP_CHANGE in flags, baseline_flags):
+            score -= DEFAULT_WEIGHTS[flag]
+            flags.append(flag)
+        st.last_ip = signals.ip or ""
+        st.trust_score = score
+        st.updated_at = now
+        st.flags = tuple(flags)
+        return clamp_score(score), flags
+
+    def score(self, user_id, signals, now=None):
+        return self.score_many(user_id, [signals], now)[0]
+
+    def score_many(self, user_id, signals_list, now=None):
+        now = now_ms() if now is None else now
+        lock, shard = self._stripe(user_id)
+        with lock:
+            st = shard.get(user_id)
+            if st is None:
+                st = shard[user_id] = _UserState()
+            return [self._score_locked(st, s, now) for s in signals_list]
+
+    def count_hit(self, user_id, signals, now=None):
+        now = now_ms() if now is None else now
+        rule = self.rate_limiter.rule_for(signals.resource)
+        lock, shard = self._stripe(user_id)
+        with lock:
+            st = shard.get(user_id)
+            if st is None:
+                st = shard[user_id] = _UserState()
+            over, _ = memory_rate_hit(st.rate, rule.prefix, self.rate_limiter.algorithm, now, rule)
+            typical, baseline_flags = self._baseline_locked(st, signals, now)
+        return _volatile_flags(signals.off_hours and not typical, over, baseline_flags)
+
+    def push_logs(self, entries, user_scores=None):
+        with self._logs_lock:
+            self._logs.extendleft(entries)
+            if user_scores:
+                self._risk.update(user_scores)
+                if len(self._risk) > RISK_INDEX_MAX:
+                    for user_id, _ in heapq.nlargest(len(self._risk) - RISK_INDEX_MAX, self._risk.items(),
+                                                     key=_risk_order):
+                        del self._risk[user_id]
+
+    def recent_logs(self, n=100):
+        """最新的在前"""
+        with self._logs_lock:
+            return list(self._logs)[:n]
+
+    def user_states(self, user_ids, now=None):
+        now = now_ms() if now is None else now
+        return [self._user_state(user_id, now) for user_id in user_ids]
+
+    def _user_state(self, user_id, now):
+        lock, shard = self._stripe(user_id)
+        with lock:
+            st = shard.get(user_id)
+            if st is None:
+                return UserRisk(None, None, 0, None, ())
+            count = sum(
+                memory_rate_peek(st.rate, rule.prefix, self.rate_limiter.algorithm, now, rule)
+                for rule in self.rate_limiter.rules
+            )
+            return UserRisk(st.trust_score, st.last_ip, count, st.updated_at, st.flags)
+
+    def riskiest(self, offset=0, limit=50):
+        with self._logs_lock:
+            items = list(self._risk.items())
+        ranked = heapq.nsmallest(offset + limit, items, key=_risk_order)
+        return len(items), ranked[offset:]
+
+
+def _risk_order(item):
+    """与 ZSET 相同的排序：分数升序，同分按 member"""
+    user_id, trust_score = item
+    return trust_score, user_id
+
+
+# ========== Redis（单节点） ==========
+class RedisStateBackend(StateBackend):
+    """mode=script：一次 EVALSHA；mode=calls：逐条调用（回退 / 基准对照）
+    l1：可选 LocalRiskCache，只在逐条调用路径挡在 last_ip / 设备查询前，subscriber 负责跨实例失效；
+    l1_channel 非空时（脚本路径也一样）在 IP 变化 / 学到新设备时发失效消息"""
+
+    key_prefix = staticmethod(default_key_prefix)
+
+    def __init__(self, client, mode="script", algorithm="sliding_window", rules=None,
+                 l1=None, subscriber=None, l1_channel="", device_policy=DEFAULT_DEVICE_POLICY, baseline=None,
+                 stream_maxlen=ACCESS_STREAM_MAXLEN):
+        self.redis = client
+        self.mode = mode
+        self.stream_maxlen = stream_maxlen
+        self.device_policy = device_policy
+        self.baseline = baseline
+        self._hit_script = BaselineHitScript(client, self.key_prefix) if baseline is not None else None
+        self._script = TrustScoreScript(client, self.key_prefix, device_policy) if mode == "script" else None
+        self.rate_limiter = RateLimiter(client, algorithm, rules, key_prefix=self.key_prefix)
+        self.l1 = l1
+        self._l1_subscriber = subscriber
+        self.l1_channel = l1_channel
+        self.instance_id = l1.instance_id if l1 is not None else new_instance_id()
+
+    def key(self, user_id, name):
+        return f"{self.key_prefix(user_id)}:{name}"
+
+    @property
+    def logs_inline(self):
+        return self._script is not None
+
+    def preload(self):
+        return self._script.preload() if self._script is not None else True
+
+    def ping(self):
+        self.redis.ping()
+
+    def _local_cache(self):
+        """返回 L1 缓存（未启用时 None）；首次使用 / fork 后启动订阅线程"""
+        if self.l1 is not None and self._l1_subscriber is not None:
+            self._l1_subscriber.start()
+        return self.l1
+
+    def _l1_notify(self, user_id):
+        """脚本内 PUBLISH 的 (频道, 消息)；未配置失效频道时 None"""
+        if not self.l1_channel:
+            return None
+        return (self.l1_channel, invalidation_message(self.instance_id, user_id))
+
+    def _queue_last_ip(self, pipe, user_id):
+        """HGET state.last_ip + 旧版 GET last_ip（同一往返）；结果交给 _last_ip_from"""
+        pipe.hget(self.key(user_id, "state"), "last_ip")
+        pipe.get(self.key(user_id, "last_ip"))
+
+    @staticmethod
+    def _last_ip_from(current, legacy):
+        """返回 (last_ip, 是否来自旧版 key)"""
+        if current is not None:
+            return current, False
+        return legacy, legacy is not None
+
+    def _queue_state_write(self, pipe, user_id, score, flags, now, last_ip=None, drop_legacy=False):
+        """一次 HSET 写入风险状态；last_ip=None 表示不改；drop_legacy 时顺带删除旧版 key"""
+        mapping = {"trust_score": score, "updated_at": now, "flags": ",".join(flags)}
+        if last_ip is not None:
+            mapping["last_ip"] = last_ip
+        pipe.hset(self.key(user_id, "state"), mapping=mapping)
+        if drop_legacy:
+            pipe.delete(self.key(user_id, "last_ip"), self.key(user_id, "trust_score"))
+
+    def _touch_devices(self, user_id, fingerprints, now, with_last_ip=False):
+        """逐条路径的设备记忆，语义同 Lua：一个 pipeline 内 [读 last_ip] + 老化 + 按顺序 ZADD/SREM，
+        有上限时每次 ZADD 后紧跟一次 ZREMRANGEBYRANK（同批后面的设备照样能挤掉前面的），最后 ZCARD。
+        返回 (last_ip, last_ip 是否来自旧版 key, [是否已知, ...])"""
+        policy = self.device_policy
+        key = self.key(user_id, "device_seen")
+        legacy = self.key(user_id, "devices")
+        capped = policy.max_devices > 0
+        pipe = self.redis.pipeline(transaction=False)
+        if with_last_ip:
+            self._queue_last_ip(pipe, user_id)
+        if policy.ttl_ms > 0:
+            pipe.zremrangebyscore(key, "-inf", now - policy.ttl_ms)
+        for fp in fingerprints:
+            pipe.zadd(key, {compact_fingerprint(fp, policy.fp_bytes): now})
+            pipe.srem(legacy, fp)
+            if capped:
+                pipe.zremrangebyrank(key, 0, -policy.max_devices - 1)
+        pipe.zcard(key)
+        if policy.ttl_ms > 0:
+            pipe.pexpire(key, policy.ttl_ms)
+        raw = pipe.execute()
+
+        last_ip, from_legacy = self._last_ip_from(raw.pop(0), raw.pop(0)) if with_last_ip else (None, False)
+        evicted_ttl = raw.pop(0) if policy.ttl_ms > 0 else 0
+        step = 3 if capped else 2
+        n = step * len(fingerprints)
+        known = [not added or bool(legacy_hit) for added, legacy_hit in zip(raw[0:n:step], raw[1:n:step])]
+        evicted_cap = sum(raw[2:n:step]) if capped else 0
+        count = raw[n]
+        observe_device_set(count, evicted_cap, evicted_ttl)
+        return last_ip, from_legacy, known
+
+    def _queue_device_refresh(self, pipe, user_id, fingerprints, now):
+        """L1 确认已知的设备：只刷新最近出现时间（ZADD XX，已被淘汰的不复活，也就不会超上限），
+        否则常用设备的时间戳停在 L1 条目写入时，会被 LRU 上限 / TTL 当成不活跃淘汰"""
+        key = self.key(user_id, "device_seen")
+        pipe.zadd(key, {compact_fingerprint(fp, self.device_policy.fp_bytes): now for fp in fingerprints}, xx=True)
+        if self.device_policy.ttl_ms > 0:
+            pipe.pexpire(key, self.device_policy.ttl_ms)
+
+    def _rate_script_params(self, user_id, resource, now):
+        rule = self.rate_limiter.rule_for(resource)
+        return self.rate_limiter.keys(user_id, rule, now), self.rate_limiter.script_args(rule, now)
+
+    # —— 单次评分 —— #
+    def score(self, user_id, signals, now=None):
+        """脚本功能不可用时回退逐条调用（见 _scripting_failed）"""
+        now = now_ms() if now is None else now
+        if self._script is not None:
+            try:
+                return self._score_scripted(user_id, signals, now)
+            except redis.exceptions.ResponseError as e:
+                self._scripting_failed(e)
+        return self._score_per_call(user_id, signals, now)
+
+    def score_logged(self, user_id, signals, route, now=None):
+        """脚本路径：访问日志 XADD 与风险排行在评分的同一次 EVALSHA 内写入（档位由脚本按 route 阈值判定，
+        与 route.decide 一致）；无脚本时同基类"""
+        if not self.logs_inline or self._script is None:
+            return super().score_logged(user_id, signals, route, now)
+        now = now_ms() if now is None else now
+        log = script_log_params(user_id, signals.resource, route, self.stream_maxlen,
+                                RISK_INDEX_KEY, RISK_INDEX_MAX)
+        try:
+            trust_score, flags = self._score_scripted(user_id, signals, now, log)
+        except redis.exceptions.ResponseError as e:
+            self._scripting_failed(e)
+            return super().score_logged(user_id, signals, route, now)
+        return trust_score, flags, route.decide(trust_score)
+
+    def _scripting_failed(self, e):
+        """脚本路径的 ResponseError：EVAL 不可用时本进程改走逐条调用（调用方随即回退）；
+        其他错误（READONLY / OOM / Lua 运行错误）脚本可能已部分执行，回退会重复计数，
+        原样抛出，由断路器 / 调用方处理，脚本模式保持开启"""
+        if not scripting_unavailable(e):
+            raise e
+        self._script = None
+
+    def _score_scripted(self, user_id, signals, now, log=None):
+        """一次 EVALSHA：读取/更新风险状态 HASH、频率与设备集合（log 非空时顺带写访问日志流）"""
+        rate_keys, rate_args = self._rate_script_params(user_id, signals.resource, now)
+        with stage("trust_score_script"):  # 各信号都在 Lua 内，整体计一段
+            score, flags = self._script.run(
+                user_id, signals.ip, signals.fingerprint,
+                off_hours=signals.off_hours, sensitive=signals.sensitive,
+                rate_keys=rate_keys, rate_args=rate_args,
+                notify=self._l1_notify(user_id),
+                baseline=self._baseline_params(signals),
+                log=log,
+            )
+        return clamp_score(score), flags
+
+    def _score_per_call(self, user_id, signals, now):
+        """逐条调用版本（约 6 次往返，非原子）：保留作回退与基准对照；L1 命中时跳过读取"""
+        score = BASE_SCORE
+        flags = []
+        l1 = self._local_cache()
+
+        # 1) IP变化
+        with stage("signal_ip_change"):
+            hit, last_ip = l1.get_last_ip(user_id) if l1 is not None else (False, None)
+            from_legacy = False
+            if not hit:
+                pipe = self.redis.pipeline(transaction=False)
+                self._queue_last_ip(pipe, user_id)
+                last_ip, from_legacy = self._last_ip_from(*pipe.execute())
+        current_ip = signals.ip
+        if last_ip and last_ip != current_ip:
+            score -= DEFAULT_WEIGHTS[FLAG_IP_CHANGE]
+            flags.append(FLAG_IP_CHANGE)
+
+        # 行为基线（轻量脚本，一次往返；未启用时跳过）
+        typical, baseline_flags = False, ()
+        params = self._baseline_params(signals)
+        if params is not None:
+            with stage("signal_baseline"):
+                _, typical, baseline_flags = self._hit_script.run(user_id, now, baseline=params)
+
+        # 2) 时间段（基线认定为该用户常规时段时不扣）
+        if signals.off_hours and not typical:
+            score -= DEFAULT_WEIGHTS[FLAG_OFF_HOURS]
+            flags.append(FLAG_OFF_HOURS)
+
+        # 3) 访问频率（真实滑动窗口 / GCRA，一次操作）
+        with stage("signal_rate_limit"):
+            over_limit, _ = self.rate_limiter.hit(user_id, signals.resource, now)
+        if over_limit:
+            score -= DEFAULT_WEIGHTS[FLAG_HIGH_FREQUENCY]
+            flags.append(FLAG_HIGH_FREQUENCY)
+
+        # 4) 敏感操作
+        if signals.sensitive:
+            score -= DEFAULT_WEIGHTS[FLAG_SENSITIVE]
+            flags.append(FLAG_SENSITIVE)
+
+        # 5) 设备指纹
+        fingerprint = signals.fingerprint
+        with stage("signal_device"):
+            # L1 命中时不回源；最近出现时间随下面的状态写 pipeline 刷新
+            known_device = l1 is not None and l1.is_known_device(user_id, fingerprint)
+            refresh_device = known_device
+            if not known_device:
+                # 查询即学习：ZADD 同时刷新最近出现时间
+                _, _, (known_device,) = self._touch_devices(user_id, [fingerprint], now)
+            if not known_device:
+                score -= DEFAULT_WEIGHTS[FLAG_UNKNOWN_DEVICE]
+                flags.append(FLAG_UNKNOWN_DEVICE)
+
+        for flag in fold_baseline_flags(FLAG_IP_CHANGE in flags, baseline_flags):
+            score -= DEFAULT_WEIGHTS[flag]
+            flags.append(flag)
+
+        # 保存状态（一个 pipeline）
+        with stage("state_write"):
+            pipe = self.redis.pipeline(transaction=False)
+            write_ip = last_ip != current_ip or l1 is None or from_legacy
+            self._queue_state_write(pipe, user_id, score, flags, now,
+                                    last_ip=current_ip if write_ip else None, drop_legacy=from_legacy)
+            if refresh_device:
+                self._queue_device_refresh(pipe, user_id, [fingerprint], now)
+            if self.l1_channel and (last_ip != current_ip or FLAG_UNKNOWN_DEVICE in flags):
+                pipe.publish(self.l1_channel, invalidation_message(self.instance_id, user_id))
+            pipe.execute()
+            if l1 is not None:
+                l1.remember(user_id, last_ip=current_ip, devices=[fingerprint])
+
+        return clamp_score(score), flags
+
+    # —— 批量评分 —— #
+    def score_many(self, user_id, signals_list, now=None):
+        """同一用户的 N 次评分：状态读写合并为一个 pipeline"""
+        if not signals_list:
+            return []
+        now = now_ms() if now is None else now
+        if self._script is not None:
+            items = []
+            for s in signals_list:
+                rate_keys, rate_args = self._rate_script_params(user_id, s.resource, now)
+                items.append((s.ip, s.fingerprint, s.off_hours, s.sensitive, rate_keys, rate_args,
+                              self._baseline_params(s)))
+            try:
+                scored = self._script.run_many(user_id, items, notify=self._l1_notify(user_id))
+            except redis.exceptions.ResponseError as e:
+                self._scripting_failed(e)
+            else:
+                return [(clamp_score(score), flags) for score, flags in scored]
+        return self._score_many_per_call(user_id, signals_list, now)
+
+    def _score_many_per_call(self, user_id, signals_list, now):
+        """无脚本时的批量版本：读 + 设备记忆 pipeline + 频率一次往返 + 本地顺序推演 + 写 pipeline"""
+        fingerprints = [s.fingerprint for s in signals_list]
+        l1 = self._local_cache()
+
+        hit, last_ip = l1.get_last_ip(user_id) if l1 is not None else (False, None)
+        known = [l1 is not None and l1.is_known_device(user_id, fp) for fp in fingerprints]
+        from_legacy = False
+        refresh_devices = hit and all(known)
+        if not refresh_devices:
+            # ZADD 按顺序执行：同批重复出现的设备第二次起即为已知
+            last_ip, from_legacy, known = self._touch_devices(user_id, fingerprints, now, with_last_ip=True)
+        first_ip = last_ip
+        rate_hits = self.rate_limiter.hit_many(user_id, [s.resource for s in signals_list], now)
+        params = [self._baseline_params(s) for s in signals_list]
+        if any(p is not None for p in params):
+            baselines = self._hit_script.run_many(user_id, now, params)
+        else:
+            baselines = [(False, False, ())] * len(signals_list)
+
+        results = []
+        raw_score = BASE_SCORE
+        for i, s in enumerate(signals_list):
+            score = BASE_SCORE
+            flags = []
+            if last_ip and last_ip != s.ip:
+                score -= DEFAULT_WEIGHTS[FLAG_IP_CHANGE]
+                flags.append(FLAG_IP_CHANGE)
+            _, typical, baseline_flags = baselines[i]
+            if s.off_hours and not typical:
+                score -= DEFAULT_WEIGHTS[FLAG_OFF_HOURS]
+                flags.append(FLAG_OFF_HOURS)
+            if rate_hits[i][0]:
+                score -= DEFAULT_WEIGHTS[FLAG_HIGH_FREQUENCY]
+                flags.append(FLAG_HIGH_FREQUENCY)
+            if s.sensitive:
+                score -= DEFAULT_WEIGHTS[FLAG_SENSITIVE]
+                flags.append(FLAG_SENSITIVE)
+            if not known[i]:
+                score -= DEFAULT_WEIGHTS[FLAG_UNKNOWN_DEVICE]
+                flags.append(FLAG_UNKNOWN_DEVICE)
+            for flag in fold_baseline_flags(FLAG_IP_CHANGE in flags, baseline_flags):
+                score -= DEFAULT_WEIGHTS[flag]
+                flags.append(flag)
+            last_ip = s.ip
+            raw_score = score
+            results.append((clamp_score(score), flags))
+
+        changed = not all(known) or any(s.ip != first_ip for s in signals_list)
+        pipe = self.redis.pipeline(transaction=False)
+        self._queue_state_write(pipe, user_id, raw_score, results[-1][1], now,
+                                last_ip=last_ip, drop_legacy=from_legacy)
+        if refresh_devices:
+            self._queue_device_refresh(pipe, user_id, fingerprints, now)
+        if self.l1_channel and changed:
+            pipe.publish(self.l1_channel, invalidation_message(self.instance_id, user_id))
+        pipe.execute()
+        if l1 is not None:
+            l1.remember(user_id, last_ip=last_ip, devices=fingerprints)
+        return results
+
+    def count_hit(self, user_id, signals, now=None):
+        """一次往返：频率 key（与评分脚本共用同一组计数）+ 启用时的行为基线"""
+        now = now_ms() if now is None else now
+        params = self._baseline_params(signals)
+        if params is None:
+            over, _ = self.rate_limiter.hit(user_id, signals.resource, now)
+            return _volatile_flags(signals.off_hours, over, ())
+        rate_keys, rate_args = self._rate_script_params(user_id, signals.resource, now)
+        over, typical, baseline_flags = self._hit_script.run(user_id, now, rate_keys, rate_args, params)
+        return _volatile_flags(signals.off_hours and not typical, over, baseline_flags)
+
+    # —— 日志 / 只读查询 —— #
+    def push_logs(self, entries, user_scores=None):
+        """一次往返：每条一个 XADD（近似 MAXLEN），有 user_scores 时再 ZADD + 裁剪风险排行"""
+        if not entries and not user_scores:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for fields in entries:
+            pipe.xadd(ACCESS_STREAM_KEY, fields, maxlen=self.stream_maxlen, approximate=True)
+        if user_scores:
+            pipe.zadd(RISK_INDEX_KEY, user_scores)
+            pipe.zremrangebyrank(RISK_INDEX_KEY, RISK_INDEX_MAX, -1)  # 只留分数最低的 RISK_INDEX_MAX 个
+        pipe.execute()
+
+    def user_states(self, user_ids, now=None):
+        """所有用户的 HMGET + 频率状态一个 pipeline 取回；HASH 为空的（未迁移）再回读一次旧版 key"""
+        now = now_ms() if now is None else now
+        pipe = self.redis.pipeline(transaction=False)
+        spans = []
+        for user_id in user_ids:
+            pipe.hmget(self.key(user_id, "state"), STATE_FIELDS)
+            rate_keys = self.rate_limiter.state_keys(user_id, now)
+            for key in rate_keys:
+                pipe.get(key)
+            spans.append(len(rate_keys))
+        raw = pipe.execute() if user_ids else []
+
+        states, pos = [], 0
+        for n in spans:
+            fields, rate_state = raw[pos], raw[pos + 1:pos + 1 + n]
+            pos += 1 + n
+            counts = self.rate_limiter.counts_from_state(rate_state, now)
+            states.append((fields, sum(counts.values())))
+
+        missing = [i for i, (fields, _) in enumerate(states) if fields[0] is None and fields[1] is None]
+        legacy = {}
+        if missing:
+            pipe = self.redis.pipeline(transaction=False)
+            for i in missing:
+                pipe.get(self.key(user_ids[i], "trust_score"))
+                pipe.get(self.key(user_ids[i], "last_ip"))
+            raw = pipe.execute()
+            legacy = {i: (raw[2 * k], raw[2 * k + 1]) for k, i in enumerate(missing)}
+
+        result = []
+        for i, ((trust_score, last_ip, updated_at, flags), count) in enumerate(states):
+            if i in legacy:
+                trust_score, last_ip = legacy[i]
+            result.append(UserRisk(
+                int(trust_score) if trust_score is not None else None,
+                last_ip,
+                count,
+                int(updated_at) if updated_at is not None else None,
+                tuple(flags.split(",")) if flags else (),
+            ))
+        return result
+
+    def riskiest(self, offset=0, limit=50):
+        """ZCARD + ZRANGE 一个 pipeline"""
+        if limit <= 0:
+            return self.redis.zcard(RISK_INDEX_KEY), []
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcard(RISK_INDEX_KEY)
+        pipe.zrange(RISK_INDEX_KEY, offset, offset + limit - 1, withscores=True)
+        total, rows = pipe.execute()
+        return total, [(user_id, int(score)) for user_id, score in rows]
+
+
+# ========== Redis Cluster ==========
+class RedisClusterStateBackend(RedisStateBackend):
+    """client 为 redis.cluster.RedisCluster；每用户 key 带 {user_id} 哈希标签，
+    脚本 KEYS 与单用户 pipeline 都落在同一槽。access_stream / risk:users 是全局 key，各自一个槽，
+    所以访问日志不进评分脚本，评分后由 push_logs 写入；user_states() 的多用户 pipeline 由 redis-py 按节点拆分"""
+
+    key_prefix = staticmethod(hash_tag_key_prefix)
+    logs_inline = False
+
@@ -0,0 +1,411 @@
+# stream_exporter.py —— 访问日志流（access_stream.py）→ 消费者组 → 决策日志文件 / Prometheus 指标
+# 用法：
+#   python stream_exporter.py run --csv out/access_log.csv                        # 6 列 CSV（同网关的 decisions.csv）
+#   python stream_exporter.py run --archive out/access_log.zta --metrics-port 9108
+#   python stream_exporter.py run --consumer exporter-2 --csv 'out/access_log.{consumer}.csv'
+#                                                                                  # 同组多进程并行，各取不同条目
+#   python stream_exporter.py info                                                 # 流长度、各组 pending / lag
+#   python stream_exporter.py bench -n 200000 --sink archive                      # fakeredis 上测导出吞吐
+# Redis 连接同 app.py（REDIS_HOST / REDIS_PORT）
+# 输出文件单写者：--csv / --archive 路径里的 {consumer} 换成消费者名，同组多进程各写各的文件；
+#   打开时对 <路径>.lock 加独占 flock，另一个进程已在写同一文件则直接退出（归档追加前会截断、字典编码私有，
+#   共写会损坏文件）。汇总时把各消费者的文件一起传给 decision_archive.py summary / replay.py
+#
+# 至少一次：每批先写入所有 sink 并 flush，成功后才 XACK。进程崩溃时未确认的条目留在 PEL（pending 列表），
+#   重启后先重读自己的 pending（ID 0），再定期 XAUTOCLAIM 认领其他消费者闲置超过 --claim-idle-ms 的条目，
+#   然后读新条目（>）。sink 写失败不确认，指数退避后从 pending 重试（可能重复写入，下游按流 ID 去重）。
+# 背压：拉模式，同一时刻只有一批在途，内存有界；批大小自适应 —— 读满一批就翻倍（积压时用大批摊薄往返与 flush），
+#   读不满就减半，范围 [--min-batch, --max-batch]；sink 变慢时读取自然放慢，不会在本进程里堆积。
+#   网关侧 XADD 从不等待导出（决策延迟不受 SIEM 影响），流按 ACCESS_STREAM_MAXLEN 近似裁剪：
+#   积压接近上限时最旧的未导出条目会被裁掉 —— zt_stream_export_lag 用于告警；已投递未确认就被裁掉的条目
+#   （XREADGROUP 返回空字段 / XAUTOCLAIM 返回的已删除 ID）直接确认并计入 zt_stream_export_trimmed_total
+# 指标（--metrics-port）：zt_stream_export_entries_total{sink}、zt_stream_export_batch_size、
+#   zt_stream_export_errors_total{sink}、zt_stream_export_lag、zt_stream_export_pending、
+#   zt_stream_export_trimmed_total、zt_stream_decisions_total{action,reason}、zt_stream_flags_total{flag}
+import os
+import sys
+import csv
+import time
+import random
+import signal
+import socket
+import argparse
+import tempfile
+
+import redis
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from access_stream import ACCESS_STREAM_KEY, csv_row, decode_entry, encode_entry
+from decision_archive import ArchiveWriter
+from replay import GATEWAY_CSV_COLUMNS
+from scoring import POLICY_TIERS, SIGNAL_ORDER
+
+EXPORTED = Counter("zt_stream_export_entries_total", "Access-stream entries written per sink", ["sink"])
+EXPORT_ERRORS = Counter("zt_stream_export_errors_total", "Access-stream export failures", ["sink"])
+EXPORT_BATCH = Histogram("zt_stream_export_batch_size", "Access-stream entries per exported batch",
+                         buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+EXPORT_LAG = Gauge("zt_stream_export_lag", "Access-stream entries not yet delivered to the consumer group")
+EXPORT_PENDING = Gauge("zt_stream_export_pending", "Access-stream entries delivered but not acknowledged")
+EXPORT_TRIMMED = Counter("zt_stream_export_trimmed_total", "Pending access-stream entries trimmed before export")
+STREAM_DECISIONS = Counter("zt_stream_decisions_total", "Decisions read from the access stream", ["action", "reason"])
+STREAM_FLAGS = Counter("zt_stream_flags_total", "Risk signals read from the access stream", ["flag"])
+
+
+# ====== sink：write() 只缓冲 / 计数，flush() 之后才确认 ======
+class OutputLocked(Exception):
+    pass
+
+
+def lock_output(path):
+    """对 path.lock 加非阻塞独占 flock，返回 fd（close 时释放）；已被其他进程持有则抛 OutputLocked。
+    没有 fcntl（Windows）时不加锁"""
+    d = os.path.dirname(path)
+    if d:
+        os.makedirs(d, exist_ok=True)
+    try:
+        import fcntl
+    except ImportError:
+        return None
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        raise OutputLocked(f"{path} 正被另一个导出进程写入：每个消费者写自己的文件（路径里用 {{consumer}}）")
+    return fd
+
+
+def _unlock(fd):
+    if fd is not None:
+        os.close(fd)
+
+
+class CsvSink:
+    name = "csv"
+
+    def __init__(self, path):
+        self._lock_fd = lock_output(path)
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, "a", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        if new_file:
+            self._writer.writerow(GATEWAY_CSV_COLUMNS)
+
+    def write(self, entries):
+        self._writer.writerows(csv_row(e) for e in entries)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        _unlock(self._lock_fd)
+
+
+class ArchiveSink:
+    """列式归档（decision_archive.py）；每批 flush 落一块，积压时批大，块也大"""
+
+    name = "archive"
+
+    def __init__(self, path):
+        self._lock_fd = lock_output(path)  # 先加锁再打开：ArchiveWriter 会截掉末尾残块
+        try:
+            self._writer = ArchiveWriter(path, GATEWAY_CSV_COLUMNS)
+        except Exception:
+            _unlock(self._lock_fd)
+            raise
+
+    def write(self, entries):
+        self._writer.writerows(csv_row(e) for e in entries)
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self):
+        self._writer.close()
+        _unlock(self._lock_fd)
+
+
+class MetricsSink:
+    name = "metrics"
+
+    def write(self, entries):
+        decisions, flags = {}, {}
+        for e in entries:
+            decisions[(e.action, e.reason)] = decisions.get((e.action, e.reason), 0) + 1
+            for flag in e.flags:
+                flags[flag] = flags.get(flag, 0) + 1
+        for (action, reason), n in decisions.items():
+            STREAM_DECISIONS.labels(action, reason).inc(n)
+        for flag, n in flags.items():
+            STREAM_FLAGS.labels(flag).inc(n)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# ====== 消费者 ======
+class StreamExporter:
+    def __init__(self, client, sinks, stream=ACCESS_STREAM_KEY, group="exporter", consumer=None,
+                 min_batch=100, max_batch=10000, block_ms=1000, claim_idle_ms=60000, stats_seconds=5.0,
+                 retry_max_seconds=30.0):
+        self.redis = client
+        self.sinks = list(sinks)
+        self.stream = stream
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.min_batch = max(1, min_batch)
+        self.max_batch = max(self.min_batch, max_batch)
+        self.batch = self.min_batch
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.stats_seconds = stats_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.exported = 0
+        self._replay = True       # 先重读自己的 pending
+        self._claim_cursor = "0-0"
+        self._next_claim = 0.0
+        self._next_stats = 0.0
+        self._stop = False
+
+    def ensure_group(self, start_id="$"):
+        """start_id=$ 只导出之后的新条目；0 从流里现存最旧的一条开始"""
+        try:
+            self.redis.xgroup_create(self.stream, self.group, id=start_id, mkstream=True)
+            return True
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+            return False
+
+    def stop(self, *_):
+        self._stop = True
+
+    def _read(self):
+        """返回 (条目列表, 是否为新条目)；pending 重读完毕后转入 >"""
+        if self._replay:
+            resp = self.redis.xreadgroup(self.group, self.consumer, {self.stream: "0"}, count=self.batch)
+            items = resp[0][1] if resp else []
+            if items:
+                return items, False
+            self._replay = False
+        if self.claim_idle_ms and time.monotonic() >= self._next_claim:
+            self._next_claim = time.monotonic() + self.claim_idle_ms / 1000
+            resp = self.redis.xautoclaim(self.stream, self.group, self.consumer, self.claim_idle_ms,
+                                         self._claim_cursor, count=self.batch)
+            self._claim_cursor = resp[0]
+            if len(resp) > 2 and resp[2]:
+                EXPORT_TRIMMED.inc(len(resp[2]))  # Redis 7：已被裁掉的 pending 由 XAUTOCLAIM 直接移出
+            if resp[1]:
+                self._replay = True  # 认领到的条目进了自己的 pending，下一轮按 pending 读
+                return resp[1], False
+        resp = self.redis.xreadgroup(self.group, self.consumer, {self.stream: ">"}, count=self.batch,
+                                     block=self.block_ms or None)
+        return (resp[0][1] if resp else []), True
+
+    def export(self, items):
+        """写入所有 sink 并 flush，成功后 XACK；失败抛出，条目留在 pending"""
+        entries, done = [], []
+        for entry_id, fields in items:
+            done.append(entry_id)
+            if not fields:  # 已投递、未确认期间被 MAXLEN 裁掉
+                EXPORT_TRIMMED.inc()
+                continue
+            try:
+                entries.append(decode_entry(entry_id, fields))
+            except (KeyError, ValueError, IndexError):
+                EXPORT_ERRORS.labels("decode").inc()  # 无法解析的条目不重试，确认掉
+        for sink in self.sinks:
+            try:
+                sink.write(entries)
+                sink.flush()
+            except Exception:
+                EXPORT_ERRORS.labels(sink.name).inc()
+                raise
+        if done:
+            self.redis.xack(self.stream, self.group, *done)
+        for sink in self.sinks:
+            EXPORTED.labels(sink.name).inc(len(entries))
+        EXPORT_BATCH.observe(len(done))
+        self.exported += len(entries)
+        return len(done)
+
+    def _adapt(self, n):
+        if n >= self.batch:
+            self.batch = min(self.max_batch, self.batch * 2)
+        elif n < self.batch // 2:
+            self.batch = max(self.min_batch, self.batch // 2)
+
+    def stats(self):
+        """{pending, lag, ...}：该组的 XINFO GROUPS 一行（lag 在 Redis < 7 或流被裁剪后可能为 None）"""
+        for g in self.redis.xinfo_groups(self.stream):
+            if g["name"] == self.group:
+                return g
+        return {}
+
+    def _update_stats(self):
+        if time.monotonic() < self._next_stats:
+            return
+        self._next_stats = time.monotonic() + self.stats_seconds
+        g = self.stats()
+        EXPORT_PENDING.set(g.get("pending") or 0)
+        if g.get("lag") is not None:
+            EXPORT_LAG.set(g["lag"])
+
+    def run_once(self):
+        """读一批、导出一批；返回处理条数（无新条目时为 0）"""
+        items, fresh = self._read()
+        if not items:
+            return 0
+        n = self.export(items)
+        if fresh:
+            self._adapt(n)
+        return n
+
+    def run(self, idle_exit=False):
+        """idle_exit=True 时读不到新条目即返回（bench / 一次性补导）"""
+        delay = 0.0
+        while not self._stop:
+            try:
+                n = self.run_once()
+                self._update_stats()
+            except Exception as e:
+                # Redis 不可用或 sink 写入失败：本批未确认，退避后从 pending 重试
+                delay = min(self.retry_max_seconds, max(0.1, delay * 2))
+                print(f"⚠️ 导出失败（{type(e).__name__}: {e}），{delay:.1f}s 后重试", file=sys.stderr)
+                self._replay = True
+                time.sleep(delay)
+                continue
+            delay = 0.0
+            if not n and idle_exit and not self._replay:
+                break
+        for sink in self.sinks:
+            sink.close()
+
+
+def make_sinks(args, consumer=""):
+    """文件路径里的 {consumer} 换成消费者名"""
+    sinks = []
+    if args.csv:
+        sinks.append(CsvSink(args.csv.replace("{consumer}", consumer)))
+    if getattr(args, "archive", None):
+        sinks.append(ArchiveSink(args.archive.replace("{consumer}", consumer)))
+    if getattr(args, "metrics_port", None) is not None:
+        sinks.append(MetricsSink())
+    return sinks
+
+
+def make_client():
+    return redis.Redis(host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")),
+                       decode_responses=True)
+
+
+# ====== 子命令 ======
+def cmd_run(args):
+    consumer = args.consumer or socket.gethostname()
+    try:
+        sinks = make_sinks(args, consumer)
+    except OutputLocked as e:
+        sys.exit(str(e))
+    if not sinks:
+        sys.exit("至少指定一个 sink：--csv / --archive / --metrics-port")
+    if args.metrics_port is not None:
+        start_http_server(args.metrics_port)
+    exporter = StreamExporter(make_client(), sinks, args.stream, args.group, consumer,
+                              args.min_batch, args.max_batch, args.block_ms, args.claim_idle_ms)
+    exporter.ensure_group(args.start)
+    signal.signal(signal.SIGTERM, exporter.stop)
+    signal.signal(signal.SIGINT, exporter.stop)
+    print(f"📤 {args.stream} → {', '.join(s.name for s in sinks)}  组 {args.group} / 消费者 {exporter.consumer}")
+    exporter.run(idle_exit=args.once)
+    print(f"已导出 {exporter.exported} 条")
+    return 0
+
+
+def cmd_info(args):
+    client = make_client()
+    if not client.exists(args.stream):
+        print(f"{args.stream} 不存在")
+        return 1
+    info = client.xinfo_stream(args.stream)
+    print(f"{args.stream}: {info['length']} 条  最新 {info['last-generated-id']}")
+    for g in client.xinfo_groups(args.stream):
+        print(f"  组 {g['name']:<16} 消费者 {g['consumers']:>3}  pending {g['pending']:>8}  "
+              f"lag {g.get('lag')}  已投递至 {g['last-delivered-id']}")
+    return 0
+
+
+def cmd_bench(args):
+    """fakeredis 上先灌 n 条（同网关字段编码），再由导出器读空；报告每条开销并核对条数"""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("需要 fakeredis：pip install fakeredis lupa")
+    client = fakeredis.FakeRedis(decode_responses=True)
+    rng = random.Random(7)
+    t0 = time.perf_counter()
+    for start in range(0, args.n, 1000):
+        pipe = client.pipeline(transaction=False)
+        for i in range(start, min(args.n, start + 1000)):
+            tier = POLICY_TIERS[rng.randrange(len(POLICY_TIERS))]
+            flags = [f for f in SIGNAL_ORDER if rng.random() < 0.1]
+            pipe.xadd(ACCESS_STREAM_KEY, encode_entry(f"user{i % 500}", rng.randrange(101), "/finance/report",
+                                                      tier, flags))
+        pipe.execute()
+    produce = time.perf_counter() - t0
+
+    tmp = tempfile.mkdtemp(prefix="zt-stream-")
+    args.csv = os.path.join(tmp, "access_log.csv") if args.sink == "csv" else None
+    args.archive = os.path.join(tmp, "access_log.zta") if args.sink == "archive" else None
+    args.metrics_port = 0 if args.sink == "metrics" else None
+    exporter = StreamExporter(client, make_sinks(args), min_batch=args.min_batch, max_batch=args.max_batch,
+                              block_ms=0, claim_idle_ms=0)
+    exporter.ensure_group("0")
+    t0 = time.perf_counter()
+    exporter.run(idle_exit=True)
+    consume = time.perf_counter() - t0
+
+    pending = exporter.stats().get("pending")
+    print(f"写入 {args.n} 条：{produce / args.n * 1e6:.1f} µs/条（fakeredis，含 pipeline 往返模拟）")
+    print(f"导出 {exporter.exported} 条 → {args.sink}：{consume / args.n * 1e6:.1f} µs/条"
+          f"（{args.n / consume:,.0f} 条/s），最终批大小 {exporter.batch}，pending {pending}")
+    ok = exporter.exported == args.n and not pending
+    print("✅ 全部导出并确认" if ok else "❌ 条数不符或仍有未确认条目")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="访问日志流消费者组导出")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    def common(p):
+        p.add_argument("--stream", default=ACCESS_STREAM_KEY)
+        p.add_argument("--group", default="exporter")
+        p.add_argument("--min-batch", type=int, default=100)
+        p.add_argument("--max-batch", type=int, default=10000)
+
+    r = sub.add_parser("run", help="持续导出")
+    common(r)
+    r.add_argument("--consumer", help="消费者名（默认主机名；重启沿用同名才能重读自己的 pending）")
+    r.add_argument("--csv", help="追加写 CSV（6 列，同 decisions.csv）；路径中的 {consumer} 换成消费者名")
+    r.add_argument("--archive", help="追加写列式归档（decision_archive.py）；路径中的 {consumer} 同上")
+    r.add_argument("--metrics-port", type=int, help="按决策 / 信号计数，在该端口暴露 /metrics")
+    r.add_argument("--start", default="$", help="新建组时的起点：$（只导新条目）| 0（从现存最旧的开始）")
+    r.add_argument("--block-ms", type=int, default=1000)
+    r.add_argument("--claim-idle-ms", type=int, default=60000, help="认领其他消费者闲置多久的 pending，0 = 不认领")
+    r.add_argument("--once", action="store_true", help="读空即退出")
+    i = sub.add_parser("info", help="流与消费者组状态")
+    i.add_argument("--stream", default=ACCESS_STREAM_KEY)
+    b = sub.add_parser("bench", help="fakeredis 上测导出吞吐")
+    common(b)
+    b.add_argument("-n", type=int, default=100000)
+    b.add_argument("--sink", choices=("csv", "archive", "metrics"), default="csv")
+    args = ap.parse_args(argv)
+    return {"run": cmd_run, "info": cmd_info, "bench": cmd_bench}[args.cmd](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
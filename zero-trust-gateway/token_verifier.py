@@ -0,0 +1,235 @@
+"""
+令牌验签子系统（Keycloak JWKS / RS256）
+功能点：
+- JwksKeyCache：按 kid 缓存公钥；后台线程定期刷新（fork 后在子进程重启）；遇到未知 kid 立即重拉（带最小间隔防刷）
+  重拉是单飞的：同一时刻只有一个线程在拉 JWKS，其余线程等它拉完再查一次
+- JWKS 拉不到（IdP / 网络故障）抛 KeySourceUnavailable 而不是 InvalidTokenError：网关据此回 503，不把 IdP 故障报成令牌无效
+- VerifiedClaimsCache：按 token 摘要缓存已验签 claims 的有界 LRU，token 的 exp 一过即淘汰
+- TokenVerifier.verify()：/api/access-request 与 verify_token 装饰器共用的唯一入口
+- JWKS 来源可以是 http(s) URL、file:// URL 或本地路径，便于离线/桩服务测试
+- mode="none" 保留开发期不验签行为（同样走 claims 缓存）
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib.request
+from collections import OrderedDict
+
+import jwt
+
+
+def _now():
+    return time.time()
+
+
+class KeySourceUnavailable(Exception):
+    """JWKS 拉取失败（网络 / IdP 故障 / 返回内容无法解析）"""
+
+
+# ========== JWKS 公钥缓存 ==========
+class JwksKeyCache:
+    """kid -> 公钥；线程安全"""
+
+    def __init__(self, source, refresh_interval=300, min_refetch_interval=10, timeout=5,
+                 on_refresh=None):
+        self.source = source
+        self.on_refresh = on_refresh
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()  # 单飞：同一时刻只有一个线程拉 JWKS
+        self._last_fetch = 0.0
+        self._last_attempt = 0.0
+        self._last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _load_jwks(self):
+        src = self.source
+        if src.startswith(("http://", "https://", "file://")):
+            with urllib.request.urlopen(src, timeout=self.timeout) as resp:
+                return json.loads(resp.read().decode("utf-8"))
+        with open(src, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def refresh(self):
+        """拉取一次 JWKS 并整体替换；返回当前 kid 集合。拉取失败抛 KeySourceUnavailable"""
+        with self._fetch_lock:
+            return self._refresh()
+
+    def _refresh(self):
+        """调用方持有 _fetch_lock"""
+        self._last_attempt = _now()
+        try:
+            jwks = self._load_jwks()
+            keys = {}
+            for jwk in jwt.PyJWKSet.from_dict(jwks).keys:
+                if jwk.key_id:
+                    keys[jwk.key_id] = jwk.key
+        except (OSError, ValueError, jwt.PyJWKSetError) as e:
+            self._last_error = e
+            raise KeySourceUnavailable(f"JWKS 拉取失败: {e}") from e
+        with self._lock:
+            self._keys = keys
+            self._last_fetch = self._last_attempt
+            self._last_error = None
+        if self.on_refresh is not None:
+            self.on_refresh(set(keys))
+        return set(keys)
+
+    def get(self, kid):
+        """返回 kid 对应公钥；未知 kid 触发一次限频重拉（单飞），仍找不到则抛 InvalidTokenError；
+        JWKS 拉不到（本次或最小间隔内的上一次）抛 KeySourceUnavailable"""
+        self.start()
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+        with self._fetch_lock:
+            # 等锁期间别的线程可能已经拉到了
+            key = self._keys.get(kid)
+            if key is None and _now() - self._last_attempt >= self.min_refetch_interval:
+                self._refresh()
+                key = self._keys.get(kid)
+            if key is None and self._last_error is not None:
+                raise KeySourceUnavailable(f"JWKS 不可用: {self._last_error}")
+        if key is None:
+            raise jwt.InvalidTokenError(f"未知的签名密钥 kid={kid}")
+        return key
+
+    def kids(self):
+        return set(self._keys)
+
+    # —— 后台刷新 —— #
+    def start(self):
+        """启动刷新线程；fork 之后（多 worker）在子进程里重新启动，已拉到的密钥沿用"""
+        if self._pid == os.getpid() or self.refresh_interval <= 0:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name="jwks-refresh", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        if not self._keys:
+            try:
+                self.refresh()
+            except Exception:
+                pass
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # 刷新失败：继续使用旧密钥，下个周期再试
+                pass
+
+
+# ========== 已验签 claims 缓存 ==========
+class VerifiedClaimsCache:
+    """token 摘要 -> (exp, kid, claims) 的有界 LRU"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            exp, _, claims = entry
+            if exp is not None and exp <= _now():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return claims
+
+    def put(self, digest, claims, kid=None):
+        if self.max_entries <= 0:
+            return
+        exp = claims.get("exp")
+        with self._lock:
+            self._entries[digest] = (exp, kid, claims)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def drop_kids_except(self, live_kids):
+        """JWKS 轮换后：丢弃由已下线密钥签发的缓存条目"""
+        with self._lock:
+            for d in [d for d, (_, kid, _) in self._entries.items()
+                      if kid is not None and kid not in live_kids]:
+                del self._entries[d]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# ========== 统一入口 ==========
+class TokenVerifier:
+    """mode: jwks（严格验签） | none（开发期不验签）"""
+
+    def __init__(self, mode="none", jwks_source=None, issuer=None, audience=None,
+                 algorithms=("RS256",), cache_size=10000, refresh_interval=300, leeway=0):
+        self.mode = mode
+        self.issuer = issuer
+        self.audience = audience
+        self.algorithms = list(algorithms)
+        self.leeway = leeway
+        self.claims_cache = VerifiedClaimsCache(cache_size)
+        self.keys = None
+        if mode == "jwks":
+            if not jwks_source:
+                raise ValueError("jwks 模式需要 JWKS 来源（URL 或文件路径）")
+            self.keys = JwksKeyCache(jwks_source, refresh_interval=refresh_interval,
+                                     on_refresh=self.claims_cache.drop_kids_except)
+
+    def cached(self, token):
+        """只查 claims 缓存（不验签）；异步模式据此决定是否需要把验签丢到线程池"""
+        return self.claims_cache.get(VerifiedClaimsCache.digest(token))
+
+    def verify(self, token):
+        """返回 claims；令牌无效抛 jwt.InvalidTokenError，JWKS 拉不到抛 KeySourceUnavailable"""
+        digest = VerifiedClaimsCache.digest(token)
+        claims = self.claims_cache.get(digest)
+        if claims is not None:
+            return claims
+
+        if self.mode == "none":
+            claims = jwt.decode(token, options={"verify_signature": False})
+            self.claims_cache.put(digest, claims)
+            return claims
+
+        kid = jwt.get_unverified_header(token).get("kid")
+        if not kid:
+            raise jwt.InvalidTokenError("令牌头缺少 kid")
+        key = self.keys.get(kid)
+        claims = jwt.decode(
+            token, key, algorithms=self.algorithms,
+            audience=self.audience, issuer=self.issuer, leeway=self.leeway,
+            options={"require": ["exp", "iat", "nbf"], "verify_signature": True, "verify_nbf": True,
+                     "verify_aud": self.audience is not None},
+        )
+        self.claims_cache.put(digest, claims, kid=kid)
+        return claims
+
+    def refresh_keys(self):
+        """手动刷新 JWKS（如收到密钥轮换通知）；失效 kid 的缓存由 on_refresh 清理"""
+        if self.keys is None:
+            return set()
+        return self.keys.refresh()
@@ -0,0 +1,351 @@
+"""
+信任分服务端脚本（Lua / EVALSHA）
+功能点：
+- 把 calculate_trust_score 的 GET/频率计数/SISMEMBER/SADD/SET 合并为一次 EVALSHA 往返
+- 频率信号内联 rate_limit.RATE_HIT_LUA_FN（sliding_window / gcra）
+- 脚本在 Redis 内原子执行：同一用户并发请求不再出现“先读后写”竞态
+- 返回 [score, flag1, flag2, ...]，flag 用于解释扣分来源
+- 进程启动时 SCRIPT LOAD 预加载；Redis 重启丢脚本时由 redis-py 自动 NOSCRIPT 重载
+- scripting_unavailable()：只有脚本功能本身不可用（EVAL 被禁用 / 代理不支持）才值得永久回退逐条调用
+- run_many()：批量接口把 N 次 EVALSHA 放进同一个 pipeline，一次往返
+- 可选 notify=(channel, message)：IP 变化或学到新设备时在脚本内 PUBLISH，供 L1 缓存跨实例失效
+- 所有 KEYS 共用同一前缀（key_prefix）：Cluster 下前缀带 {user_id} 哈希标签，脚本只落在一个槽
+- 已知设备为有上限的有序集合（device_memory.py）：截断二进制指纹、按最近出现淘汰、可选老化
+- last_ip / trust_score / updated_at / flags 写在同一个 HASH（{prefix}:state）里；
+  HASH 里还没有 last_ip 时读一次旧版 {prefix}:last_ip，并删除旧版两个 key（惰性迁移）
+- 可选每用户行为基线（baseline.py，内联 BASELINE_LUA_FN）：同一 HASH 的 baseline 字段（定长二进制），
+  脚本内读出、判定、写回；基线信号排在固定规则之后，基线认定为常规时段时不扣 off_hours
+- BaselineHitScript：只计频率 + 更新基线的轻量脚本（决策缓存命中 / 逐条调用路径）
+- 可选 log（access_stream.script_log_params）：按路由阈值判定档位，同一次 EVALSHA 内 XADD 访问日志流
+  （近似 MAXLEN）并更新风险排行；不写日志时 KEYS 8/9 用 state 占位（Cluster 下必须同槽）
+"""
+
+from string import Template
+
+from redis.exceptions import NoScriptError
+
+from access_stream import FLAG_BITS, LOG_OFF_ARGV
+from baseline import BASELINE_LUA_FN, baseline_args
+from device_memory import DEFAULT_DEVICE_POLICY, compact_fingerprint, observe_device_set
+from rate_limit import RATE_HIT_LUA_FN, default_key_prefix
+from scoring import (
+    BASE_SCORE, DEFAULT_WEIGHTS, BASELINE_SIGNALS,
+    FLAG_IP_CHANGE, FLAG_OFF_HOURS, FLAG_HIGH_FREQUENCY, FLAG_SENSITIVE, FLAG_UNKNOWN_DEVICE, FLAG_NEW_NETWORK,
+)
+
+# EVAL / EVALSHA 被 rename-command 禁用、或前置代理不支持脚本时的错误文本（小写比较）
+SCRIPTING_DISABLED_ERRORS = ("unknown command", "unknown subcommand")
+
+
+def scripting_unavailable(exc):
+    """ResponseError 是否表示脚本功能不可用（重载后仍 NOSCRIPT 也算）。
+    READONLY / OOM / Lua 运行错误等不算：脚本可能已部分执行，不能再逐条重跑一遍，应原样上抛"""
+    if isinstance(exc, NoScriptError):
+        return True
+    message = str(exc).lower()
+    return any(m in message for m in SCRIPTING_DISABLED_ERRORS)
+
+# KEYS: 1=state(HASH) 2=device_seen(ZSET) 3=旧版 last_ip 4/5=频率状态（见 rate_limit.RateLimiter.keys）
+#       6=旧版设备 SET（只 SREM） 7=旧版 trust_score（只 DEL） 8=访问日志流 9=风险排行 ZSET
+# ARGV: 1=current_ip 2=设备指纹（截断二进制） 3=off_hours(0/1) 4=sensitive(0/1)
+#       5=rate_algo 6=now_ms 7=rate_limit 8=rate_window_ms
+#       9=失效频道（空串=不发布） 10=失效消息
+#       11=每用户设备上限（0=不限） 12=设备老化毫秒（0=不老化） 13=设备指纹 hex（旧版 SET 成员）
+#       14=基线开关(0/1) 15=小时 16=IP 前缀键 17=ASN 18..24=基线配置（baseline.baseline_args）
+#       25=日志开关(0/1) 26=user_id 27=resource 28=流 MAXLEN 29..31=档位阈值 32..35=各档 reason（""=默认）
+#       36=风险排行上限
+# 返回：{score, 设备数, 上限淘汰数, 老化淘汰数, flag...}
+# 权重取自 scoring.DEFAULT_WEIGHTS，与逐条调用路径、离线回放共用
+_BASELINE_WEIGHTS_LUA = "{" + ", ".join(f"{f} = {DEFAULT_WEIGHTS[f]}" for f in BASELINE_SIGNALS) + "}"
+_BASELINE_OFF = ["0", "0", "0", "0", *(["0"] * 7)]
+_FLAG_BITS_LUA = "{" + ", ".join(f"{f} = {bit}" for f, bit in FLAG_BITS.items()) + "}"
+
+TRUST_SCORE_LUA = RATE_HIT_LUA_FN + BASELINE_LUA_FN + Template("""
+local score = $base
+local flags = {}
+
+local now = tonumber(ARGV[6])
+local changed = false
+local last_ip = redis.call('HGET', KEYS[1], 'last_ip')
+if not last_ip then
+  last_ip = redis.call('GET', KEYS[3])
+  if last_ip then
+    redis.call('DEL', KEYS[3], KEYS[7])
+  end
+end
+if last_ip ~= ARGV[1] then changed = true end
+local ip_flagged = false
+if last_ip and last_ip ~= ARGV[1] then
+  ip_flagged = true
+  score = score - $w_ip
+  flags[#flags + 1] = '$f_ip'
+end
+
+local bl_blob, bl_typical, bl_flags = nil, false, {}
+if ARGV[14] == '1' then
+  local cfg = {}
+  for i = 1, 7 do cfg[i] = tonumber(ARGV[17 + i]) end
+  bl_blob, bl_typical, bl_flags = baseline_update(redis.call('HGET', KEYS[1], 'baseline'), now,
+    tonumber(ARGV[15]), tonumber(ARGV[16]), tonumber(ARGV[17]), cfg)
+end
+
+if ARGV[3] == '1' and not bl_typical then
+  score = score - $w_off
+  flags[#flags + 1] = '$f_off'
+end
+
+local over = rate_hit(KEYS[4], KEYS[5], ARGV[5], now,
+                     tonumber(ARGV[7]), tonumber(ARGV[8]))
+if over == 1 then
+  score = score - $w_freq
+  flags[#flags + 1] = '$f_freq'
+end
+
+if ARGV[4] == '1' then
+  score = score - $w_sens
+  flags[#flags + 1] = '$f_sens'
+end
+
+local dev_cap = tonumber(ARGV[11])
+local dev_ttl = tonumber(ARGV[12])
+local evicted_ttl = 0
+local evicted_cap = 0
+if dev_ttl > 0 then
+  evicted_ttl = redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - dev_ttl)
+end
+local dev_new = redis.call('ZADD', KEYS[2], now, ARGV[2]) == 1
+if dev_new and redis.call('SREM', KEYS[6], ARGV[13]) == 1 then
+  dev_new = false
+end
+local dev_count = redis.call('ZCARD', KEYS[2])
+if dev_new then
+  changed = true
+  score = score - $w_dev
+  flags[#flags + 1] = '$f_dev'
+end
+if dev_cap > 0 and dev_count > dev_cap then
+  evicted_cap = redis.call('ZREMRANGEBYRANK', KEYS[2], 0, dev_count - dev_cap - 1)
+  dev_count = dev_cap
+end
+if dev_ttl > 0 then
+  redis.call('PEXPIRE', KEYS[2], dev_ttl)
+end
+
+local bl_weights = $bl_weights
+for i = 1, #bl_flags do
+  -- new_network 并入 ip_change（scoring.fold_baseline_flags）
+  if not (ip_flagged and bl_flags[i] == '$f_net') then
+    score = score - bl_weights[bl_flags[i]]
+    flags[#flags + 1] = bl_flags[i]
+  end
+end
+
+redis.call('HSET', KEYS[1], 'last_ip', ARGV[1], 'trust_score', score,
+           'updated_at', now, 'flags', table.concat(flags, ','))
+if bl_blob then
+  redis.call('HSET', KEYS[1], 'baseline', bl_blob)
+end
+if changed and ARGV[9] ~= '' then
+  redis.call('PUBLISH', ARGV[9], ARGV[10])
+end
+
+if ARGV[25] == '1' then
+  local s = math.max(0, math.min(100, score))
+  local tier = 3
+  for i = 1, 3 do
+    if s >= tonumber(ARGV[28 + i]) then
+      tier = i - 1
+      break
+    end
+  end
+  local flag_bits = $flag_bits
+  local bits = 0
+  for i = 1, #flags do
+    bits = bits + flag_bits[flags[i]]
+  end
+  local reason = ARGV[32 + tier]
+  if reason == '' then
+    redis.call('XADD', KEYS[8], 'MAXLEN', '~', ARGV[28], '*', 'u', ARGV[26], 'r', ARGV[27], 's', s,
+               'a', tier, 'f', bits)
+  else
+    redis.call('XADD', KEYS[8], 'MAXLEN', '~', ARGV[28], '*', 'u', ARGV[26], 'r', ARGV[27], 's', s,
+               'a', tier, 'f', bits, 'c', reason)
+  end
+  redis.call('ZADD', KEYS[9], s, ARGV[26])
+  redis.call('ZREMRANGEBYRANK', KEYS[9], tonumber(ARGV[36]), -1)
+end
+
+local result = {score, dev_count, evicted_cap, evicted_ttl}
+for i = 1, #flags do
+  result[#result + 1] = flags[i]
+end
+return result
+""").substitute(
+    base=BASE_SCORE,
+    w_ip=DEFAULT_WEIGHTS[FLAG_IP_CHANGE], f_ip=FLAG_IP_CHANGE,
+    w_off=DEFAULT_WEIGHTS[FLAG_OFF_HOURS], f_off=FLAG_OFF_HOURS,
+    w_freq=DEFAULT_WEIGHTS[FLAG_HIGH_FREQUENCY], f_freq=FLAG_HIGH_FREQUENCY,
+    w_sens=DEFAULT_WEIGHTS[FLAG_SENSITIVE], f_sens=FLAG_SENSITIVE,
+    w_dev=DEFAULT_WEIGHTS[FLAG_UNKNOWN_DEVICE], f_dev=FLAG_UNKNOWN_DEVICE,
+    f_net=FLAG_NEW_NETWORK,
+    bl_weights=_BASELINE_WEIGHTS_LUA,
+    flag_bits=_FLAG_BITS_LUA,
+)
+
+# 轻量脚本：KEYS 1=state 2/3=频率状态
+# ARGV: 1=是否计频率(0/1) 2=rate_algo 3=now_ms 4=rate_limit 5=rate_window_ms
+#       6=基线开关(0/1) 7=小时 8=IP 前缀键 9=ASN 10..16=基线配置
+# 返回：{是否超限, 是否常规时段(0/1), 基线信号...}
+BASELINE_HIT_LUA = RATE_HIT_LUA_FN + BASELINE_LUA_FN + """
+local now = tonumber(ARGV[3])
+local over = 0
+if ARGV[1] == '1' then
+  over = rate_hit(KEYS[2], KEYS[3], ARGV[2], now, tonumber(ARGV[4]), tonumber(ARGV[5]))
+end
+local result = {over, 0}
+if ARGV[6] == '1' then
+  local cfg = {}
+  for i = 1, 7 do cfg[i] = tonumber(ARGV[9 + i]) end
+  local blob, typical, flags = baseline_update(redis.call('HGET', KEYS[1], 'baseline'), now,
+    tonumber(ARGV[7]), tonumber(ARGV[8]), tonumber(ARGV[9]), cfg)
+  redis.call('HSET', KEYS[1], 'baseline', blob)
+  if typical then result[2] = 1 end
+  for i = 1, #flags do result[#result + 1] = flags[i] end
+end
+return result
+"""
+
+
+def _baseline_argv(baseline):
+    """baseline=(BaselineConfig, hour, 前缀键, asn) 或 None（不启用）"""
+    if baseline is None:
+        return _BASELINE_OFF
+    config, hour, net, asn = baseline
+    return [1, hour, net, asn, *baseline_args(config)]
+
+
+class TrustScoreScript:
+    """对 redis-py Script 的薄封装：预加载 + 解析返回值"""
+
+    def __init__(self, client, key_prefix=default_key_prefix, device_policy=DEFAULT_DEVICE_POLICY):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.device_policy = device_policy
+        self._script = client.register_script(TRUST_SCORE_LUA)
+
+    def preload(self):
+        """SCRIPT LOAD；Redis 不可达时返回 False，首次调用时再由 EVALSHA 兜底加载"""
+        try:
+            self._script.sha = self.client.script_load(TRUST_SCORE_LUA)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _keys(prefix, rate_keys, log_keys=None):
+        """prefix 为 key_prefix(user_id)，如 user:alice 或 user:{alice}；log_keys=[流, 风险排行] 或 None"""
+        return [
+            f"{prefix}:state",
+            f"{prefix}:device_seen",
+            f"{prefix}:last_ip",
+            *rate_keys,
+            f"{prefix}:devices",
+            f"{prefix}:trust_score",
+            *(log_keys or (f"{prefix}:state", f"{prefix}:state")),
+        ]
+
+    @staticmethod
+    def _args(current_ip, fingerprint, off_hours, sensitive, rate_args, notify,
+              device_policy=DEFAULT_DEVICE_POLICY, baseline=None, log_argv=None):
+        """fingerprint 为 64 字符 hex（scoring.device_fingerprint）；集合里存的是截断后的字节
+        baseline=(BaselineConfig, hour, 前缀键, asn) 时更新并判定行为基线；
+        log_argv 为 access_stream.script_log_params 的 ARGV 部分（None = 不写日志）"""
+        return [
+            current_ip or "",
+            compact_fingerprint(fingerprint, device_policy.fp_bytes),
+            1 if off_hours else 0,
+            1 if sensitive else 0,
+            *rate_args,
+            *(notify or ("", "")),
+            device_policy.max_devices,
+            device_policy.ttl_ms,
+            fingerprint,
+            *_baseline_argv(baseline),
+            *(log_argv or LOG_OFF_ARGV),
+        ]
+
+    @staticmethod
+    def _parse(result):
+        """返回 (score, flags)；设备集合大小 / 淘汰数直接记入指标"""
+        score = int(result[0])
+        observe_device_set(int(result[1]), int(result[2]), int(result[3]))
+        flags = [f.decode() if isinstance(f, bytes) else f for f in result[4:]]
+        return score, flags
+
+    def run(self, user_id, current_ip, fingerprint, off_hours, sensitive, rate_keys, rate_args,
+            notify=None, baseline=None, log=None):
+        """rate_keys / rate_args 由 RateLimiter.keys() / script_args() 生成；
+        log=(KEYS, ARGV) 由 access_stream.script_log_params 生成"""
+        log_keys, log_argv = log or (None, None)
+        keys = self._keys(self.key_prefix(user_id), rate_keys, log_keys)
+        args = self._args(current_ip, fingerprint, off_hours, sensitive, rate_args, notify, self.device_policy,
+                          baseline, log_argv)
+        return self._parse(self._script(keys=keys, args=args))
+
+    def run_many(self, user_id, items, notify=None):
+        """items: [(current_ip, fingerprint, off_hours, sensitive, rate_keys, rate_args, baseline), ...]
+        按顺序在同一 pipeline 内执行"""
+        for attempt in (0, 1):
+            pipe = self.client.pipeline(transaction=False)
+            for current_ip, fingerprint, off_hours, sensitive, rate_keys, rate_args, baseline in items:
+                keys = self._keys(self.key_prefix(user_id), rate_keys)
+                args = self._args(current_ip, fingerprint, off_hours, sensitive, rate_args, notify,
+                                  self.device_policy, baseline)
+                pipe.evalsha(self._script.sha, len(keys), *keys, *args)
+            try:
+                return [self._parse(r) for r in pipe.execute()]
+            except NoScriptError:
+                # 脚本缓存被清空：整批都未执行，重新加载后重放一次
+                if attempt:
+                    raise
+                self.preload()
+
+
+class BaselineHitScript:
+    """BASELINE_HIT_LUA 的封装：run() 返回 (是否超限, 是否常规时段, [基线信号...])"""
+
+    def __init__(self, client, key_prefix=default_key_prefix):
+        self.client = client
+        self.key_prefix = key_prefix
+        self._script = client.register_script(BASELINE_HIT_LUA)
+
+    def _keys_args(self, user_id, now, rate_keys, rate_args, baseline):
+        state = f"{self.key_prefix(user_id)}:state"
+        # 不计频率时用 state 占位：Cluster 下所有 KEYS 必须同槽
+        keys = [state, *(rate_keys or (state, state))[:2]]
+        rate_argv = [rate_args[0], now, *rate_args[2:]] if rate_keys else ["", now, 0, 0]
+        return keys, [1 if rate_keys else 0, *rate_argv, *_baseline_argv(baseline)]
+
+    @staticmethod
+    def _parse(result):
+        flags = [f.decode() if isinstance(f, bytes) else f for f in result[2:]]
+        return bool(result[0]), bool(result[1]), flags
+
+    def run(self, user_id, now, rate_keys=None, rate_args=None, baseline=None):
+        """rate_keys=None 时不计频率；baseline=None 时不动基线"""
+        keys, args = self._keys_args(user_id, now, rate_keys, rate_args, baseline)
+        return self._parse(self._script(keys=keys, args=args))
+
+    def run_many(self, user_id, now, baselines):
+        """只更新基线（不计频率），按顺序在同一 pipeline 内执行；baselines 中的 None 项原样跳过"""
+        for attempt in (0, 1):
+            pipe = self.client.pipeline(transaction=False)
+            for baseline in baselines:
+                keys, args = self._keys_args(user_id, now, None, None, baseline)
+                pipe.evalsha(self._script.sha, len(keys), *keys, *args)
+            try:
+                return [self._parse(r) for r in pipe.execute()]
+            except NoScriptError:
+                if attempt:
+                    raise
+                self._script.sha = self.client.script_load(BASELINE_HIT_LUA)